@@ -1,22 +1,164 @@
 import os
 import sys
+import json
+import shutil
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import socket
+import time
 import requests
 import bz2
 from gensim.corpora import WikiCorpus
 from tqdm import tqdm
-import tensorflow as tf
 from transformers import AutoTokenizer, TFGPT2LMHeadModel
 
 from pyknp import Juman
 
+# src/ 以下の学習用モジュールを共有する
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from config import env_bool, env_int, env_str
+from dataset import build_packed_dataset
+from downloader import DownloadError, RangeDownloader, fetch_checksum, file_digest
+from lm_trainer import fit_language_model, fit_language_model_distributed, is_chief, mixed_precision
+from shards import num_shard_sequences, shard_dataset, shards_complete, write_shards
+from token_cache import TokenCache
+
+WIKI_DUMP_NAME = "jawiki-latest-pages-articles.xml.bz2"
+WIKI_CHECKSUM_NAME = "jawiki-latest-md5sums.txt"
+
+# 形態素解析ワーカーごとに1つだけ起動するJuman++
+_worker_juman = None
+
+
+def _init_juman_worker():
+    global _worker_juman
+    _worker_juman = Juman()
+
+
+def _analyze_byte_range(task):
+    """
+    入力ファイルの指定されたバイト範囲を1行ずつ分かち書きし、パートファイルに書き出す
+    """
+    index, start, end, input_path, part_path = task
+    lines = 0
+    with open(input_path, 'rb') as f_in:
+        f_in.seek(start)
+        data = f_in.read(end - start).decode('utf-8')
+    with open(part_path + ".tmp", 'w', encoding='utf-8') as f_out:
+        for line in data.splitlines():
+            line = line.strip()
+            if line:
+                try:
+                    result = _worker_juman.analysis(line)
+                    wakati_text = " ".join(mrph.midasi for mrph in result.mrph_list())
+                except Exception:
+                    # 解析できない行があっても、チャンク全体はやり直さない
+                    wakati_text = line
+                f_out.write(wakati_text + "\n")
+            lines += 1
+    os.replace(part_path + ".tmp", part_path)
+    return index, lines
+
+
+def bz2_complete(path, chunk_size=1 << 20):
+    """
+    bz2ファイルが最後まで壊れずに展開できるかを返す（途中で切れたファイルはEOFErrorになる）
+    """
+    try:
+        with bz2.open(path, "rb") as f:
+            while f.read(chunk_size):
+                pass
+        return True
+    except (EOFError, OSError):
+        return False
+
+
+class _SkipPagesThrough:
+    """
+    WikiCorpusのfilter_articlesに渡し、記事ID pageid のページまでを解析せずに読み飛ばす
+    読み飛ばしたページは本文が空として扱われ、解析のプロセスでほとんど時間を使わない
+    """
+    def __init__(self, pageid):
+        self.pageid = pageid
+
+    def __call__(self, elem, pageid_path, **kwargs):
+        if self.pageid is None:
+            return True
+        if elem.find(pageid_path).text == self.pageid:
+            self.pageid = None
+        return False
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _pretrain_worker(options, tf_config=None, threads=None):
+    """
+    シャードでの事前学習を行うワーカー。tf_configを渡した場合はMultiWorkerMirroredStrategyの1ワーカーとして動く
+    学習が終わったらチーフのワーカーがモデルを保存する
+    """
+    import tensorflow as tf
+
+    if tf_config is not None:
+        os.environ["TF_CONFIG"] = tf_config
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(max(1, threads // 2))
+    if os.environ.get("TF_CONFIG"):
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    else:
+        strategy = tf.distribute.get_strategy()
+
+    tokenizer = AutoTokenizer.from_pretrained(options["base_model_name"])
+    with mixed_precision(options["mixed_precision"]), strategy.scope():
+        model = TFGPT2LMHeadModel.from_pretrained(options["base_model_name"])
+        if tokenizer.pad_token is None:
+            tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+            model.resize_token_embeddings(len(tokenizer))
+
+    global_batch_size = options["batch_size"] * strategy.num_replicas_in_sync
+    steps_per_epoch = max(1, options["num_sequences"] // global_batch_size)
+
+    def dataset_fn(input_context):
+        return shard_dataset(
+            options["shard_dir"],
+            input_context.get_per_replica_batch_size(global_batch_size),
+            tokenizer.pad_token_id,
+            input_context=input_context,
+            shuffle_buffer_size=options["shuffle_buffer_size"],
+        )
+
+    with mixed_precision(options["mixed_precision"]):
+        fit_language_model_distributed(
+            strategy, model, dataset_fn, options["epochs"], steps_per_epoch, options["checkpoint_dir"],
+            learning_rate=5e-5, checkpoint_every=options["checkpoint_every"],
+        )
+
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None or is_chief(resolver.task_type, resolver.task_id, resolver.cluster_spec().as_dict()):
+        print("Training finished. Saving new base model...")
+        model.save_pretrained(options["new_model_dir"])
+        tokenizer.save_pretrained(options["new_model_dir"])
+        shutil.rmtree(options["checkpoint_dir"], ignore_errors=True)
+        print(f"New base model saved to {options['new_model_dir']}")
+
+
 class WikipediaTrainer:
     def __init__(self, base_model_name="rinna/japanese-gpt2-small", new_model_dir="models/wikipedia_base"):
         self.base_model_name = base_model_name
         self.new_model_dir = new_model_dir
         self.data_dir = "AI/data"
-        self.wiki_dump_path = os.path.join(self.data_dir, "jawiki-latest-pages-articles.xml.bz2")
+        self.wiki_dump_path = os.path.join(self.data_dir, WIKI_DUMP_NAME)
         self.wiki_text_path = os.path.join(self.data_dir, "wiki_jp.txt")
+        self.wiki_shard_dir = os.path.join(self.data_dir, "wiki_jp_shards")
         self.wiki_wakati_path = os.path.join(self.data_dir, "wiki_jp_wakati.txt")
+        self.wiki_wakati_part_dir = os.path.join(self.data_dir, "wiki_jp_wakati_parts")
+        self.wiki_shard_token_dir = os.path.join(self.data_dir, "wiki_jp_token_shards")
+        self.pretrain_checkpoint_dir = os.path.join(self.data_dir, "pretrain_checkpoints")
 
         os.makedirs(self.data_dir, exist_ok=True)
         os.makedirs(self.new_model_dir, exist_ok=True)
@@ -31,54 +173,141 @@ class WikipediaTrainer:
     def download_wikipedia_dump(self):
         """
         日本語Wikipediaの最新ダンプをダウンロードする
+        Rangeリクエストで区間ごとに並列にダウンロードし、中断した場合は完了済みの区間の続きから再開する
+        公開されているmd5と一致したものだけを完成したダンプとして扱う
+        検証の記録がない既存のダンプは、最後まで展開できれば以前の月のものでもそのまま使う
         """
+        base_url = env_str("AI_KUN_WIKI_DUMP_URL", "https://dumps.wikimedia.org/jawiki/latest").rstrip("/")
+        url = f"{base_url}/{WIKI_DUMP_NAME}"
+        try:
+            checksum = fetch_checksum(f"{base_url}/{WIKI_CHECKSUM_NAME}", WIKI_DUMP_NAME)
+        except (requests.exceptions.RequestException, DownloadError) as e:
+            print(f"[WARNING] Failed to fetch the published checksum: {e}. The download will not be verified.")
+            checksum = None
+
+        verified_path = self.wiki_dump_path + ".md5"
         if os.path.exists(self.wiki_dump_path):
-            print("Wikipedia dump already exists. Skipping download.")
-            return
+            # 検証の記録がない（以前の方法でダウンロードした）ダンプは、一度だけ中身を確かめる
+            if os.path.exists(verified_path) or checksum is None:
+                print("Wikipedia dump already exists. Skipping download.")
+                return
+            digest = file_digest(self.wiki_dump_path)
+            if digest == checksum:
+                with open(verified_path, "w", encoding="utf-8") as f:
+                    f.write(digest)
+                print("Wikipedia dump already exists. Skipping download.")
+                return
+            # 以前の月のダンプはmd5が最新のものと一致しないので、bz2として最後まで読めるかで完全かを確かめる
+            if bz2_complete(self.wiki_dump_path):
+                with open(verified_path, "w", encoding="utf-8") as f:
+                    f.write(digest)
+                print("[WARNING] The existing Wikipedia dump is complete but older than the latest published dump. "
+                      f"Using it anyway; delete {self.wiki_dump_path} to download the latest one.")
+                return
+            print("[WARNING] The existing Wikipedia dump is incomplete or corrupted. Downloading it again...")
 
-        url = "https://dumps.wikimedia.org/jawiki/latest/jawiki-latest-pages-articles.xml.bz2"
         print(f"Downloading Wikipedia dump from {url} ... (This may take a very long time)")
-
+        downloader = RangeDownloader(
+            connections=env_int("AI_KUN_DOWNLOAD_CONNECTIONS", 4),
+            segment_size=env_int("AI_KUN_DOWNLOAD_SEGMENT_MB", 64) << 20,
+        )
         try:
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                total_size = int(r.headers.get('content-length', 0))
-                with open(self.wiki_dump_path, 'wb') as f, tqdm(
-                    total=total_size, unit='iB', unit_scale=True, desc="jawiki-dump"
-                ) as pbar:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+            with tqdm(unit='iB', unit_scale=True, desc="jawiki-dump") as pbar:
+                downloader.download(url, self.wiki_dump_path, checksum=checksum, progress=pbar)
+            if checksum is not None:
+                with open(verified_path, "w", encoding="utf-8") as f:
+                    f.write(checksum)
             print("Download complete.")
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, DownloadError) as e:
             print(f"Failed to download Wikipedia dump: {e}")
             sys.exit(1)
 
-    def extract_and_clean_text(self):
+    def extract_and_clean_text(self, articles_per_shard=50000, processes=None):
         """
         ダンプファイルからテキストを抽出し、整形する
+        ダンプは1回だけ走査し、記事の解析は複数プロセスで行う。結果は一定件数ごとのシャードに書き出し、
+        中断した場合は完了済みのシャードの続きから再開する（完了済みの記事は解析しないが、bz2の展開はやり直す）
         """
         if os.path.exists(self.wiki_text_path):
             print("Cleaned Wikipedia text already exists. Skipping extraction.")
             return
 
         print("Extracting and cleaning text from Wikipedia dump... (This may also take a while)")
+        os.makedirs(self.wiki_shard_dir, exist_ok=True)
+        progress = self._load_extract_progress()
+        stat = os.stat(self.wiki_dump_path)
+        dump = f"{stat.st_size}:{stat.st_mtime_ns}"
+        if progress.get("dump", dump) != dump:
+            # 記事IDで続きを探すので、別のダンプの進捗からは再開しない
+            print("[WARNING] The Wikipedia dump has changed since the last extraction. Starting over.")
+            progress = {"shards": []}
+        progress["dump"] = dump
+        skip = sum(shard["articles"] for shard in progress["shards"])
+        last_pageid = progress["shards"][-1].get("last_pageid") if progress["shards"] else None
 
         # gensimのWikiCorpusはファイル名を渡すと自動でbzip2を展開してくれる
-        wiki = WikiCorpus(self.wiki_dump_path, lemmatize=False, dictionary={})
-
-        count = 0
-        with open(self.wiki_text_path, 'w', encoding='utf-8') as output_file:
-            # tqdmを使って進捗を表示
-            with tqdm(total=sum(1 for _ in wiki.get_texts()), desc="Extracting articles") as pbar:
-                for text in wiki.get_texts():
-                    article = " ".join(text)
-                    output_file.write(article + "\n")
-                    count += 1
+        # 再開する場合は、完了済みのシャードの最後の記事までを解析に回さない（bz2の展開とXMLの読み飛ばしだけは行う）
+        processes = processes or max(1, (os.cpu_count() or 1) - 1)
+        wiki = WikiCorpus(self.wiki_dump_path, dictionary={}, processes=processes, metadata=True,
+                          filter_articles=_SkipPagesThrough(last_pageid))
+        texts = wiki.get_texts()
+        if skip:
+            print(f"Resuming after {len(progress['shards'])} completed shard(s) ({skip} articles).")
+            if last_pageid is None:
+                # 記事IDを記録していない以前の形式の進捗では、完了済みの記事も解析してから読み飛ばす
+                texts = itertools.islice(texts, skip, None)
+
+        output_file, shard_path, shard_articles = None, None, 0
+        try:
+            # 記事数を数えるための事前走査はせず、処理済み件数と速度だけを表示する
+            with tqdm(initial=skip, unit="articles", desc="Extracting articles") as pbar:
+                for text, (pageid, _) in texts:
+                    if output_file is None:
+                        shard_path = os.path.join(self.wiki_shard_dir, f"wiki_jp_{len(progress['shards']):05d}.txt")
+                        output_file = open(shard_path + ".tmp", 'w', encoding='utf-8')
+                    output_file.write(" ".join(text) + "\n")
+                    shard_articles += 1
                     pbar.update(1)
-
+                    if shard_articles == articles_per_shard:
+                        output_file.close()
+                        output_file = None
+                        self._complete_extract_shard(progress, shard_path, shard_articles, pageid)
+                        shard_articles = 0
+            if output_file is not None:
+                output_file.close()
+                output_file = None
+                self._complete_extract_shard(progress, shard_path, shard_articles, pageid)
+        finally:
+            if output_file is not None:
+                output_file.close()
+
+        # シャードを1つのファイルにまとめる
+        tmp_path = self.wiki_text_path + ".tmp"
+        with open(tmp_path, 'wb') as output_file:
+            for shard in progress["shards"]:
+                with open(os.path.join(self.wiki_shard_dir, shard["name"]), 'rb') as f:
+                    shutil.copyfileobj(f, output_file, 16 * 1024 * 1024)
+        os.replace(tmp_path, self.wiki_text_path)
+        shutil.rmtree(self.wiki_shard_dir, ignore_errors=True)
+
+        count = sum(shard["articles"] for shard in progress["shards"])
         print(f"Finished extracting {count} articles to {self.wiki_text_path}")
 
+    def _load_extract_progress(self):
+        try:
+            with open(os.path.join(self.wiki_shard_dir, "progress.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"shards": []}
+
+    def _complete_extract_shard(self, progress, shard_path, articles, last_pageid):
+        os.replace(shard_path + ".tmp", shard_path)
+        progress["shards"].append({"name": os.path.basename(shard_path), "articles": articles, "last_pageid": last_pageid})
+        progress_path = os.path.join(self.wiki_shard_dir, "progress.json")
+        with open(progress_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(progress, f, indent=1)
+        os.replace(progress_path + ".tmp", progress_path)
+
     def add_bot_description(self):
         """
         学習データにBOT自身の仕様説明を追加する
@@ -100,25 +329,34 @@ class WikipediaTrainer:
 
 AIは定期的に最新の会話を学習し、賢くなっていきます。
 """
+        header = bot_description.strip() + '\n\n'
         try:
-            with open(self.wiki_text_path, 'r+', encoding='utf-8') as f:
-                content = f.read()
-                f.seek(0, 0)
-                f.write(bot_description.strip() + '\n\n' + content)
+            with open(self.wiki_text_path, 'r', encoding='utf-8') as f:
+                if f.read(len(header)) == header:
+                    # 再実行時に説明を重ねて追加しない（後続の解析の再開情報も無効にしない）
+                    print("Bot description is already present. Skipping.")
+                    return
+
+            # 巨大なファイルを丸ごと読み込まないよう、一時ファイルに説明と本文を順に書き出す
+            tmp_path = self.wiki_text_path + ".tmp"
+            with open(self.wiki_text_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+                f_out.write(header.encode('utf-8'))
+                shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+            os.replace(tmp_path, self.wiki_text_path)
             print("Bot description added successfully.")
         except IOError as e:
             print(f"Error adding bot description: {e}")
             sys.exit(1)
 
-    def morphological_analysis(self):
+    def morphological_analysis(self, processes=None, chunk_bytes=8 * 1024 * 1024):
         """
         Juman++を使ってテキストを分かち書きする
+        CPUコアごとにJuman++のワーカープロセスを起動し、チャンク単位で並列に解析する
         """
         if self.juman is None:
             print("Skipping morphological analysis because Juman++ is not available.")
             print(f"Copying {self.wiki_text_path} to {self.wiki_wakati_path} as a fallback.")
             try:
-                import shutil
                 shutil.copyfile(self.wiki_text_path, self.wiki_wakati_path)
             except IOError as e:
                 print(f"Error copying file: {e}")
@@ -131,82 +369,230 @@ AIは定期的に最新の会話を学習し、賢くなっていきます。
 
         print("Performing morphological analysis... (This will take an extremely long time)")
         try:
-            with open(self.wiki_text_path, 'r', encoding='utf-8') as f_in, \
-                 open(self.wiki_wakati_path, 'w', encoding='utf-8') as f_out:
-
-                total_lines = sum(1 for line in f_in)
-                f_in.seek(0) # ファイルポインタを先頭に戻す
-
-                with tqdm(total=total_lines, desc="Analyzing sentences") as pbar:
-                    for line in f_in:
-                        line = line.strip()
-                        if line:
-                            result = self.juman.analysis(line)
-                            wakati_text = " ".join(mrph.midasi for mrph in result.mrph_list())
-                            f_out.write(wakati_text + "\n")
-                        pbar.update(1)
+            # 入力を行の境界で区切ったバイト範囲に分け、各範囲をJuman++のワーカープロセスで解析する
+            os.makedirs(self.wiki_wakati_part_dir, exist_ok=True)
+            ranges = self._load_or_plan_ranges(chunk_bytes)
+            part_paths = [os.path.join(self.wiki_wakati_part_dir, f"part_{i:05d}.txt") for i in range(len(ranges))]
+            # 完了済みのパートは解析し直さない
+            tasks = [
+                (i, start, end, self.wiki_text_path, part_paths[i])
+                for i, (start, end) in enumerate(ranges)
+                if not os.path.exists(part_paths[i])
+            ]
+            if len(tasks) < len(ranges):
+                print(f"Resuming: {len(ranges) - len(tasks)} of {len(ranges)} chunk(s) already analyzed.")
+
+            processes = processes or os.cpu_count() or 1
+            total_lines = 0
+            started_at = time.perf_counter()
+            with multiprocessing.Pool(processes, initializer=_init_juman_worker) as pool, \
+                 tqdm(total=len(ranges), initial=len(ranges) - len(tasks), unit="chunks", desc="Analyzing sentences") as pbar:
+                for _, lines in pool.imap_unordered(_analyze_byte_range, tasks):
+                    total_lines += lines
+                    pbar.update(1)
+                    pbar.set_postfix(lines_per_sec=f"{total_lines / (time.perf_counter() - started_at):.1f}")
+
+            elapsed = time.perf_counter() - started_at
+            if total_lines:
+                print(f"Analyzed {total_lines} lines in {elapsed:.1f}s ({total_lines / elapsed:.1f} lines/sec, {processes} worker(s)).")
+
+            # 元の順序でパートを結合する
+            tmp_path = self.wiki_wakati_path + ".tmp"
+            with open(tmp_path, 'wb') as f_out:
+                for part_path in part_paths:
+                    with open(part_path, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+            os.replace(tmp_path, self.wiki_wakati_path)
+            shutil.rmtree(self.wiki_wakati_part_dir, ignore_errors=True)
             print(f"Finished morphological analysis. Output: {self.wiki_wakati_path}")
         except Exception as e:
             print(f"An error occurred during morphological analysis: {e}")
             sys.exit(1)
 
-    def train_model(self, epochs=1, batch_size=2):
+    def _load_or_plan_ranges(self, chunk_bytes):
+        """
+        入力ファイルを行の境界で区切ったバイト範囲の一覧を返す
+        再開時に同じ区切りを使えるよう、入力ファイルのサイズ・更新時刻とともに保存する
+        """
+        stat = os.stat(self.wiki_text_path)
+        plan_path = os.path.join(self.wiki_wakati_part_dir, "ranges.json")
+        try:
+            with open(plan_path, 'r', encoding='utf-8') as f:
+                plan = json.load(f)
+            if plan["size"] == stat.st_size and plan["mtime_ns"] == stat.st_mtime_ns:
+                return plan["ranges"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        # 入力が変わっていれば以前のパートは使えない
+        shutil.rmtree(self.wiki_wakati_part_dir, ignore_errors=True)
+        os.makedirs(self.wiki_wakati_part_dir, exist_ok=True)
+
+        ranges = []
+        start = 0
+        with open(self.wiki_text_path, 'rb') as f:
+            while start < stat.st_size:
+                end = min(start + chunk_bytes, stat.st_size)
+                if end < stat.st_size:
+                    f.seek(end)
+                    f.readline()
+                    end = f.tell()
+                ranges.append((start, end))
+                start = end
+
+        with open(plan_path, 'w', encoding='utf-8') as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "ranges": ranges}, f)
+        return ranges
+
+    def train_model(self, epochs=1, batch_size=2, shuffle_buffer_size=10000):
         """
         整形済みデータでベースモデルを追加学習する
+        勾配の累積（AI_KUN_GRAD_ACCUMULATION）とbfloat16の混合精度（AI_KUN_MIXED_PRECISION）は環境変数で指定する
+        AI_KUN_SHARDED_PRETRAINING が有効な場合は train_model_sharded で学習する
         """
         if os.path.exists(os.path.join(self.new_model_dir, "tf_model.h5")):
             print("Pre-trained Wikipedia model already exists. Skipping training.")
             return
+        if env_bool("AI_KUN_SHARDED_PRETRAINING", False):
+            self.train_model_sharded(epochs=epochs, batch_size=batch_size, shuffle_buffer_size=shuffle_buffer_size)
+            return
 
         print("Starting training on Wikipedia data...")
 
         print("Loading tokenizer and model...")
+        use_mixed_precision = env_bool("AI_KUN_MIXED_PRECISION", False)
+        accumulation_steps = env_int("AI_KUN_GRAD_ACCUMULATION", 1)
         tokenizer = AutoTokenizer.from_pretrained(self.base_model_name)
-        model = TFGPT2LMHeadModel.from_pretrained(self.base_model_name)
+        with mixed_precision(use_mixed_precision):
+            model = TFGPT2LMHeadModel.from_pretrained(self.base_model_name)
 
         if tokenizer.pad_token is None:
             tokenizer.add_special_tokens({'pad_token': '[PAD]'})
             model.resize_token_embeddings(len(tokenizer))
 
         print("Loading and preparing dataset...")
-        try:
-            with open(self.wiki_wakati_path, 'r', encoding='utf-8') as f:
-                full_text = f.read()
-        except FileNotFoundError:
+        if not os.path.exists(self.wiki_wakati_path):
             print(f"Error: Processed data file not found at {self.wiki_wakati_path}. Please run the data preparation steps first.")
             sys.exit(1)
 
-        tokenized_text = tokenizer.encode(full_text)
-
-        examples = []
+        # トークン化の結果はキャッシュし、入力が変わっていなければ再利用する
         block_size = 128
-        for i in range(0, len(tokenized_text) - block_size + 1, block_size):
-            examples.append(tokenized_text[i:i + block_size])
+        files = [self.wiki_wakati_path]
+        cache = TokenCache(os.path.join(self.data_dir, ".token_cache"), tokenizer)
+        cache.update(files)
+        num_examples = cache.num_sequences(files, block_size)
 
-        if not examples:
+        if num_examples == 0:
             print("Not enough text data to create training examples.")
             return
 
-        inputs, labels = [], []
-        for ex in examples:
-            inputs.append(ex[:-1])
-            labels.append(ex[1:])
-
-        dataset = tf.data.Dataset.from_tensor_slices((inputs, labels))
-        dataset = dataset.shuffle(len(examples)).batch(batch_size, drop_remainder=True)
+        # 行（記事の段落）の境界に沿ってシーケンスに詰め、長さの近いものを同じバッチにする
+        # Wikipediaのデータはメモリに載り切らないため、tf.dataのキャッシュは使わない
+        dataset = build_packed_dataset(
+            lambda: cache.iter_packed(files, block_size),
+            block_size,
+            batch_size,
+            tokenizer.pad_token_id,
+            shuffle_buffer_size=min(num_examples, shuffle_buffer_size),
+        )
 
-        optimizer = tf.keras.optimizers.Adam(learning_rate=5e-5)
-        loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-        model.compile(optimizer=optimizer, loss=loss)
-
-        print(f"Starting fine-tuning for {epochs} epoch(s)...")
-        model.fit(dataset, epochs=epochs)
+        print(f"Starting fine-tuning for {epochs} epoch(s) (batch size {batch_size} x {accumulation_steps} accumulation steps)...")
+        with mixed_precision(use_mixed_precision):
+            fit_language_model(model, dataset, epochs, learning_rate=5e-5, accumulation_steps=accumulation_steps)
 
         print("Training finished. Saving new base model...")
         model.save_pretrained(self.new_model_dir)
         tokenizer.save_pretrained(self.new_model_dir)
         print(f"New base model saved to {self.new_model_dir}")
 
+    def train_model_sharded(self, epochs=1, batch_size=2, shuffle_buffer_size=10000, block_size=128):
+        """
+        トークン化済みのシャードから、複数のワーカーでベースモデルを追加学習する
+        AI_KUN_PRETRAIN_WORKERS 個のローカルプロセスをMultiWorkerMirroredStrategyでつなぎ、batch_sizeはワーカーごとの値になる
+        環境変数TF_CONFIGが設定されている場合は、複数のマシンで学習するうちの1ワーカーとして、このプロセスだけで学習する
+        （チェックポイントとシャードは、すべてのワーカーから同じパスで読める場所に置く）
+        AI_KUN_PRETRAIN_CHECKPOINT_STEPS ステップごとにチェックポイントを保存し、中断した場合はその続きから再開する
+        """
+        print("Starting sharded training on Wikipedia data...")
+        if not os.path.exists(self.wiki_wakati_path):
+            print(f"Error: Processed data file not found at {self.wiki_wakati_path}. Please run the data preparation steps first.")
+            sys.exit(1)
+
+        tf_config = json.loads(os.environ.get("TF_CONFIG") or "{}")
+        task = tf_config.get("task", {})
+        if is_chief(task.get("type", "worker") if tf_config else None, task.get("index", 0), tf_config.get("cluster")):
+            print("Preparing token shards...")
+            tokenizer = AutoTokenizer.from_pretrained(self.base_model_name)
+            if tokenizer.pad_token is None:
+                tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+            files = [self.wiki_wakati_path]
+            cache = TokenCache(os.path.join(self.data_dir, ".token_cache"), tokenizer)
+            cache.update(files)
+            write_shards(cache, files, block_size, self.wiki_shard_token_dir)
+        else:
+            # 共有ストレージのシャードは、チーフのワーカーだけが書き出す
+            print("Waiting for the chief worker to write token shards...")
+            while not shards_complete(self.wiki_shard_token_dir):
+                time.sleep(10)
+        num_sequences = num_shard_sequences(self.wiki_shard_token_dir)
+        if num_sequences == 0:
+            print("Not enough text data to create training examples.")
+            return
+
+        options = {
+            "base_model_name": self.base_model_name,
+            "new_model_dir": self.new_model_dir,
+            "shard_dir": self.wiki_shard_token_dir,
+            "checkpoint_dir": self.pretrain_checkpoint_dir,
+            "num_sequences": num_sequences,
+            "epochs": epochs,
+            "batch_size": batch_size,
+            "shuffle_buffer_size": min(num_sequences, shuffle_buffer_size),
+            "checkpoint_every": env_int("AI_KUN_PRETRAIN_CHECKPOINT_STEPS", 1000),
+            "mixed_precision": env_bool("AI_KUN_MIXED_PRECISION", False),
+        }
+        if os.environ.get("TF_CONFIG"):
+            _pretrain_worker(options)
+            return
+
+        workers = max(1, env_int("AI_KUN_PRETRAIN_WORKERS", 1))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        print(f"Starting {workers} worker(s) with {threads} thread(s) each (batch size {batch_size} per worker)...")
+        if workers == 1:
+            _pretrain_worker(options, threads=threads)
+            return
+
+        # 親プロセスのTensorFlowの状態を引き継がないよう、spawnで新しいプロセスを起動する
+        context = multiprocessing.get_context("spawn")
+        addresses = [f"127.0.0.1:{_free_port()}" for _ in range(workers)]
+        processes = []
+        for index in range(workers):
+            tf_config = json.dumps({"cluster": {"worker": addresses}, "task": {"type": "worker", "index": index}})
+            process = context.Process(target=_pretrain_worker, args=(options, tf_config, threads), name=f"ai-kun-pretrain-{index}")
+            process.start()
+            processes.append(process)
+        try:
+            running = list(processes)
+            while running:
+                for sentinel in multiprocessing.connection.wait([process.sentinel for process in running]):
+                    process = next(process for process in running if process.sentinel == sentinel)
+                    process.join()
+                    running.remove(process)
+                    if process.exitcode != 0:
+                        raise RuntimeError(f"{process.name} exited with code {process.exitcode}")
+        except (RuntimeError, KeyboardInterrupt) as e:
+            print(f"[WARNING] Stopping training workers: {e!r}")
+        finally:
+            # 1つのワーカーが止まると他のワーカーは集約を待ち続けるため、残ったワーカーも止める
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        failed = [process.name for process in processes if process.exitcode != 0]
+        if failed:
+            print(f"Training worker(s) failed: {', '.join(failed)}. Run again to resume from the last checkpoint.")
+            sys.exit(1)
+
     def run_full_pipeline(self):
         """
         データ準備から学習までの全パイプラインを実行する
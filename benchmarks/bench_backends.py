@@ -0,0 +1,108 @@
+"""
+推論バックエンドごとの応答レイテンシと、eager を基準にした生成結果の一致度を計測する
+
+    python benchmarks/bench_backends.py [--model models/fine_tuned] [--backends eager,xla,tflite,onnx]
+
+CPU上で1件ずつ応答を生成し、p50 / p95 のレイテンシ（ミリ秒）と、
+eager と完全に一致した応答の割合・生成トークンの一致率を表示する。
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+from transformers import AutoTokenizer, TFGPT2LMHeadModel
+import tensorflow as tf
+
+from backends import create_backend
+from learning import AILearner, ServingModel
+
+PROMPTS = [
+    "おはようございます",
+    "今日は何をしていますか？",
+    "昨日のゲーム楽しかったね",
+    "明日の予定はどうなっている？",
+    "おすすめの本を教えて",
+    "このサーバーのルールを教えてください",
+    "お昼ご飯なに食べた？",
+    "週末は晴れるらしいよ",
+]
+
+
+def token_agreement(reference, candidate):
+    """
+    位置ごとに一致したトークンの割合（長さが違う部分は不一致として数える）
+    """
+    length = max(len(reference), len(candidate))
+    if length == 0:
+        return 1.0
+    return sum(a == b for a, b in zip(reference, candidate)) / length
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=None, help="学習済みモデルのディレクトリ（省略時は現在のバージョンまたはベースモデル）")
+    parser.add_argument("--backends", default="eager,xla,tflite,onnx")
+    parser.add_argument("--repeat", type=int, default=3, help="各プロンプトを生成する回数")
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--quantization", default="int8", help="tflite の量子化方式（int8 / float16 / none）")
+    args = parser.parse_args()
+
+    # GPUがあっても CPU 上で計測する
+    tf.config.set_visible_devices([], "GPU")
+
+    learner = AILearner()
+    # 応答キャッシュを使うと2回目以降の計測が意味をなさないため無効にする
+    learner.response_cache.max_entries = 0
+    model_path = args.model
+    if model_path is None:
+        version = learner.registry.current()
+        model_path = learner.registry.path(version) if version is not None else learner.model_name
+    print(f"Loading model from {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+    model = TFGPT2LMHeadModel.from_pretrained(model_path)
+
+    reference = None
+    rows = []
+    for name in args.backends.split(","):
+        options = {"quantization": args.quantization} if name == "tflite" else {}
+        start = time.perf_counter()
+        backend = create_backend(name, model, tokenizer, model_path, **options)
+        if backend.name != name:
+            print(f"Skipping {name}: backend is not available.")
+            continue
+        learner.serving = ServingModel(model, tokenizer, name, backend, None)
+        # 初回呼び出しのコンパイル時間は別に表示し、レイテンシの計測から除く
+        learner.predict_batch(PROMPTS[:1], max_length=args.max_length)
+        setup = time.perf_counter() - start
+
+        latencies = []
+        responses = []
+        for _ in range(args.repeat):
+            for prompt in PROMPTS:
+                begin = time.perf_counter()
+                responses.append(learner.predict(prompt, max_length=args.max_length))
+                latencies.append((time.perf_counter() - begin) * 1000)
+        responses = responses[:len(PROMPTS)]
+        if reference is None:
+            reference = responses
+
+        exact = sum(a == b for a, b in zip(reference, responses)) / len(PROMPTS)
+        agreement = np.mean([
+            token_agreement(tokenizer.encode(a), tokenizer.encode(b)) for a, b in zip(reference, responses)
+        ])
+        rows.append((name, setup, np.percentile(latencies, 50), np.percentile(latencies, 95), exact, agreement))
+
+    print(f"{'backend':>8} {'setup s':>8} {'p50 ms':>8} {'p95 ms':>8} {'exact':>6} {'tokens':>7}")
+    for name, setup, p50, p95, exact, agreement in rows:
+        print(f"{name:>8} {setup:>8.2f} {p50:>8.1f} {p95:>8.1f} {exact:>6.2f} {agreement:>7.2f}")
+    print(f"(exact / tokens: agreement with the {args.backends.split(',')[0]} backend)")
+
+
+if __name__ == "__main__":
+    main()
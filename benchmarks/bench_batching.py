@@ -0,0 +1,73 @@
+"""
+まとめて生成（マイクロバッチ）した場合の応答スループットを計測する
+
+    python benchmarks/bench_batching.py [--model models/fine_tuned] [--replies 32]
+
+CPU上でバッチサイズ 1 / 4 / 16 の replies/sec を表示する。
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# 同じプロンプトを繰り返すので、応答キャッシュを切って毎回生成させる（環境変数で上書きできる）
+os.environ.setdefault("AI_KUN_RESPONSE_CACHE_SIZE", "0")
+
+from transformers import AutoTokenizer, TFGPT2LMHeadModel
+import tensorflow as tf
+
+from backends import EagerBackend
+from learning import AILearner, ServingModel
+
+PROMPTS = [
+    "おはようございます",
+    "今日は何をしていますか？",
+    "昨日のゲーム楽しかったね",
+    "明日の予定はどうなっている？",
+    "おすすめの本を教えて",
+    "このサーバーのルールを教えてください",
+    "お昼ご飯なに食べた？",
+    "週末は晴れるらしいよ",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=None, help="学習済みモデルのディレクトリ（省略時は現在のバージョンまたはベースモデル）")
+    parser.add_argument("--replies", type=int, default=32, help="バッチサイズごとに生成する応答数")
+    parser.add_argument("--max-length", type=int, default=50)
+    parser.add_argument("--batch-sizes", default="1,4,16")
+    args = parser.parse_args()
+
+    # GPUがあっても CPU 上で計測する
+    tf.config.set_visible_devices([], "GPU")
+
+    learner = AILearner()
+    model_path = args.model
+    if model_path is None:
+        version = learner.registry.current()
+        model_path = learner.registry.path(version) if version is not None else learner.model_name
+    print(f"Loading model from {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+    model = TFGPT2LMHeadModel.from_pretrained(model_path)
+    learner.serving = ServingModel(model, tokenizer, "benchmark", EagerBackend(model, tokenizer, model_path), None)
+
+    # 初回呼び出しのトレース時間を計測から除く
+    learner.predict_batch(PROMPTS[:1], max_length=args.max_length)
+
+    print(f"{'batch':>6} {'replies':>8} {'seconds':>9} {'replies/sec':>12}")
+    for batch_size in (int(size) for size in args.batch_sizes.split(",")):
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(args.replies)]
+        start = time.perf_counter()
+        for i in range(0, len(prompts), batch_size):
+            learner.predict_batch(prompts[i:i + batch_size], max_length=args.max_length)
+        elapsed = time.perf_counter() - start
+        print(f"{batch_size:>6} {len(prompts):>8} {elapsed:>9.2f} {len(prompts) / elapsed:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
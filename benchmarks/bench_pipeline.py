@@ -0,0 +1,337 @@
+"""
+会話の収集 → トークン化 → 学習 → 応答生成 の各段階の性能を、Discordにもモデルのダウンロードにも頼らずに計測する
+
+    python benchmarks/bench_pipeline.py [--output bench_pipeline.json] [--baseline previous.json] [--profile cprofile|tf]
+
+作業ディレクトリ（省略時は一時ディレクトリ）に小さなGPT-2と文字単位のトークナイザーを作り、
+偽のギルド・チャンネル（fake_discord.py）で research_and_collect と on_message を実行する。
+収集のメッセージ/秒、トークン化のトークン/秒、学習のステップ/秒、predict の p50 / p95 レイテンシとスループット、
+on_message の応答/秒を表示してJSONに保存する。--baseline を指定すると、以前の結果との差も表示する。
+--profile を指定すると、段階ごとに cProfile の結果（<段階>.prof、メインスレッドのみ）か
+TensorFlow Profiler のトレース（TensorBoardで表示）を --profile-dir に保存する。
+"""
+import argparse
+import asyncio
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import platform
+import pstats
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# 計測の妨げになる機能は切っておく（環境変数で上書きできる）
+BENCH_ENV = {
+    "TF_CPP_MIN_LOG_LEVEL": "2",
+    "AI_KUN_STATE_PATH": os.path.join("data", "state.sqlite3"),
+    "AI_KUN_RESPONSE_CACHE_SIZE": "0",
+    "AI_KUN_STREAMING": "0",
+    "AI_KUN_CHANNEL_RATE_PER_MIN": "0",
+    "AI_KUN_GLOBAL_RATE_PER_MIN": "0",
+    "AI_KUN_COALESCE_SECONDS": "0",
+    "AI_KUN_QUEUE_DEADLINE": "0",
+    "AI_KUN_INFERENCE_QUEUE_SIZE": "1024",
+}
+for name, value in BENCH_ENV.items():
+    os.environ.setdefault(name, value)
+
+import discord
+import numpy as np
+import tensorflow as tf
+import transformers
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import GPT2Config, PreTrainedTokenizerFast, TFGPT2LMHeadModel
+
+from bot import AIKunBot
+from corpus import corpus_files, iter_records
+from fake_discord import WORDS, FakeAuthor, FakeMessage, make_guilds, random_sentence
+from learning import AILearner
+from token_cache import TokenCache
+
+BASE_MODEL_DIR = os.path.join("models", "wikipedia_base")
+
+
+class BenchBot(AIKunBot):
+    """
+    ログインせずに、偽のギルドを参加中のギルドとして扱うボット
+    """
+    def __init__(self, guilds, **options):
+        super().__init__(**options)
+        self._bench_guilds = guilds
+
+    @property
+    def guilds(self):
+        return self._bench_guilds
+
+
+def make_tiny_model(path, layers, embd, heads, positions):
+    """
+    偽の会話に出てくる文字だけを語彙にした文字単位のトークナイザーと、ランダムに初期化した小さなGPT-2を保存する
+    AILearnerはこれを models/wikipedia_base として見つけ、ベースモデルに使う
+    """
+    chars = sorted(set("".join(WORDS)) | set("!-AIKUNRun ？?。、"))
+    vocab = {"[PAD]": 0, "</s>": 1, "<unk>": 2}
+    for char in chars:
+        vocab[char] = len(vocab)
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", eos_token="</s>", unk_token="<unk>")
+    config = GPT2Config(
+        vocab_size=len(vocab), n_positions=positions, n_embd=embd, n_layer=layers, n_head=heads,
+        bos_token_id=1, eos_token_id=1, pad_token_id=0,
+    )
+    model = TFGPT2LMHeadModel(config)
+    model(model.dummy_inputs)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+
+@contextlib.contextmanager
+def profiled(stage, mode, directory):
+    """
+    modeが "cprofile" / "tf" の場合、このブロックの処理をプロファイルしてdirectoryに保存する
+    """
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(directory, f"{stage}.prof")
+            profiler.dump_stats(path)
+            print(f"  cProfile saved to {path}; top functions by cumulative time:")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(10)
+    elif mode == "tf":
+        logdir = os.path.join(directory, stage)
+        tf.profiler.experimental.start(logdir)
+        try:
+            yield
+        finally:
+            tf.profiler.experimental.stop()
+            print(f"  TensorFlow profile saved to {logdir}")
+    else:
+        yield
+
+
+def percentile_ms(values, pct):
+    return float(np.percentile(values, pct) * 1000) if values else None
+
+
+async def bench_collect(guilds):
+    bot = BenchBot(guilds, intents=discord.Intents.default(), serve=False)
+    messages = sum(len(channel.messages) for guild in guilds for channel in guild.text_channels)
+    start = time.perf_counter()
+    await bot.research_and_collect("data")
+    elapsed = time.perf_counter() - start
+    await bot.close()
+    saved = sum(1 for path in corpus_files("data") for _ in iter_records(path))
+    return {"messages": messages, "saved": saved, "seconds": elapsed, "messages_per_sec": messages / elapsed}
+
+
+def bench_tokenize(learner, processes):
+    files = corpus_files("data")
+    cache = TokenCache(os.path.join("data", ".token_cache"), learner.tokenizer)
+    start = time.perf_counter()
+    cache.update(files, processes=processes)
+    elapsed = time.perf_counter() - start
+    tokens = cache.num_tokens(files)
+    return {"files": len(files), "tokens": tokens, "seconds": elapsed, "tokens_per_sec": tokens / elapsed}
+
+
+def bench_train(learner, epochs, batch_size):
+    history = []
+
+    class Recorder(tf.keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            history.append(dict(logs or {}))
+
+    start = time.perf_counter()
+    version = learner.fine_tune("data", epochs=epochs, batch_size=batch_size, callbacks=[Recorder()])
+    elapsed = time.perf_counter() - start
+    # 1エポック目はグラフのトレースを含むので、最後のエポックを定常状態の値とする
+    last = history[-1]
+    return {
+        "version": version,
+        "epochs": epochs,
+        "steps_per_epoch": last["steps"],
+        "steps_per_sec": last["steps"] / last["epoch_time"],
+        "tokens_per_sec": last["tokens_per_sec"],
+        "first_epoch_seconds": history[0]["epoch_time"],
+        "seconds": elapsed,
+    }
+
+
+def bench_predict(learner, prompts, max_length):
+    start = time.perf_counter()
+    learner.load_model()
+    load_seconds = time.perf_counter() - start
+
+    latencies = []
+    start = time.perf_counter()
+    for prompt in prompts:
+        begin = time.perf_counter()
+        learner.predict(prompt, max_length=max_length)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(prompts),
+        "load_seconds": load_seconds,
+        "latency_p50_ms": percentile_ms(latencies, 50),
+        "latency_p95_ms": percentile_ms(latencies, 95),
+        "replies_per_sec": len(prompts) / elapsed,
+    }
+
+
+async def bench_on_message(learner, guilds, prompts):
+    """
+    チャンネルごとに1件ずつ、全チャンネル同時にメッセージを送り、on_messageが応答を送るまでの時間を計測する
+    """
+    bot = BenchBot(guilds, intents=discord.Intents.default(), serve=True)
+    bot._learner = learner
+    channels = [channel for guild in guilds for channel in guild.text_channels]
+    bot.is_ai_running = True
+    bot.ai_enabled_channels = {channel.id for channel in channels}
+    for channel in channels:
+        channel.sent.clear()
+
+    latencies = []
+
+    async def drive(channel, channel_prompts):
+        for i, prompt in enumerate(channel_prompts):
+            message = FakeMessage(channel.messages[-1].id + i + 1, prompt, FakeAuthor(7), channel, channel.guild)
+            begin = time.perf_counter()
+            await bot.on_message(message)
+            latencies.append(time.perf_counter() - begin)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(drive(channel, prompts[i::len(channels)]) for i, channel in enumerate(channels)))
+    elapsed = time.perf_counter() - start
+    replies = sum(len(channel.sent) for channel in channels)
+    snapshot = bot.inference.snapshot()
+    await bot.close()
+    return {
+        "requests": len(prompts),
+        "replies": replies,
+        "latency_p50_ms": percentile_ms(latencies, 50),
+        "latency_p95_ms": percentile_ms(latencies, 95),
+        "replies_per_sec": replies / elapsed,
+        "batch_size_avg": snapshot["batch_size_avg"],
+    }
+
+
+def compare(results, baseline):
+    """
+    以前の結果と数値を比べて表示する
+    """
+    print(f"\n{'stage':>10} {'metric':>20} {'baseline':>12} {'current':>12} {'change':>8}")
+    for stage, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(stage, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or isinstance(value, bool):
+                continue
+            change = f"{(value - previous) / previous * 100:+.1f}%" if previous else "-"
+            print(f"{stage:>10} {metric:>20} {previous:>12.2f} {value:>12.2f} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="bench_pipeline.json", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", default=None, help="比較する以前の結果のJSONファイル")
+    parser.add_argument("--workdir", default=None, help="作業ディレクトリ（省略時は一時ディレクトリを作り、終了時に削除する）")
+    parser.add_argument("--profile", choices=("none", "cprofile", "tf"), default="none")
+    parser.add_argument("--profile-dir", default="bench_profile")
+    parser.add_argument("--guilds", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=4, help="ギルドごとのチャンネル数")
+    parser.add_argument("--messages", type=int, default=2000, help="チャンネルごとのメッセージ数")
+    parser.add_argument("--processes", type=int, default=None, help="トークン化のプロセス数")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=40, help="predict / on_message で生成する応答数")
+    parser.add_argument("--max-length", type=int, default=32)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--embd", type=int, default=128)
+    parser.add_argument("--heads", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # GPUがあっても CPU 上で計測する
+    tf.config.set_visible_devices([], "GPU")
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+    profile_dir = os.path.abspath(args.profile_dir)
+    if args.profile != "none":
+        os.makedirs(profile_dir, exist_ok=True)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ai-kun-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    previous_cwd = os.getcwd()
+    # ボットと学習は data/ と models/ を相対パスで使うので、作業ディレクトリで実行する
+    os.chdir(workdir)
+    try:
+        make_tiny_model(BASE_MODEL_DIR, args.layers, args.embd, args.heads, positions=256)
+        guilds = make_guilds(args.guilds, args.channels, args.messages, seed=args.seed)
+        rng = random.Random(args.seed)
+        prompts = [random_sentence(rng) for _ in range(args.requests)]
+
+        results = {}
+        print("== collect ==")
+        with profiled("collect", args.profile, profile_dir):
+            results["collect"] = asyncio.run(bench_collect(guilds))
+        learner = AILearner()
+        print("== tokenize ==")
+        with profiled("tokenize", args.profile, profile_dir):
+            results["tokenize"] = bench_tokenize(learner, args.processes)
+        print("== train ==")
+        with profiled("train", args.profile, profile_dir):
+            results["train"] = bench_train(learner, args.epochs, args.batch_size)
+        print("== predict ==")
+        with profiled("predict", args.profile, profile_dir):
+            results["predict"] = bench_predict(learner, prompts, args.max_length)
+        print("== on_message ==")
+        with profiled("on_message", args.profile, profile_dir):
+            results["on_message"] = asyncio.run(bench_on_message(learner, guilds, prompts))
+    finally:
+        os.chdir(previous_cwd)
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    for stage, metrics in results.items():
+        print(f"{stage}: " + ", ".join(
+            f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}" for name, value in metrics.items()
+        ))
+    if baseline is not None:
+        compare(results, baseline)
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "tensorflow": tf.__version__,
+            "transformers": transformers.__version__,
+            "ai_kun_env": {name: value for name, value in os.environ.items() if name.startswith("AI_KUN_")},
+        },
+        "config": vars(args),
+        "stages": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+各コマンドが処理を始められるようになるまでの起動時間を、以前の版（--baseline-ref）と現在の作業ツリーで計測する
+
+    python benchmarks/bench_startup.py --baseline-ref 6d45b58~1 [--repeat 3]
+
+以前の版は git archive で src/ を一時ディレクトリに取り出し、両方の版で同じ起動処理（main の読み込み・依存関係チェック・
+ボットまたは学習器の作成）を実行する。models/ と requirements.txt は --cwd のものを共通で使う
+"""
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# 各コマンドが Discord への接続・学習を始める直前までの処理（main.py の各コマンドと同じ順序）
+# 以前の版の AIKunBot は作成時にループのタスクを開始するので、イベントループの中で作成する
+BOT = (
+    "import asyncio, discord\n"
+    "from bot import AIKunBot\n"
+    "intents = discord.Intents.default(); intents.messages = intents.guilds = intents.message_content = True\n"
+    "async def start():\n"
+    "    AIKunBot(intents=intents)\n"
+    "asyncio.run(start())\n"
+)
+COMMANDS = {
+    "run": "import main; main.check_and_install_dependencies()\n" + BOT,
+    "research": "import main; main.check_and_install_dependencies()\n" + BOT,
+    # 学習はすぐにトークナイザーを使うので、その読み込みまでを含める
+    "learning": "import main; main.check_and_install_dependencies()\n"
+                "from learning import AILearner; AILearner().tokenizer\n",
+}
+
+
+def export_tree(ref, directory):
+    """
+    ref の版の src/ を directory に取り出し、そのパスを返す
+    """
+    archive = subprocess.run(["git", "-C", ROOT, "archive", "--format=tar", ref, "src"],
+                             check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, "src")
+
+
+def measure(src_dir, code, repeat, cwd):
+    prelude = f"import sys; sys.path.insert(0, {src_dir!r})\n"
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", prelude + code], cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline-ref", required=True, help="比較する以前の版（gitのコミットやタグ）")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cwd", default=ROOT, help="計測時の作業ディレクトリ（requirements.txt と models/ がある場所）")
+    args = parser.parse_args()
+
+    current_src = os.path.join(ROOT, "src")
+    with tempfile.TemporaryDirectory() as directory:
+        baseline_src = export_tree(args.baseline_ref, directory)
+        # 依存関係チェックの結果をキャッシュしておく
+        measure(current_src, "import main; main.check_and_install_dependencies()\n", 1, args.cwd)
+
+        print(f"{'command':>10} {'baseline (s)':>12} {'current (s)':>12} {'speedup':>8}")
+        for command, code in COMMANDS.items():
+            baseline = measure(baseline_src, code, args.repeat, args.cwd)
+            current = measure(current_src, code, args.repeat, args.cwd)
+            print(f"{command:>10} {baseline:>12.2f} {current:>12.2f} {baseline / current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+ベンチマーク用の、Discordに接続しないギルド・チャンネル・メッセージの代わり
+
+research_and_collect が使う guild.text_channels / channel.history() と、
+on_message が使う message.channel.typing() / channel.send() / message.edit() だけを実装している。
+"""
+import asyncio
+import contextlib
+import datetime
+import random
+
+import discord
+
+# 会話らしい文を作るための語句
+WORDS = [
+    "おはよう", "こんにちは", "今日", "昨日", "明日", "ゲーム", "楽しかった", "ご飯", "何", "食べた",
+    "週末", "晴れ", "雨", "予定", "どうする", "サーバー", "ルール", "教えて", "本", "おすすめ",
+    "眠い", "仕事", "学校", "終わった", "映画", "見た", "また", "あとで", "よろしく", "ありがとう",
+]
+
+
+class FakeAuthor:
+    def __init__(self, author_id, bot=False):
+        self.id = author_id
+        self.bot = bot
+
+
+class FakeMessageType:
+    def __init__(self, name="default"):
+        self.name = name
+
+
+class FakeReference:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel=None, guild=None, created_at=None, reply_to=None):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.created_at = created_at or discord.utils.snowflake_time(message_id)
+        self.type = FakeMessageType()
+        self.reference = FakeReference(reply_to) if reply_to is not None else None
+
+    async def edit(self, content):
+        self.content = content
+        return self
+
+
+class FakePermissions:
+    read_messages = True
+
+
+class FakeChannel:
+    """
+    メッセージ履歴を持ち、送信されたメッセージを記録するチャンネル
+    """
+    def __init__(self, channel_id, guild, messages=None):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.guild = guild
+        self.messages = messages or []
+        self.sent = []
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    async def history(self, limit=None, after=None, oldest_first=None):
+        if isinstance(after, datetime.datetime):
+            after = discord.utils.time_snowflake(after)
+        elif after is not None:
+            after = after.id
+        count = 0
+        for message in self.messages:
+            if after is not None and message.id <= after:
+                continue
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            # 実際のAPIのように、メッセージごとにイベントループへ制御を返す
+            await asyncio.sleep(0)
+            yield message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def send(self, content):
+        message = FakeMessage(discord.utils.time_snowflake(discord.utils.utcnow()), content, FakeAuthor(0, bot=True), self, self.guild)
+        self.sent.append((asyncio.get_running_loop().time(), content))
+        return message
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.me = None
+        self.text_channels = []
+
+
+def random_sentence(rng):
+    return "".join(rng.choice(WORDS) for _ in range(rng.randint(2, 8)))
+
+
+def make_guilds(num_guilds=2, channels_per_guild=4, messages_per_channel=1000, seed=0):
+    """
+    ランダムな会話履歴を持つギルドのリストを作る。同じseedなら同じ履歴になる
+    一部のメッセージはボットの発言・コマンド・返信にして、収集時の除外処理も通るようにする
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    guilds = []
+    for g in range(num_guilds):
+        guild = FakeGuild(100 + g)
+        for c in range(channels_per_guild):
+            channel = FakeChannel(1000 + g * channels_per_guild + c, guild)
+            for i in range(messages_per_channel):
+                created_at = start + datetime.timedelta(minutes=i)
+                message_id = discord.utils.time_snowflake(created_at) + channel.id
+                roll = rng.random()
+                if roll < 0.05:
+                    message = FakeMessage(message_id, "!AI-KUN Run", FakeAuthor(1), channel, guild, created_at)
+                elif roll < 0.10:
+                    message = FakeMessage(message_id, random_sentence(rng), FakeAuthor(0, bot=True), channel, guild, created_at)
+                else:
+                    reply_to = channel.messages[-1].id if channel.messages and roll < 0.3 else None
+                    message = FakeMessage(message_id, random_sentence(rng), FakeAuthor(rng.randint(1, 20)), channel, guild,
+                                          created_at, reply_to)
+                channel.messages.append(message)
+            guild.text_channels.append(channel)
+        guilds.append(guild)
+    return guilds
@@ -0,0 +1,192 @@
+import datetime
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import tensorflow as tf
+from transformers.modeling_tf_utils import TFConv1D
+
+# 学習データのファイル名（{guild.id}_{channel.id}.txt / .jsonl.gz）からギルドIDを取り出す
+_GUILD_FILE = re.compile(r"^(\d+)_\d+\.")
+
+
+def guild_of(path):
+    """
+    学習データのファイル名からギルドIDを返す。ギルドのわからないファイルはNoneを返す
+    """
+    match = _GUILD_FILE.match(os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+class LoRAConv1D(TFConv1D):
+    """
+    元の出力に低ランクの差分 x A B * scale を加えるTFConv1D
+    LoRA.__init__で既存の層のクラスを差し替えて使うので、元の重みはそのまま共有される
+    """
+    def call(self, x):
+        output = super().call(x)
+        delta = tf.matmul(tf.reshape(x, [-1, self.nx]), tf.cast(self.lora_a, x.dtype))
+        delta = tf.matmul(delta, tf.cast(self.lora_b, x.dtype)) * self.lora_scale
+        return output + tf.reshape(delta, tf.shape(output))
+
+
+def _target_layers(model):
+    """
+    GPT-2の各ブロックのTFConv1D（attn.c_attn, attn.c_proj, mlp.c_fc, mlp.c_proj）を名前と組にして返す
+    """
+    for i, block in enumerate(model.transformer.h):
+        for module_name, module in (("attn", block.attn), ("mlp", block.mlp)):
+            for layer_name in ("c_attn", "c_proj", "c_fc"):
+                layer = getattr(module, layer_name, None)
+                if isinstance(layer, TFConv1D):
+                    yield f"h.{i}.{module_name}.{layer_name}", layer
+
+
+class LoRA:
+    """
+    モデルのTFConv1Dに低ランクのアダプター（A: nx×rank, B: rank×nf）を付け、その重みの読み書きを行う
+    Bは0で初期化するので、付けた直後とdisable()の後の出力は元のモデルと同じになる
+    """
+    def __init__(self, model, rank=8, alpha=16.0):
+        self.rank = rank
+        self.alpha = alpha
+        self.layers = dict(_target_layers(model))
+        for layer in self.layers.values():
+            layer.lora_a = tf.Variable(tf.zeros((layer.nx, rank)), trainable=True, name="lora_a")
+            layer.lora_b = tf.Variable(tf.zeros((rank, layer.nf)), trainable=True, name="lora_b")
+            layer.lora_scale = alpha / rank
+            layer.__class__ = LoRAConv1D
+        self.reset()
+
+    @property
+    def variables(self):
+        return [v for layer in self.layers.values() for v in (layer.lora_a, layer.lora_b)]
+
+    def reset(self, seed=None):
+        """
+        学習を始めるために、Aを小さな乱数、Bを0で初期化する
+        """
+        generator = tf.random.Generator.from_seed(seed) if seed is not None else tf.random.Generator.from_non_deterministic_state()
+        for layer in self.layers.values():
+            layer.lora_a.assign(generator.normal(layer.lora_a.shape, stddev=1.0 / layer.nx ** 0.5))
+            layer.lora_b.assign(tf.zeros_like(layer.lora_b))
+
+    def disable(self):
+        """
+        差分を0にして、元のモデルと同じ出力に戻す
+        """
+        for layer in self.layers.values():
+            layer.lora_b.assign(tf.zeros_like(layer.lora_b))
+
+    def get_weights(self):
+        weights = {}
+        for name, layer in self.layers.items():
+            weights[name + "/a"] = layer.lora_a.numpy()
+            weights[name + "/b"] = layer.lora_b.numpy()
+        return weights
+
+    def set_weights(self, weights):
+        for name, layer in self.layers.items():
+            layer.lora_a.assign(weights[name + "/a"])
+            layer.lora_b.assign(weights[name + "/b"])
+
+
+class AdapterStore:
+    """
+    ギルドごとのアダプターを models/adapters/<ギルドID>/ に保存する
+    adapter.npz に重みを、adapter.json にベースモデルのバージョン・ランク・学習したメッセージ数を保存する
+    """
+    WEIGHTS_FILE = "adapter.npz"
+    META_FILE = "adapter.json"
+
+    def __init__(self, adapter_dir="models/adapters"):
+        self.adapter_dir = adapter_dir
+
+    def path(self, guild_id):
+        return os.path.join(self.adapter_dir, str(guild_id))
+
+    def guilds(self):
+        if not os.path.isdir(self.adapter_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(self.adapter_dir) if name.isdigit())
+
+    def meta(self, guild_id):
+        try:
+            with open(os.path.join(self.path(guild_id), self.META_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, guild_id, weights, meta):
+        """
+        アダプターを保存する。書きかけのものを読み込まないよう、一時ディレクトリに書いてから置き換える
+        """
+        path = self.path(guild_id)
+        tmp_path, old_path = path + ".tmp", path + ".old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.savez(os.path.join(tmp_path, self.WEIGHTS_FILE), **weights)
+        meta = dict(meta, trained_at=datetime.datetime.now().isoformat(timespec="seconds"))
+        with open(os.path.join(tmp_path, self.META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+        if os.path.exists(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def load_all(self, base_version, rank):
+        """
+        base_versionのモデルから学習した、ランクがrankのアダプターを {ギルドID: (学習日時, 重み)} で返す
+        """
+        adapters = {}
+        for guild_id in self.guilds():
+            meta = self.meta(guild_id)
+            if meta is None or meta.get("base_version") != base_version or meta.get("rank") != rank:
+                continue
+            with np.load(os.path.join(self.path(guild_id), self.WEIGHTS_FILE)) as data:
+                adapters[guild_id] = (meta["trained_at"], {name: data[name] for name in data.files})
+        return adapters
+
+
+class AdapterSet:
+    """
+    応答生成用のモデルに付けたLoRAと、読み込んだギルドごとのアダプター
+    refresh()は読み込み用のスレッドから、activate()は推論スレッドからだけ呼ぶ
+    """
+    def __init__(self, lora, store, base_version):
+        self.lora = lora
+        self.store = store
+        self.base_version = base_version
+        self.adapters = {}
+        self._active = None
+
+    def refresh(self):
+        """
+        保存されているアダプターを読み直し、読み込んだ数を返す（辞書ごと差し替える）
+        """
+        self.adapters = self.store.load_all(self.base_version, self.lora.rank)
+        return len(self.adapters)
+
+    def key(self, guild_id):
+        """
+        guild_idのアダプターを識別する文字列を返す。アダプターがなければNoneを返す
+        """
+        entry = self.adapters.get(guild_id)
+        return f"{guild_id}@{entry[0]}" if entry is not None else None
+
+    def activate(self, guild_id):
+        """
+        guild_idのアダプターを有効にし（なければ元のモデルに戻し）、そのキーを返す
+        """
+        entry = self.adapters.get(guild_id)
+        key = f"{guild_id}@{entry[0]}" if entry is not None else None
+        if key != self._active:
+            if entry is None:
+                self.lora.disable()
+            else:
+                self.lora.set_weights(entry[1])
+            self._active = key
+        return key
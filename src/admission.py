@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    rate（件/秒）でトークンが補充され、最大burst個まで貯まるトークンバケット
+    rateが0以下の場合は制限しない
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+
+    def try_take(self):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdmissionController:
+    """
+    応答生成の前に置く受け付け制御
+    チャンネルごとと全体のトークンバケットで応答数を制限し、短い間隔で続いたメッセージは1つのプロンプトにまとめる
+    まとめるために待つのは、そのチャンネルで応答を生成中か、直前のメッセージからcoalesce_window秒以内の場合だけで、
+    それ以外のメッセージはすぐに受け付ける
+    """
+    def __init__(self, channel_rate=0.1, channel_burst=3, global_rate=1.0, global_burst=10, coalesce_window=1.5):
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.coalesce_window = coalesce_window
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        # チャンネルごとに設定された制限（rate, burst）。設定のないチャンネルは既定値を使う
+        self.channel_limits = {}
+        self._buckets = {}
+        self._pending = {}
+        # チャンネルごとの、受け付けてまだ応答し終えていないプロンプトの数と、最後にメッセージが届いた時刻
+        self._active = {}
+        self._last_arrival = {}
+        self.admitted = 0
+        self.rate_limited = 0
+        self.coalesced = 0
+
+    def set_channel_limit(self, channel_id, rate, burst):
+        self.channel_limits[channel_id] = (rate, burst)
+        self._buckets.pop(channel_id, None)
+
+    def set_global_limit(self, rate, burst):
+        self.global_bucket = TokenBucket(rate, burst)
+
+    def channel_limit(self, channel_id):
+        return self.channel_limits.get(channel_id, (self.channel_rate, self.channel_burst))
+
+    def _bucket(self, channel_id):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._buckets[channel_id] = TokenBucket(*self.channel_limit(channel_id))
+        return bucket
+
+    async def admit(self, channel_id, text):
+        """
+        メッセージを受け付け、応答を生成すべきプロンプトを返す（応答し終えたらfinishedを呼ぶ）
+        まとめ待ちの間に同じチャンネルに届いたメッセージは、最初のメッセージのプロンプトに追加してNoneを返す
+        制限を超えたメッセージもNoneを返す
+        """
+        now = time.monotonic()
+        previous = self._last_arrival.get(channel_id)
+        self._last_arrival[channel_id] = now
+        pending = self._pending.get(channel_id)
+        if pending is not None:
+            pending.append(text)
+            self.coalesced += 1
+            return None
+
+        # チャンネルの制限を先に確認し、全体のトークンを無駄に消費しない
+        if not self._bucket(channel_id).try_take() or not self.global_bucket.try_take():
+            self.rate_limited += 1
+            return None
+
+        pending = [text]
+        burst = self._active.get(channel_id, 0) > 0 or (previous is not None and now - previous < self.coalesce_window)
+        if burst and self.coalesce_window > 0:
+            self._pending[channel_id] = pending
+            try:
+                await asyncio.sleep(self.coalesce_window)
+            finally:
+                del self._pending[channel_id]
+        self.admitted += 1
+        self._active[channel_id] = self._active.get(channel_id, 0) + 1
+        return "\n".join(pending)
+
+    def finished(self, channel_id):
+        """
+        admitが返したプロンプトへの応答が終わった（失敗した場合も含む）ことを知らせる
+        """
+        count = self._active.get(channel_id, 0) - 1
+        if count > 0:
+            self._active[channel_id] = count
+        else:
+            self._active.pop(channel_id, None)
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "coalesced": self.coalesced,
+            "pending_channels": len(self._pending),
+        }
@@ -0,0 +1,279 @@
+import abc
+import math
+import os
+
+import numpy as np
+import tensorflow as tf
+from transformers.generation import TFLogitsProcessor, TFLogitsProcessorList
+
+
+def greedy_next_token(logits, sequence, no_repeat_ngram_size=2):
+    """
+    貪欲法で次のトークンを選ぶ。sequence中にすでに出現したn-gramを繰り返すトークンは除外する
+    """
+    n = no_repeat_ngram_size
+    if n and len(sequence) >= n - 1:
+        prefix = tuple(sequence[len(sequence) - (n - 1):]) if n > 1 else ()
+        banned = [
+            sequence[i + n - 1]
+            for i in range(len(sequence) - n + 1)
+            if tuple(sequence[i:i + n - 1]) == prefix
+        ]
+        if banned:
+            logits = logits.copy()
+            logits[banned] = -np.inf
+    return int(np.argmax(logits))
+
+
+class EagerBackend:
+    """
+    TFGPT2LMHeadModel.generate をそのまま使うバックエンド
+    """
+    name = "eager"
+
+    def __init__(self, model, tokenizer, model_path):
+        self.model = model
+        self.model_path = model_path
+        self.pad_token_id = tokenizer.pad_token_id
+        self.eos_token_id = tokenizer.eos_token_id
+
+    def generate(self, input_ids, attention_mask, max_new_tokens):
+        """
+        左パディング済みの (batch, length) の配列を受け取り、生成したトークンを続けた配列を返す
+        """
+        return self.model.generate(
+            input_ids=tf.constant(input_ids, dtype=tf.int32),
+            attention_mask=tf.constant(attention_mask, dtype=tf.int32),
+            max_new_tokens=max_new_tokens,
+            num_return_sequences=1,
+            no_repeat_ngram_size=2,
+            early_stopping=True,
+            pad_token_id=self.pad_token_id,
+            eos_token_id=self.eos_token_id,
+        ).numpy()
+
+
+class TFNoRepeatBigramLogitsProcessor(TFLogitsProcessor):
+    """
+    XLAでコンパイルできる no_repeat_ngram_size=2 相当の処理
+    transformers標準の処理はXLAに対応していないため、固定長のテンソル演算だけで実装する
+    """
+    def __call__(self, input_ids, scores, cur_len):
+        batch_size = tf.shape(input_ids)[0]
+        length = tf.shape(input_ids)[1]
+        last = tf.gather(input_ids, cur_len - 1, axis=1)
+        previous, following = input_ids[:, :-1], input_ids[:, 1:]
+        # まだ生成されていない位置は比較に含めない
+        valid = tf.range(length - 1) < cur_len - 1
+        match = tf.logical_and(tf.equal(previous, last[:, None]), valid[None, :])
+        rows = tf.broadcast_to(tf.range(batch_size)[:, None], tf.shape(following))
+        indices = tf.stack([rows, following], axis=-1)
+        banned = tf.scatter_nd(indices, tf.cast(match, scores.dtype), tf.shape(scores))
+        return tf.where(banned > 0, tf.cast(float("-inf"), scores.dtype), scores)
+
+
+class TFTokenBudgetLogitsProcessor(TFLogitsProcessor):
+    """
+    生成したトークンがlimit（入力を含む長さ）に達したら、EOSだけを選べるようにする
+    limitは変数なので、生成長を変えてもコンパイルし直さない。全員がEOSを出すとgenerateのループも終わる
+    """
+    def __init__(self, eos_token_id):
+        self.eos_token_id = eos_token_id
+        self.limit = tf.Variable(0, dtype=tf.int32, trainable=False)
+
+    def __call__(self, input_ids, scores, cur_len):
+        vocab_size = tf.shape(scores)[-1]
+        only_eos = tf.where(tf.range(vocab_size) == self.eos_token_id, tf.cast(0.0, scores.dtype), tf.cast(float("-inf"), scores.dtype))
+        return tf.where(cur_len >= self.limit.read_value(), tf.broadcast_to(only_eos[None, :], tf.shape(scores)), scores)
+
+
+class XLABackend(EagerBackend):
+    """
+    XLAでコンパイルした generate を使うバックエンド
+    再コンパイルを避けるため、バッチサイズは2のべき乗に、入力長と生成長はbucketの倍数にそろえる
+    実際の生成長を超えた分は、コンパイル済みのループの中でEOSにして打ち切る
+    """
+    name = "xla"
+
+    def __init__(self, model, tokenizer, model_path, bucket=16):
+        super().__init__(model, tokenizer, model_path)
+        self.bucket = bucket
+        self._generate = tf.function(model.generate, jit_compile=True)
+        processors = [TFNoRepeatBigramLogitsProcessor()]
+        self._budget = None
+        if self.eos_token_id is not None:
+            self._budget = TFTokenBudgetLogitsProcessor(self.eos_token_id)
+            processors.append(self._budget)
+        self._processors = TFLogitsProcessorList(processors)
+
+    def generate(self, input_ids, attention_mask, max_new_tokens):
+        batch_size, length = input_ids.shape
+        padded_batch = 1 << max(0, math.ceil(math.log2(batch_size)))
+        padded_length = math.ceil(length / self.bucket) * self.bucket
+        new_tokens = math.ceil(max_new_tokens / self.bucket) * self.bucket
+
+        ids = np.full((padded_batch, padded_length), self.pad_token_id, dtype=np.int32)
+        mask = np.zeros((padded_batch, padded_length), dtype=np.int32)
+        ids[:batch_size, padded_length - length:] = input_ids
+        mask[:batch_size, padded_length - length:] = attention_mask
+        # 埋め草の行も、すべてマスクされないように最後の1トークンだけ有効にしておく
+        mask[batch_size:, -1] = 1
+        if self._budget is not None:
+            self._budget.limit.assign(padded_length + max_new_tokens)
+
+        output = self._generate(
+            input_ids=tf.constant(ids),
+            attention_mask=tf.constant(mask),
+            max_new_tokens=new_tokens,
+            logits_processor=self._processors,
+            pad_token_id=self.pad_token_id,
+            eos_token_id=self.eos_token_id,
+        ).numpy()
+        return output[:batch_size, padded_length - length:padded_length + max_new_tokens]
+
+
+class _WindowedGreedyBackend(EagerBackend, metaclass=abc.ABCMeta):
+    """
+    固定長の入力（window）で最後の位置のロジットを返すモデルを使い、1トークンずつ貪欲に生成するバックエンドの共通部分
+    入力は右詰めにし、windowを超える部分は古い方から切り捨てる
+    """
+    def __init__(self, model, tokenizer, model_path, window=64):
+        super().__init__(model, tokenizer, model_path)
+        self.window = min(window, model.config.n_positions)
+
+    def _forward_signature(self):
+        window = self.window
+        model = self.model
+        spec = [
+            tf.TensorSpec([1, window], tf.int32, name="input_ids"),
+            tf.TensorSpec([1, window], tf.int32, name="attention_mask"),
+            tf.TensorSpec([1, window], tf.int32, name="position_ids"),
+        ]
+
+        @tf.function(input_signature=spec)
+        def forward(input_ids, attention_mask, position_ids):
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids)
+            return {"logits": outputs.logits[:, -1, :]}
+
+        return forward, spec
+
+    @abc.abstractmethod
+    def _last_logits(self, input_ids, attention_mask, position_ids):
+        """
+        (1, window) の入力に対する、最後の位置のロジット（語彙数の1次元配列）を返す
+        """
+
+    def generate(self, input_ids, attention_mask, max_new_tokens):
+        rows = []
+        for ids, mask in zip(input_ids, attention_mask):
+            sequence = [int(token) for token, keep in zip(ids, mask) if keep]
+            generated = []
+            for _ in range(max_new_tokens):
+                window = (sequence + generated)[-self.window:]
+                x = np.full((1, self.window), self.pad_token_id, dtype=np.int32)
+                m = np.zeros((1, self.window), dtype=np.int32)
+                p = np.zeros((1, self.window), dtype=np.int32)
+                x[0, self.window - len(window):] = window
+                m[0, self.window - len(window):] = 1
+                p[0, self.window - len(window):] = np.arange(len(window))
+                logits = self._last_logits(x, m, p)
+                next_id = greedy_next_token(logits, sequence + generated)
+                if next_id == self.eos_token_id:
+                    break
+                generated.append(next_id)
+            padding = [self.pad_token_id] * (max_new_tokens - len(generated))
+            rows.append(list(ids) + generated + padding)
+        return np.array(rows, dtype=np.int32)
+
+
+class TFLiteBackend(_WindowedGreedyBackend):
+    """
+    学習後量子化（int8のダイナミックレンジ量子化またはfloat16）したTFLiteモデルを使うバックエンド
+    変換結果はモデルのディレクトリに保存し、次回からはそれを読み込む
+    """
+    name = "tflite"
+
+    def __init__(self, model, tokenizer, model_path, window=64, quantization="int8", threads=None):
+        super().__init__(model, tokenizer, model_path, window)
+        path = os.path.join(model_path, f"model_{quantization}_{self.window}.tflite")
+        if not os.path.exists(path):
+            print(f"Exporting TFLite model ({quantization}) to {path}...")
+            forward, _ = self._forward_signature()
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([forward.get_concrete_function()], model)
+            if quantization == "int8":
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            elif quantization == "float16":
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                converter.target_spec.supported_types = [tf.float16]
+            with open(path + ".tmp", "wb") as f:
+                f.write(converter.convert())
+            os.replace(path + ".tmp", path)
+
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self._runner = self.interpreter.get_signature_runner()
+
+    def _last_logits(self, input_ids, attention_mask, position_ids):
+        outputs = self._runner(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids)
+        return outputs["logits"][0]
+
+
+class ONNXBackend(_WindowedGreedyBackend):
+    """
+    ONNXに変換したモデルをonnxruntimeで実行するバックエンド（tf2onnx と onnxruntime が必要）
+    """
+    name = "onnx"
+
+    def __init__(self, model, tokenizer, model_path, window=64, threads=None):
+        super().__init__(model, tokenizer, model_path, window)
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("onnxruntime is not installed. Please install it using: pip install onnxruntime tf2onnx")
+
+        path = os.path.join(model_path, f"model_{self.window}.onnx")
+        if not os.path.exists(path):
+            try:
+                import tf2onnx
+            except ImportError:
+                raise RuntimeError("tf2onnx is not installed. Please install it using: pip install tf2onnx")
+            print(f"Exporting ONNX model to {path}...")
+            forward, spec = self._forward_signature()
+            tf2onnx.convert.from_function(forward, input_signature=spec, opset=17, output_path=path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def _last_logits(self, input_ids, attention_mask, position_ids):
+        outputs = self.session.run(None, {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+        })
+        return outputs[0][0]
+
+
+BACKENDS = {
+    EagerBackend.name: EagerBackend,
+    XLABackend.name: XLABackend,
+    TFLiteBackend.name: TFLiteBackend,
+    ONNXBackend.name: ONNXBackend,
+}
+
+
+def create_backend(name, model, tokenizer, model_path, **options):
+    """
+    名前で指定されたバックエンドを作成する。作成できない場合は eager にフォールバックする
+    """
+    backend_class = BACKENDS.get(name)
+    if backend_class is None:
+        print(f"[WARNING] Unknown inference backend {name!r}. Available: {', '.join(BACKENDS)}. Using eager.")
+        return EagerBackend(model, tokenizer, model_path)
+    try:
+        return backend_class(model, tokenizer, model_path, **options)
+    except Exception as e:
+        print(f"[WARNING] Failed to initialize the {name} backend: {e}. Using eager.")
+        return EagerBackend(model, tokenizer, model_path)
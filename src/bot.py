@@ -1,19 +1,184 @@
 import discord
 import os
-from learning import AILearner
+from admission import AdmissionController
+from inference import InferenceWorker, InferenceQueueFull, InferenceDeadlineExceeded
+from training_process import TrainingProcess
+from state_store import StateStore
+from config import env_bool, env_int, env_float, env_str
+from corpus import CORPUS_SUFFIX, CorpusWriter, last_record_id, message_record, should_collect
+from metrics import METRICS, MetricsServer, monitor_event_loop, process_memory_bytes
 from discord.ext import tasks
+import asyncio
 import datetime
+import json
+import threading
+import time
 
 class AIKunBot(discord.Client):
     """
     Discordボットのメインクラス
     """
-    def __init__(self, **options):
+    def __init__(self, serve=True, **options):
         super().__init__(**options)
-        self.ai_enabled_channels = set()
-        self.is_ai_running = False
-        self.learner = AILearner()
+        # serveが偽の場合（researchコマンド）は応答と週次学習を行わない
+        self.serve = serve
+        # TensorFlowを読み込むAILearnerは、最初に必要になるまで作成しない
+        self._learner = None
+        self.inference = InferenceWorker(
+            lambda: self.learner,
+            max_queue_size=env_int("AI_KUN_INFERENCE_QUEUE_SIZE", 32),
+            timeout=env_float("AI_KUN_INFERENCE_TIMEOUT", 60.0),
+            max_batch_size=env_int("AI_KUN_BATCH_SIZE", 8),
+            batch_window=env_float("AI_KUN_BATCH_WINDOW_MS", 10.0) / 1000,
+            max_queue_wait=env_float("AI_KUN_QUEUE_DEADLINE", 30.0) or None,
+        )
+        # 会話が盛り上がったときに応答が溜まって遅れないよう、応答する数を制限し、続けて届いたメッセージはまとめる
+        self.admission = AdmissionController(
+            channel_rate=env_float("AI_KUN_CHANNEL_RATE_PER_MIN", 6.0) / 60,
+            channel_burst=env_int("AI_KUN_CHANNEL_BURST", 3),
+            global_rate=env_float("AI_KUN_GLOBAL_RATE_PER_MIN", 60.0) / 60,
+            global_burst=env_int("AI_KUN_GLOBAL_BURST", 10),
+            coalesce_window=env_float("AI_KUN_COALESCE_SECONDS", 1.5),
+        )
+        # 稼働状態・有効なチャンネル・設定は保存しておき、再起動後も引き継ぐ
+        self.state = StateStore(env_str("AI_KUN_STATE_PATH", "data/state.sqlite3"))
+        self.ai_enabled_channels = self.state.enabled_channels()
+        self.is_ai_running = self.state.get("ai_running", False)
+        self._restore_settings()
+        # 応答を生成しながらメッセージを編集して表示する。編集の間隔はDiscordのレート制限に収まるようにする
+        self.streaming = env_bool("AI_KUN_STREAMING", False)
+        if self.streaming and env_str("AI_KUN_BACKEND", "eager") != "eager":
+            print("[WARNING] Streaming replies are generated one at a time with the eager model; AI_KUN_BACKEND is not used for them.")
+        self.stream_edit_interval = env_float("AI_KUN_STREAM_EDIT_INTERVAL", 1.0)
+        # チャンネルごとの生成中の応答。新しいメッセージが来たら古い生成を中断する
+        self._generations = {}
+        # モデルの読み込み・差し替えを同時に複数走らせない
+        self.model_lock = asyncio.Lock()
+        # 週次学習は別プロセスで行い、推論と同じCPUを使い切らないようスレッド数を抑える
+        self.trainer = TrainingProcess(
+            threads=env_int("AI_KUN_TRAIN_THREADS", max(1, (os.cpu_count() or 2) // 2)),
+            memory_limit_mb=env_int("AI_KUN_TRAIN_MEMORY_MB", 0) or None,
+        )
+        # 計測値はローカルのHTTPエンドポイントか、定期的に書き出すJSONファイルで確認できる
+        metrics_port = env_int("AI_KUN_METRICS_PORT", 0)
+        self.metrics_server = MetricsServer(port=metrics_port) if metrics_port else None
+        self.metrics_dump_path = env_str("AI_KUN_METRICS_DUMP_PATH", "")
+        self.metrics_dump_task.change_interval(seconds=env_float("AI_KUN_METRICS_DUMP_INTERVAL", 60.0))
+        self._loop_monitor = None
+        METRICS.collector("bot", self.collect_metrics)
+
+    @property
+    def learner(self):
+        """
+        AILearnerを返す（初回アクセス時に作成する）
+        """
+        if self._learner is None:
+            from learning import AILearner
+            self._learner = AILearner()
+        return self._learner
+
+    async def ensure_learner(self):
+        """
+        イベントループを止めないよう、AILearnerの作成（TensorFlowの読み込み）を別スレッドで行う
+        """
+        if self._learner is None:
+            await asyncio.to_thread(lambda: self.learner)
+        return self._learner
+
+    def _restore_settings(self):
+        """
+        保存されている応答数の制限などの設定を反映する
+        """
+        global_limit = self.state.get("global_limit")
+        if global_limit is not None:
+            self.admission.set_global_limit(*global_limit)
+        self.admission.coalesce_window = self.state.get("coalesce_window", self.admission.coalesce_window)
+        self.inference.max_queue_wait = self.state.get("queue_deadline", self.inference.max_queue_wait)
+        for channel_id, settings in self.state.channel_settings().items():
+            if "rate" in settings:
+                self.admission.set_channel_limit(channel_id, settings["rate"], settings["burst"])
+
+    def set_running(self, running):
+        self.is_ai_running = running
+        self.state.set("ai_running", running)
+
+    def set_channel_enabled(self, channel_id, enabled):
+        if enabled:
+            self.ai_enabled_channels.add(channel_id)
+        else:
+            self.ai_enabled_channels.discard(channel_id)
+        self.state.set_channel_enabled(channel_id, enabled)
+
+    async def setup_hook(self):
+        """
+        イベントループ開始後、ログイン前に呼び出される
+        """
+        self.state_flush_task.start()
+        if not self.serve:
+            return
+        self._loop_monitor = asyncio.create_task(monitor_event_loop())
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                print(f"[WARNING] Could not start the metrics endpoint: {e}")
+        if self.metrics_dump_path:
+            self.metrics_dump_task.start()
+        self.inference.start()
         self.weekly_learning_task.start()
+        # 再起動前に稼働していた場合は、モデルを読み込んで応答を再開する
+        if self.is_ai_running and self.ai_enabled_channels:
+            print(f"Resuming AI-KUN in {len(self.ai_enabled_channels)} channel(s).")
+            self._resume_task = asyncio.create_task(self.load_model_in_background())
+
+    async def close(self):
+        self.trainer.terminate()
+        await self.inference.close()
+        self.state_flush_task.cancel()
+        self.metrics_dump_task.cancel()
+        if self._loop_monitor is not None:
+            self._loop_monitor.cancel()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await asyncio.to_thread(self.state.close)
+        await super().close()
+
+    @tasks.loop(seconds=5)
+    async def state_flush_task(self):
+        """
+        変更された状態をまとめて書き込む
+        """
+        await asyncio.to_thread(self.state.flush)
+
+    @tasks.loop(seconds=60)
+    async def metrics_dump_task(self):
+        """
+        計測値をJSONファイルに書き出す（間隔は AI_KUN_METRICS_DUMP_INTERVAL）
+        """
+        try:
+            await asyncio.to_thread(METRICS.dump_json, self.metrics_dump_path)
+        except OSError as e:
+            print(f"[WARNING] Could not write metrics to {self.metrics_dump_path}: {e}")
+
+    def collect_metrics(self):
+        """
+        メトリクスとして出力する推論キュー・受け付け制御・プロセスの状態（METRICSのcollector）
+        """
+        inference = self.inference.snapshot()
+        admission = self.admission.stats()
+        return {
+            "inference_queue_depth": inference["queue_depth"],
+            "inference_requests": {
+                (("outcome", outcome),): inference[outcome]
+                for outcome in ("submitted", "completed", "failed", "rejected", "timed_out", "cancelled", "expired")
+            },
+            "admission_messages": {
+                (("outcome", outcome),): admission[outcome] for outcome in ("admitted", "rate_limited", "coalesced")
+            },
+            "process_resident_memory_bytes": process_memory_bytes(),
+            "ai_running": int(self.is_ai_running),
+            "enabled_channels": len(self.ai_enabled_channels),
+        }
 
     @tasks.loop(hours=24 * 7)  # 7日に1回実行
     async def weekly_learning_task(self):
@@ -26,22 +191,62 @@ class AIKunBot(discord.Client):
             # 1週間前の日時を取得
             one_week_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(weeks=1)
 
-            # 直近1週間のデータを収集
-            weekly_data_dir = "data/weekly"
-            await self.research_and_collect(output_dir=weekly_data_dir, after=one_week_ago)
+            if env_bool("AI_KUN_INCREMENTAL_TRAINING", True):
+                # 前回の収集以降のメッセージを学習データに追記し、現在のモデルから追加学習する
+                # 初めて収集するチャンネルは直近1週間分だけを取得する
+                await self.research_and_collect(output_dir="data", after=one_week_ago, incremental=True)
+                print("Re-training model incrementally with new data...")
+                version = await self.trainer.run(
+                    "data",
+                    epochs=1,
+                    on_progress=self.report_training_progress,
+                    incremental=True,
+                )
+            else:
+                # 直近1週間のデータを収集
+                weekly_data_dir = "data/weekly"
+                await self.research_and_collect(output_dir=weekly_data_dir, after=one_week_ago, incremental=False)
 
-            # 新しいデータでモデルを再学習
-            print("Re-training model with new weekly data...")
-            self.learner.fine_tune(data_path=weekly_data_dir, epochs=1)  # 追加学習は1エポックで十分な場合が多い
+                # 新しいデータでモデルを別プロセスで再学習する（学習中も応答は続ける）
+                print("Re-training model with new weekly data...")
+                version = await self.trainer.run(
+                    weekly_data_dir,
+                    epochs=1,  # 追加学習は1エポックで十分な場合が多い
+                    on_progress=self.report_training_progress,
+                )
+            if version is None:
+                print("Weekly training did not produce a new model. Keeping the current model.")
+                return
 
-            # 新しいモデルを即座に反映させるために再読み込み
+            # 学習が成功した場合だけ、新しいモデルをバックグラウンドで読み込んで差し替える
             print("Reloading the updated model...")
-            self.learner.load_model()
+            await self.load_model_in_background(version)
 
             print("Weekly learning task finished successfully.")
         except Exception as e:
             print(f"An error occurred during weekly learning task: {e}")
 
+    def report_training_progress(self, event):
+        """
+        学習プロセスから届いた進捗を表示する
+        """
+        if event["type"] == "started":
+            print(f"Training process started (PID: {event['pid']}).")
+        elif event["type"] == "epoch":
+            METRICS.observe("training_epoch_seconds", event["epoch_time"])
+            METRICS.set("training_tokens_per_sec", event["tokens_per_sec"])
+            METRICS.set("training_loss", event["loss"])
+            print(
+                f"Training epoch {event['epoch']}/{event['epochs']} finished. loss={event['loss']:.4f} "
+                f"tokens/sec={event['tokens_per_sec']:.0f} time={event['epoch_time']:.1f}s"
+            )
+        elif event["type"] == "done":
+            METRICS.inc("training_runs_total", result="done")
+            METRICS.observe("fine_tune_seconds", event["seconds"], mode=event["mode"])
+            print(f"Training finished. New model version: {event['version']}")
+        elif event["type"] == "error":
+            METRICS.inc("training_runs_total", result="error")
+
     @weekly_learning_task.before_loop
     async def before_weekly_learning_task(self):
         print('Waiting for bot to be ready before starting weekly learning task...')
@@ -58,6 +263,10 @@ class AIKunBot(discord.Client):
         """
         メッセージを受信したときに呼び出される
         """
+        # 収集だけを行うボット（researchコマンド）は応答もコマンドの処理もしない
+        if not self.serve:
+            return
+
         # 自分自身のメッセージは無視する
         if message.author == self.user:
             return
@@ -69,9 +278,78 @@ class AIKunBot(discord.Client):
 
         # AIが稼働中で、対象チャンネルであれば応答する
         if self.is_ai_running and message.channel.id in self.ai_enabled_channels:
-            async with message.channel.typing():
-                response = self.learner.predict(message.content)
-                await message.channel.send(response)
+            # 制限を超えたメッセージと、他のメッセージにまとめられたメッセージには個別に応答しない
+            prompt = await self.admission.admit(message.channel.id, message.content)
+            if prompt is None:
+                return
+            started_at = time.perf_counter()
+            outcome = "replied"
+            try:
+                if self.streaming:
+                    await self.reply_streaming(message.channel, prompt)
+                else:
+                    async with message.channel.typing():
+                        response = await self.inference.submit(
+                            prompt, channel_id=message.channel.id, guild_id=message.guild.id if message.guild else None
+                        )
+                        with METRICS.timer("reply_stage_seconds", stage="send"):
+                            await message.channel.send(response)
+            except (InferenceQueueFull, InferenceDeadlineExceeded) as e:
+                outcome = "dropped"
+                print(f"Dropped message in channel {message.channel.id}: {e}")
+            except asyncio.TimeoutError:
+                outcome = "timed_out"
+                print(f"Response generation timed out in channel {message.channel.id}.")
+            except Exception as e:
+                outcome = "error"
+                print(f"An error occurred while generating a response: {e}")
+            finally:
+                self.admission.finished(message.channel.id)
+            METRICS.inc("replies_total", outcome=outcome)
+            if outcome == "replied":
+                METRICS.observe("on_message_seconds", time.perf_counter() - started_at, mode="stream" if self.streaming else "batch")
+
+    async def reply_streaming(self, channel, prompt):
+        """
+        応答を生成しながら返信する。最初のトークンが生成された時点でメッセージを送り、以降は一定間隔で編集する
+        同じチャンネルで新しい応答の生成が始まった場合は、生成を中断する
+        """
+        channel_id = channel.id
+        guild = getattr(channel, "guild", None)
+        previous = self._generations.get(channel_id)
+        if previous is not None:
+            previous.set()
+        cancelled = threading.Event()
+        self._generations[channel_id] = cancelled
+
+        loop = asyncio.get_running_loop()
+        sent = None
+        shown = text = None
+        last_edit = 0.0
+        try:
+            async with channel.typing():
+                async for text in self.inference.stream(
+                    prompt, channel_id=channel_id, cancelled=cancelled, guild_id=guild.id if guild else None
+                ):
+                    # 空のメッセージは送れない
+                    if not text.strip():
+                        continue
+                    now = loop.time()
+                    if sent is None:
+                        with METRICS.timer("reply_stage_seconds", stage="send"):
+                            sent = await channel.send(text)
+                    elif now - last_edit >= self.stream_edit_interval:
+                        with METRICS.timer("reply_stage_seconds", stage="edit"):
+                            await sent.edit(content=text)
+                    else:
+                        continue
+                    shown, last_edit = text, now
+            # 編集の間隔を空けるために表示していなかった最後の部分を反映する
+            if sent is not None and text != shown and text.strip():
+                await sent.edit(content=text)
+        finally:
+            if self._generations.get(channel_id) is cancelled:
+                del self._generations[channel_id]
 
     async def handle_command(self, message):
         """
@@ -80,60 +358,262 @@ class AIKunBot(discord.Client):
         parts = message.content.split()
         command = parts[1] if len(parts) > 1 else None
 
+        if command in ('Run', 'Reload', 'Rollback'):
+            await self.ensure_learner()
+
         if command == 'Run':
-            await message.channel.send('Loading AI model...')
-            self.learner.load_model()
+            if self.learner.model is None:
+                await message.channel.send('Loading AI model...')
+                await self.load_model_in_background()
             if self.learner.model is not None:
-                self.is_ai_running = True
-                self.ai_enabled_channels.add(message.channel.id)
+                self.set_running(True)
+                self.set_channel_enabled(message.channel.id, True)
                 await message.channel.send('AI-KUN is now running in this channel.')
             else:
                 await message.channel.send('Failed to load AI model. Please run `learning` first.')
 
         elif command == 'Stop':
-            self.is_ai_running = False
+            self.set_running(False)
             await message.channel.send('AI-KUN has been stopped.')
 
         elif command == 'NO':
-            if message.channel.id in self.ai_enabled_channels:
-                self.ai_enabled_channels.remove(message.channel.id)
+            self.set_channel_enabled(message.channel.id, False)
             await message.channel.send('AI-KUN will no longer be active in this channel.')
 
+        elif command == 'Reload':
+            await message.channel.send('Loading the latest AI model in the background...')
+            if await self.load_model_in_background():
+                await message.channel.send(f'Now serving model version {self.learner.serving.version}.')
+            else:
+                await message.channel.send('Failed to load AI model. Please run `learning` first.')
+
+        elif command == 'Rollback':
+            async with self.model_lock:
+                version = await asyncio.to_thread(self.learner.rollback_model)
+            if version is not None:
+                await message.channel.send(f'Rolled back to model version {version}.')
+            else:
+                await message.channel.send('There is no previous model version to roll back to.')
+
+        elif command == 'Limit':
+            await self.handle_limit_command(message, parts[2:])
+
+        elif command == 'Stats':
+            await message.channel.send(self.format_stats())
+
+        elif command in ('Coalesce', 'Deadline'):
+            try:
+                seconds = float(parts[2])
+            except (IndexError, ValueError):
+                await message.channel.send(f'Usage: !AI-KUN {command} <seconds>')
+                return
+            if command == 'Coalesce':
+                self.admission.coalesce_window = max(0.0, seconds)
+                self.state.set("coalesce_window", self.admission.coalesce_window)
+                await message.channel.send(f'Messages arriving within {seconds:g} seconds will be answered together.')
+            else:
+                self.inference.max_queue_wait = seconds if seconds > 0 else None
+                self.state.set("queue_deadline", self.inference.max_queue_wait)
+                await message.channel.send(f'Requests waiting longer than {seconds:g} seconds will be dropped.' if seconds > 0 else 'Queue deadline disabled.')
+
         else:
-            await message.channel.send('Unknown command. Available commands: Run, Stop, NO')
+            await message.channel.send('Unknown command. Available commands: Run, Stop, NO, Reload, Rollback, Limit, Coalesce, Deadline, Stats')
+
+    def format_stats(self):
+        """
+        !AI-KUN Stats で表示する、主な計測値の要約
+        """
+        def timing(name, **labels):
+            histogram = METRICS.histogram(name, **labels)
+            if histogram is None or histogram.count == 0:
+                return 'n/a'
+            return f'p50 {histogram.quantile(0.5) * 1000:.0f}ms / p95 {histogram.quantile(0.95) * 1000:.0f}ms (n={histogram.count})'
+
+        def megabytes(value):
+            return f'{value / 1024 / 1024:.1f}MB' if value is not None else 'n/a'
+
+        inference = self.inference.snapshot()
+        lines = [
+            f'Reply: {timing("on_message_seconds", mode="stream" if self.streaming else "batch")}',
+            f'Queue wait: {timing("queue_wait_seconds")}',
+            f'Generate: encode {timing("generate_stage_seconds", stage="encode")}, '
+            f'generate {timing("generate_stage_seconds", stage="generate")}, '
+            f'decode {timing("generate_stage_seconds", stage="decode")}',
+            f'First token (streaming): {timing("stream_first_token_seconds")}',
+            f'Send: {timing("reply_stage_seconds", stage="send")}',
+            f'Event loop lag: {timing("event_loop_lag_seconds")}',
+            f'Queue: depth {inference["queue_depth"]}, completed {inference["completed"]}, failed {inference["failed"]}, '
+            f'rejected {inference["rejected"]}, expired {inference["expired"]}, timed out {inference["timed_out"]}',
+        ]
+        if self._learner is not None:
+            caches = self._learner.cache_stats()
+            rates = ', '.join(
+                f'{name.replace("_", " ")} {stats["hit_rate"]:.0%}' if stats["hit_rate"] is not None else f'{name.replace("_", " ")} n/a'
+                for name, stats in caches.items()
+            )
+            lines.append(f'Cache hit rate: {rates}')
+        weights = METRICS.snapshot()["gauges"].get("model_weights_bytes")
+        lines.append(f'Memory: model weights {megabytes(weights)}, process {megabytes(process_memory_bytes())}')
+        return '\n'.join(lines)
 
-    async def research_and_collect(self, output_dir="data", after=None):
+    async def handle_limit_command(self, message, args):
+        """
+        応答数の制限を表示・変更する
+        !AI-KUN Limit                         現在の制限と破棄・まとめた件数を表示
+        !AI-KUN Limit <件/分> [バースト]        このチャンネルの制限を変更（0で無制限）
+        !AI-KUN Limit global <件/分> [バースト] 全体の制限を変更
+        """
+        admission = self.admission
+
+        def describe(rate, burst):
+            return f'{rate * 60:g}/min (burst {burst})' if rate > 0 else 'unlimited'
+
+        if not args:
+            rate, burst = admission.channel_limit(message.channel.id)
+            stats = admission.stats()
+            inference = self.inference.stats
+            dropped = stats["rate_limited"] + inference.rejected + inference.expired
+            await message.channel.send(
+                f'Channel limit: {describe(rate, burst)}. '
+                f'Global limit: {describe(admission.global_bucket.rate, admission.global_bucket.burst)}. '
+                f'Coalesce window: {admission.coalesce_window:g}s. '
+                f'Queue deadline: {self.inference.max_queue_wait or 0:g}s.\n'
+                f'Dropped: {dropped} (rate limited {stats["rate_limited"]}, queue full {inference.rejected}, '
+                f'expired {inference.expired}). Coalesced: {stats["coalesced"]}.'
+            )
+            return
+
+        is_global = args[0] == 'global'
+        if is_global:
+            args = args[1:]
+        try:
+            rate = float(args[0]) / 60
+            burst = int(args[1]) if len(args) > 1 else None
+        except (IndexError, ValueError):
+            await message.channel.send('Usage: !AI-KUN Limit [global] <messages per minute> [burst]')
+            return
+
+        if is_global:
+            admission.set_global_limit(rate, burst or admission.global_bucket.burst)
+            self.state.set("global_limit", [rate, admission.global_bucket.burst])
+            await message.channel.send(f'Global limit set to {describe(rate, admission.global_bucket.burst)}.')
+        else:
+            burst = burst or admission.channel_limit(message.channel.id)[1]
+            admission.set_channel_limit(message.channel.id, rate, burst)
+            self.state.update_channel_settings(message.channel.id, rate=rate, burst=burst)
+            await message.channel.send(f'Channel limit set to {describe(rate, burst)}.')
+
+    async def load_model_in_background(self, version=None):
+        """
+        推論スレッドとは別のスレッドでモデルを読み込む。差し替えまでは現在のモデルで応答を続ける
+        """
+        await self.ensure_learner()
+        async with self.model_lock:
+            try:
+                return await asyncio.to_thread(self.learner.load_model, version)
+            except Exception as e:
+                print(f"An error occurred while loading the model: {e}")
+                return False
+
+    async def research_and_collect(self, output_dir="data", after=None, incremental=True):
         """
         ボットが参加しているサーバーの会話履歴を収集して保存する
         `after`が指定された場合、その日時以降のメッセージのみを収集する
+        `incremental`が真の場合、チャンネルごとに最後に保存したメッセージIDを記録し、次回はそれ以降のメッセージだけを追記する
         """
         print("Starting data collection...")
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
+        # 前回の続きの位置は、収集先ディレクトリごとに state store に記録する
+        scope = os.path.normpath(output_dir) if incremental else None
+        if scope is not None:
+            self._import_legacy_checkpoints(scope, os.path.join(output_dir, ".checkpoints.json"))
+        # 同時に履歴を取得するチャンネル数。レート制限による待機はdiscord.py側で行われる
+        semaphore = asyncio.Semaphore(env_int("AI_KUN_RESEARCH_CONCURRENCY", 4))
+
+        jobs = []
         for guild in self.guilds:
             print(f"Collecting data from guild: {guild.name} (ID: {guild.id})")
             for channel in guild.text_channels:
                 # チャンネルにアクセス権があるか確認
                 if channel.permissions_for(guild.me).read_messages:
-                    print(f"  - Channel: {channel.name}")
-                    try:
-                        history_messages = [message.content async for message in channel.history(limit=None, after=after)]
-                        if not history_messages:
-                            continue
-
-                        # `after`が指定されていない場合、履歴は新しい順なので時系列にするために逆順にする
-                        if after is None:
-                            history_messages.reverse()
-
-                        # ファイルに書き込み
-                        file_path = os.path.join(output_dir, f"{guild.id}_{channel.id}.txt")
-                        with open(file_path, "w", encoding="utf-8") as f:
-                            for line in history_messages:
-                                f.write(line + "\n")
-                    except discord.Forbidden:
-                        print(f"    - Could not access channel: {channel.name} (Forbidden)")
-                    except Exception as e:
-                        print(f"    - An error occurred in {channel.name}: {e}")
-
-        print("Data collection finished.")
\ No newline at end of file
+                    jobs.append(self._collect_channel(guild, channel, output_dir, after, scope, semaphore))
+        started_at = time.perf_counter()
+        await asyncio.gather(*jobs)
+        await asyncio.to_thread(self.state.flush)
+        METRICS.observe("collect_seconds", time.perf_counter() - started_at)
+
+        print("Data collection finished.")
+
+    async def _collect_channel(self, guild, channel, output_dir, after, scope, semaphore):
+        """
+        1つのチャンネルの履歴を古い順に取得し、届いたそばからファイルに書き込む
+        scopeがNoneでなければ、前回の続きから取得して追記し、最後に書き込んだメッセージIDを記録する
+        afterは、前回の続きの位置（チェックポイント）がない場合にだけ取得の開始位置として使う
+        """
+        async with semaphore:
+            print(f"  - Channel: {channel.name}")
+            since = after
+            file_path = os.path.join(output_dir, f"{guild.id}_{channel.id}{CORPUS_SUFFIX}")
+            last_id = self.state.checkpoints(scope).get(channel.id) if scope is not None else None
+            if scope is not None and last_id is None and os.path.exists(file_path):
+                # チェックポイントがなくても、既に保存したメッセージは取得し直さない
+                last_id = await asyncio.to_thread(last_record_id, file_path)
+            if last_id is not None:
+                # afterより古いチェックポイントでも、その続きから取得する（停止していた間のメッセージを取りこぼさない）
+                since = discord.Object(id=last_id)
+
+            legacy_path = os.path.join(output_dir, f"{guild.id}_{channel.id}.txt")
+            if scope is not None and os.path.exists(legacy_path) and not os.path.exists(file_path):
+                # 会話コーパスができると以前の形式のファイルは学習に使わなくなるため、最初から全履歴を取得する
+                print(f"    - Migrating {legacy_path} to {CORPUS_SUFFIX}: collecting the full history.")
+                since = None
+            writer = CorpusWriter(file_path, append=scope is not None, dedup_window=env_int("AI_KUN_DEDUP_WINDOW", 100000))
+            last_seen_id = None
+            count = filtered = 0
+            try:
+                async for message in channel.history(limit=None, after=since, oldest_first=True):
+                    last_seen_id = message.id
+                    count += 1
+                    # ボットの発言やコマンドは、書き込む時点で学習データから除く
+                    if should_collect(message):
+                        if not writer.is_open:
+                            # 既存のメッセージの読み込みでイベントループを止めない
+                            await asyncio.to_thread(writer.open)
+                        writer.write(message_record(message))
+                    else:
+                        filtered += 1
+                    # プロセスが強制終了しても重複が少なくなるよう、定期的にチェックポイントを更新する
+                    if scope is not None and count % 1000 == 0:
+                        writer.flush()
+                        self.state.set_checkpoint(scope, channel.id, last_seen_id)
+            except discord.Forbidden:
+                print(f"    - Could not access channel: {channel.name} (Forbidden)")
+            except Exception as e:
+                print(f"    - An error occurred in {channel.name}: {e}")
+            finally:
+                writer.close()
+                # 途中で失敗しても、書き込めたところまでは次回取得し直さない
+                if scope is not None and last_seen_id is not None:
+                    self.state.set_checkpoint(scope, channel.id, last_seen_id)
+            METRICS.inc("collected_messages_total", writer.written, result="saved")
+            METRICS.inc("collected_messages_total", filtered, result="filtered")
+            METRICS.inc("collected_messages_total", writer.duplicates, result="duplicate")
+            if count:
+                print(f"    - {channel.name}: {writer.written} saved, {filtered} filtered, {writer.duplicates} duplicates")
+
+    def _import_legacy_checkpoints(self, scope, path):
+        """
+        以前の形式（収集先ディレクトリの .checkpoints.json）のチェックポイントを state store に移す
+        """
+        if self.state.checkpoints(scope) or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                checkpoints = json.load(f)
+        except ValueError:
+            return
+        for channel_id, message_id in checkpoints.items():
+            self.state.set_checkpoint(scope, int(channel_id), message_id)
+        print(f"Imported {len(checkpoints)} collection checkpoints from {path}.")
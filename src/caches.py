@@ -0,0 +1,130 @@
+import collections
+import re
+import time
+import unicodedata
+
+
+def normalize_prompt(text):
+    """
+    キャッシュのキーにするため、表記ゆれ（全角・半角、大文字・小文字、空白）をそろえる
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class ResponseCache:
+    """
+    正規化したプロンプトとモデルのバージョンをキーにした、件数と有効期限付きのLRU応答キャッシュ
+    """
+    def __init__(self, max_entries=512, ttl=600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, prompt, version):
+        key = (normalize_prompt(prompt), version)
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, prompt, version, response):
+        if self.max_entries <= 0:
+            return
+        key = (normalize_prompt(prompt), version)
+        self._entries[key] = (response, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+        }
+
+
+class ChannelContext:
+    """
+    チャンネルの会話のトークン列と、それに対応するモデルのキャッシュ（past_key_values）
+    """
+    __slots__ = ("tokens", "past", "nbytes", "version", "last_used")
+
+    def __init__(self, tokens, past, nbytes, version):
+        self.tokens = tokens
+        self.past = past
+        self.nbytes = nbytes
+        self.version = version
+        self.last_used = time.monotonic()
+
+
+class ChannelContextCache:
+    """
+    チャンネルごとの会話コンテキストを保持し、次の発言ではプレフィックスの再計算を省く
+    一定時間発言のないチャンネルと、メモリ上限を超えた分は古いものから破棄する
+    """
+    def __init__(self, idle_seconds=900.0, memory_budget_bytes=256 * 1024 * 1024):
+        self.idle_seconds = idle_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._contexts = collections.OrderedDict()
+
+    @property
+    def nbytes(self):
+        return sum(context.nbytes for context in self._contexts.values())
+
+    def get(self, channel_id, version):
+        self.evict()
+        context = self._contexts.get(channel_id)
+        # モデルが差し替えられた場合、以前のキャッシュは使えない
+        if context is not None and context.version == version:
+            self._contexts.move_to_end(channel_id)
+            self.hits += 1
+            return context
+        if context is not None:
+            del self._contexts[channel_id]
+        self.misses += 1
+        return None
+
+    def put(self, channel_id, context):
+        context.last_used = time.monotonic()
+        self._contexts[channel_id] = context
+        self._contexts.move_to_end(channel_id)
+        self.evict()
+
+    def discard(self, channel_id):
+        self._contexts.pop(channel_id, None)
+
+    def evict(self):
+        now = time.monotonic()
+        for channel_id in [cid for cid, context in self._contexts.items() if now - context.last_used > self.idle_seconds]:
+            del self._contexts[channel_id]
+            self.evictions += 1
+        total = self.nbytes
+        while self._contexts and total > self.memory_budget_bytes:
+            _, context = self._contexts.popitem(last=False)
+            total -= context.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "channels": len(self._contexts),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else None,
+        }
@@ -0,0 +1,49 @@
+import os
+
+
+def env_str(name, default=None):
+    """
+    環境変数（.env）から文字列の設定値を読み込む
+    """
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip()
+
+
+def env_int(name, default):
+    """
+    環境変数から整数の設定値を読み込む。不正な値の場合はデフォルト値を使う
+    """
+    value = env_str(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"[WARNING] Invalid integer for {name}: {value!r}. Using default {default}.")
+        return default
+
+
+def env_float(name, default):
+    """
+    環境変数から小数の設定値を読み込む。不正な値の場合はデフォルト値を使う
+    """
+    value = env_str(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"[WARNING] Invalid number for {name}: {value!r}. Using default {default}.")
+        return default
+
+
+def env_bool(name, default):
+    """
+    環境変数から真偽値の設定値を読み込む（1/true/yes/on を真とみなす）
+    """
+    value = env_str(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,217 @@
+import collections
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import unicodedata
+import zlib
+
+# 会話コーパスのファイル形式（1行に1メッセージのJSONをgzipで圧縮したもの）
+CORPUS_SUFFIX = ".jsonl.gz"
+# これらで始まるメッセージはボットへのコマンドとみなし、学習データに含めない
+COMMAND_PREFIXES = ("!", "/")
+# 通常の発言と返信以外（参加通知・ピン留めなど）は学習データに含めない
+MESSAGE_TYPES = ("default", "reply")
+# 書き込み中に強制終了した会話コーパスを読んだときに送出されうる例外
+CORRUPTION_ERRORS = (EOFError, gzip.BadGzipFile, zlib.error, OSError)
+
+
+def corpus_files(data_path):
+    """
+    学習データのファイル（会話コーパスと、以前の形式のテキストファイル）をファイル名順に返す
+    同じチャンネルの会話コーパスがある場合、以前の形式のファイルは同じ会話を含むため使わない
+    """
+    corpora = glob.glob(os.path.join(data_path, "*" + CORPUS_SUFFIX))
+    legacy = [path for path in glob.glob(os.path.join(data_path, "*.txt")) if not os.path.exists(corpus_path_for(path))]
+    return sorted(corpora + legacy)
+
+
+def corpus_path_for(legacy_path):
+    """
+    以前の形式のテキストファイル（<サーバーID>_<チャンネルID>.txt）に対応する会話コーパスのパス
+    """
+    return legacy_path[:-len(".txt")] + CORPUS_SUFFIX
+
+
+def _read_records(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def iter_records(path):
+    """
+    会話コーパスのメッセージを1件ずつ辞書で返す
+    書き込み中に強制終了して末尾が壊れている場合は、読めたところまでを返す
+    """
+    try:
+        yield from _read_records(path)
+    except CORRUPTION_ERRORS as e:
+        print(f"[WARNING] {path} is truncated or corrupted; using the records read so far ({e}).")
+
+
+def last_record_id(path):
+    """
+    会話コーパスに保存されている最後のメッセージのIDを返す。ファイルがない・IDを持つメッセージがない場合はNone
+    """
+    if not os.path.exists(path):
+        return None
+    last_id = None
+    for record in iter_records(path):
+        if record.get("id") is not None:
+            last_id = max(last_id or 0, record["id"])
+    return last_id
+
+
+def repair_corpus(path):
+    """
+    壊れた会話コーパスを、読めたところまでのメッセージで書き直す
+    壊れたgzipメンバーの後ろに追記すると、それ以降のメッセージもすべて読めなくなるため、追記の前に行う
+    """
+    tmp_path = path + ".tmp"
+    count = 0
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for record in iter_records(path):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    print(f"Repaired {path}: kept {count} readable message(s).")
+
+
+def iter_lines(path):
+    """
+    学習に使うテキストを1行ずつ返す。会話コーパスの場合は各メッセージの本文を返す
+    """
+    if path.endswith(CORPUS_SUFFIX):
+        for record in iter_records(path):
+            yield record["content"] + "\n"
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from f
+
+
+def should_collect(message):
+    """
+    メッセージを学習データとして収集するかどうか（ボットの発言・コマンド・システムメッセージ・空の本文は除く）
+    """
+    if getattr(message.author, "bot", False):
+        return False
+    if getattr(getattr(message, "type", None), "name", "default") not in MESSAGE_TYPES:
+        return False
+    content = message.content.strip()
+    return bool(content) and not content.startswith(COMMAND_PREFIXES)
+
+
+def message_record(message):
+    """
+    メッセージを会話コーパスに保存する形式の辞書にする
+    """
+    reference = getattr(message, "reference", None)
+    return {
+        "id": message.id,
+        "author": message.author.id,
+        "timestamp": message.created_at.isoformat(),
+        "reply_to": reference.message_id if reference is not None else None,
+        "content": message.content,
+    }
+
+
+_URL = re.compile(r"https?://\S+")
+_MENTION = re.compile(r"<[@#][!&]?\d+>")
+_REPEAT = re.compile(r"(.)\1{2,}")
+_SYMBOLS = re.compile(r"[\W_]+")
+
+
+def content_fingerprint(text):
+    """
+    表記ゆれ・URL・メンション・数字・記号・同じ文字の繰り返しを無視した、本文のハッシュ値
+    """
+    original = unicodedata.normalize("NFKC", text).lower()
+    text = _MENTION.sub("@", _URL.sub("url", original))
+    text = re.sub(r"\d+", "0", text)
+    # 記号や絵文字だけのメッセージは、すべて同じとみなさないよう元の本文を使う
+    text = _REPEAT.sub(r"\1\1", _SYMBOLS.sub("", text)) or original
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+
+class NearDuplicateFilter:
+    """
+    直近window件のメッセージと、ほぼ同じ内容のメッセージを検出する
+    """
+    def __init__(self, window=100000):
+        self.window = window
+        self._seen = collections.OrderedDict()
+
+    def is_duplicate(self, text):
+        """
+        textが直近のメッセージの重複ならTrueを返し、そうでなければ記録してFalseを返す
+        """
+        key = content_fingerprint(text)
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+        self._seen[key] = None
+        if len(self._seen) > self.window:
+            self._seen.popitem(last=False)
+        return False
+
+
+class CorpusWriter:
+    """
+    1チャンネル分のメッセージを会話コーパスに書き込む。重複したメッセージは書き込まない
+    appendが真の場合は既存のファイルに追記し、既存のメッセージとの重複も除く
+    ファイルは最初のメッセージを書き込むときに開く
+    """
+    def __init__(self, path, append=True, dedup_window=100000):
+        self.path = path
+        self.append = append
+        self.dedup = NearDuplicateFilter(dedup_window)
+        self.written = 0
+        self.duplicates = 0
+        self._file = None
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    def open(self):
+        """
+        ファイルを開く。追記する場合は、重複を検出するために既存のメッセージを読み込む
+        """
+        if self._file is not None:
+            return
+        if self.append and os.path.exists(self.path):
+            try:
+                for record in _read_records(self.path):
+                    self.dedup.is_duplicate(record["content"])
+            except CORRUPTION_ERRORS as e:
+                print(f"[WARNING] {self.path} is truncated or corrupted ({e}). Repairing it before appending.")
+                repair_corpus(self.path)
+        # gzipは追記すると新しいメンバーとして連結され、読み出し時は1つのファイルとして扱われる
+        self._file = gzip.open(self.path, "at" if self.append else "wt", encoding="utf-8")
+
+    def write(self, record):
+        """
+        メッセージを書き込む。重複として除いた場合はFalseを返す
+        """
+        self.open()
+        if self.dedup.is_duplicate(record["content"]):
+            self.duplicates += 1
+            return False
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.written += 1
+        return True
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,129 @@
+import collections
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from transformers import AutoTokenizer
+
+from corpus import iter_lines
+
+# ワーカープロセスごとに1つだけ読み込むトークナイザー
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer_name):
+    global _worker_tokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _encode_chunk(text):
+    """
+    1行を1メッセージとしてトークン化し、メッセージの終わりにEOSを付けて連結する
+    連結したトークンID列と、各メッセージのトークン数を返す
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    eos = [] if _worker_tokenizer.eos_token_id is None else [_worker_tokenizer.eos_token_id]
+    encoded = [ids + eos for ids in _worker_tokenizer(lines, add_special_tokens=False)["input_ids"]]
+    ids = np.fromiter((token for message in encoded for token in message), dtype=np.int32)
+    lengths = np.asarray([len(message) for message in encoded], dtype=np.int32)
+    return ids, lengths
+
+
+def iter_text_chunks(files, chunk_chars=1 << 20, skip=None):
+    """
+    テキストファイルまたは会話コーパスを行単位で読み、おおよそchunk_chars文字ごとのかたまりにして (ファイル名, テキスト, 行数) で返す
+    ファイル全体をメモリに載せないようにするため、1ファイルずつ順に読む
+    skipはファイルごとの読み飛ばす行数の辞書で、前回読んだところの続きから読む場合に使う
+    """
+    for file in files:
+        lines, size = [], 0
+        for line in itertools.islice(iter_lines(file), (skip or {}).get(file, 0), None):
+            lines.append(line)
+            size += len(line)
+            if size >= chunk_chars:
+                yield file, "".join(lines), len(lines)
+                lines, size = [], 0
+        if lines:
+            yield file, "".join(lines), len(lines)
+
+
+def iter_token_chunks(files, tokenizer_name, processes=None, chunk_chars=1 << 20, skip=None):
+    """
+    テキストのかたまりをプロセスプールでトークン化し、元の順序で (ファイル名, トークンID配列, メッセージごとのトークン数, 行数) を返す
+    同時に処理中のかたまりはプロセス数の2倍までに抑え、メモリ使用量を一定に保つ
+    """
+    processes = processes or os.cpu_count() or 1
+    max_pending = processes * 2
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+        pending = collections.deque()
+        for file, chunk, lines in iter_text_chunks(files, chunk_chars, skip):
+            pending.append((file, lines, pool.submit(_encode_chunk, chunk)))
+            if len(pending) >= max_pending:
+                done_file, done_lines, future = pending.popleft()
+                yield (done_file, *future.result(), done_lines)
+        while pending:
+            done_file, done_lines, future = pending.popleft()
+            yield (done_file, *future.result(), done_lines)
+
+
+def pack_ranges(lengths, block_size):
+    """
+    メッセージの境界に沿って、連続するメッセージをblock_sizeトークン以下のシーケンスに詰め、その範囲 (start, end) を返す
+    1つのメッセージがblock_sizeを超える場合だけ、メッセージの途中で区切る
+    """
+    start = end = 0
+    for length in lengths:
+        if end > start and end - start + length > block_size:
+            if end - start >= 2:
+                yield start, end
+            start = end
+        end += int(length)
+        while end - start > block_size:
+            yield start, start + block_size
+            start += block_size
+    # 1トークンだけでは入力と正解の組が作れない
+    if end - start >= 2:
+        yield start, end
+
+
+def build_packed_dataset(sequences_fn, block_size, batch_size, pad_token_id, shuffle_buffer_size=10000,
+                         num_buckets=4, cache=False):
+    """
+    block_sizeトークン以下のシーケンスを返す関数sequences_fnから、(inputs, labels, sample_weight) のバッチを返す tf.data.Dataset を作る
+    長さの近いシーケンスを同じバッチにまとめてパディングを減らし、パディング部分の重みは0にする
+    cacheが真の場合、2エポック目以降はシーケンスをメモリから読む
+    """
+    def generator():
+        for sequence in sequences_fn():
+            yield np.asarray(sequence, dtype=np.int32)
+
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=tf.TensorSpec(shape=(None,), dtype=tf.int32))
+    if cache:
+        dataset = dataset.cache()
+    dataset = dataset.shuffle(shuffle_buffer_size, reshuffle_each_iteration=True)
+    dataset = dataset.map(to_example, num_parallel_calls=tf.data.AUTOTUNE)
+    return batch_by_length(dataset, block_size, batch_size, pad_token_id, num_buckets).prefetch(tf.data.AUTOTUNE)
+
+
+def to_example(sequence):
+    """
+    トークンID列を (inputs, labels, sample_weight) の組にする
+    """
+    return sequence[:-1], sequence[1:], tf.ones(tf.shape(sequence)[0] - 1, dtype=tf.float32)
+
+
+def batch_by_length(dataset, block_size, batch_size, pad_token_id, num_buckets=4):
+    """
+    長さの近い (inputs, labels, sample_weight) を同じバッチにまとめてパディングし、パディング部分の重みは0にする
+    """
+    boundaries = sorted({max(2, block_size * (i + 1) // num_buckets) for i in range(num_buckets - 1)})
+    return dataset.bucket_by_sequence_length(
+        element_length_func=lambda inputs, labels, weights: tf.shape(inputs)[0],
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1),
+        padding_values=(pad_token_id, pad_token_id, 0.0),
+    )
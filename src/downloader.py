@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ChecksumMismatch(DownloadError):
+    pass
+
+
+class SourceChanged(DownloadError):
+    pass
+
+
+def fetch_checksum(sums_url, filename, timeout=30):
+    """
+    公開されているチェックサム一覧（"<ハッシュ>  <ファイル名>" の行が並んだテキスト）から、filename のハッシュを返す
+    """
+    response = requests.get(sums_url, timeout=timeout)
+    response.raise_for_status()
+    for line in response.text.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].lstrip("*") == filename:
+            return parts[0].lower()
+    raise DownloadError(f"{filename} is not listed in {sums_url}")
+
+
+def file_digest(path, algorithm="md5", chunk_size=1 << 20):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RangeDownloader:
+    """
+    HTTPのRangeリクエストでファイルを区間に分け、複数の接続で並列にダウンロードする
+    書きかけは <path>.part に、完了した区間は <path>.part.json に記録し、中断しても完了済みの区間の続きから再開する
+    すべての区間がそろったらチェックサムを確かめ、1回のリネームで <path> に置き換える
+    サーバーがRangeに対応していない場合は、1本の接続でそのままダウンロードする
+    """
+    def __init__(self, connections=4, segment_size=64 << 20, chunk_size=1 << 20, retries=5, timeout=60, session=None):
+        self.connections = max(1, connections)
+        self.segment_size = max(chunk_size, segment_size)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+
+    def probe(self, url):
+        """
+        先頭1バイトだけを要求し、ファイルサイズ・Rangeへの対応・版の識別子（ETag / Last-Modified）を調べる
+        """
+        with self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            etag = r.headers.get("ETag")
+            if etag is not None and etag.startswith("W/"):
+                # If-Range は強いETagでしか比較されないので、弱いETagの場合は Last-Modified を使う
+                etag = None
+            validator = etag or r.headers.get("Last-Modified")
+            content_range = r.headers.get("Content-Range", "")
+            if r.status_code == 206 and "/" in content_range and not content_range.endswith("/*"):
+                return int(content_range.rsplit("/", 1)[1]), True, validator
+            length = r.headers.get("Content-Length")
+            return (int(length) if length is not None else None), False, validator
+
+    def download(self, url, path, checksum=None, algorithm="md5", progress=None):
+        """
+        url を path にダウンロードする。checksum を渡した場合は一致しなければ ChecksumMismatch を送出する
+        progress には、tqdmのように total と update(書き込んだバイト数) を持つものを渡せる
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        part_path = path + ".part"
+        state_path = part_path + ".json"
+
+        size, ranged, validator = self.probe(url)
+        if progress is not None:
+            progress.total = size
+        if ranged:
+            self._download_ranges(url, part_path, state_path, size, validator, progress)
+        else:
+            print("[WARNING] The server does not support range requests. Downloading over a single connection.")
+            self._download_stream(url, part_path, progress)
+
+        if checksum is not None:
+            actual = file_digest(part_path, algorithm)
+            if actual != checksum.lower():
+                # 壊れた内容から再開しないよう、書きかけと進捗の記録を捨てる
+                for stale in (part_path, state_path):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                raise ChecksumMismatch(f"{algorithm} of {url} is {actual}, expected {checksum}")
+        os.replace(part_path, path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def _load_state(self, state_path, url, size, validator):
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # サーバー上のファイルが更新されていたり、区間の大きさが変わっていたら最初からやり直す
+        if (state.get("url"), state.get("size"), state.get("validator"), state.get("segment_size")) != (
+                url, size, validator, self.segment_size):
+            return None
+        return state
+
+    def _save_state(self, state_path, state):
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def _download_ranges(self, url, part_path, state_path, size, validator, progress):
+        state = self._load_state(state_path, url, size, validator) if os.path.exists(part_path) else None
+        if state is None:
+            state = {"url": url, "size": size, "validator": validator, "segment_size": self.segment_size, "done": []}
+            # 各区間を決まった位置に書き込めるよう、最終的な大きさのファイルを先に作る
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+            self._save_state(state_path, state)
+
+        def bounds(index):
+            start = index * self.segment_size
+            return start, min(size, start + self.segment_size) - 1
+
+        done = set(state["done"])
+        segments = [i for i in range((size + self.segment_size - 1) // self.segment_size) if i not in done]
+        if progress is not None:
+            progress.update(sum(end - start + 1 for start, end in map(bounds, done)))
+        if done:
+            print(f"Resuming download: {len(done)} of {len(done) + len(segments)} segments already downloaded.")
+
+        def fetch(index):
+            start, end = bounds(index)
+            self._fetch_segment(url, part_path, start, end, validator, progress)
+            with self._lock:
+                state["done"].append(index)
+                self._save_state(state_path, state)
+
+        with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix="download") as executor:
+            # 1つの区間が失敗しても、他の区間の結果は記録してから例外を送出する
+            futures = [executor.submit(fetch, index) for index in segments]
+            errors = [future.exception() for future in futures]
+        errors = [e for e in errors if e is not None]
+        for e in errors:
+            if isinstance(e, SourceChanged):
+                # 区間ごとに別の版が混ざらないよう、次回は最初からやり直す
+                os.remove(state_path)
+                raise e
+        if errors:
+            raise DownloadError(f"{len(errors)} segment(s) failed; rerun to resume: {errors[0]}")
+
+    def _fetch_segment(self, url, part_path, start, end, validator, progress):
+        headers = {"Range": f"bytes={start}-{end}"}
+        if validator is not None:
+            # ダウンロード中にファイルが更新された場合、サーバーは206ではなく全体を返す
+            headers["If-Range"] = validator
+        for attempt in range(self.retries + 1):
+            written = 0
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise SourceChanged(f"{url} changed on the server during the download (status {r.status_code})")
+                    with open(part_path, "r+b", buffering=self.chunk_size) as f:
+                        f.seek(start)
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                            written += len(chunk)
+                            if progress is not None:
+                                progress.update(len(chunk))
+                if written != end - start + 1:
+                    raise DownloadError(f"Segment {start}-{end} ended after {written} bytes")
+                return
+            except SourceChanged:
+                raise
+            except (requests.exceptions.RequestException, DownloadError) as e:
+                if progress is not None and written:
+                    progress.update(-written)
+                if attempt == self.retries:
+                    raise
+                print(f"[WARNING] Segment {start}-{end} failed ({e}). Retrying ({attempt + 1}/{self.retries})...")
+                time.sleep(min(60, 2 ** attempt))
+
+    def _download_stream(self, url, part_path, progress):
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            with open(part_path, "wb", buffering=self.chunk_size) as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    if progress is not None:
+                        progress.update(len(chunk))
@@ -0,0 +1,323 @@
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+
+class InferenceQueueFull(Exception):
+    """
+    推論キューが満杯で、新しいリクエストを受け付けられないときに送出される
+    """
+
+
+class InferenceDeadlineExceeded(Exception):
+    """
+    リクエストがキューで待った時間が期限を超え、応答を生成せずに破棄されたときに送出される
+    """
+
+
+# ストリーミングの終わりを表す印
+_END = object()
+
+
+class _Request:
+    """
+    推論キューに入れる1件のリクエスト
+    partialsが指定されたリクエストはストリーミングで生成し、途中結果をそのキューに入れる
+    """
+    __slots__ = ("text", "channel_id", "guild_id", "future", "enqueued_at", "partials", "cancelled")
+
+    def __init__(self, text, channel_id, future, partials=None, cancelled=None, guild_id=None):
+        self.text = text
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.partials = partials
+        self.cancelled = cancelled
+
+
+class InferenceStats:
+    """
+    推論ワーカーの統計情報（キューの深さ・待ち時間・生成時間）を保持する
+    """
+    def __init__(self, window=256):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.queue_wait = collections.deque(maxlen=window)
+        self.latency = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def record_wait(self, seconds):
+        self.queue_wait.append(seconds)
+        METRICS.observe("queue_wait_seconds", seconds)
+
+    def record_latency(self, seconds):
+        self.latency.append(seconds)
+        METRICS.observe("inference_latency_seconds", seconds)
+
+    @staticmethod
+    def _percentile(values, pct):
+        if not values:
+            return None
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self, queue_depth):
+        return {
+            "queue_depth": queue_depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "expired": self.expired,
+            "queue_wait_p50": self._percentile(self.queue_wait, 50),
+            "queue_wait_p95": self._percentile(self.queue_wait, 95),
+            "latency_p50": self._percentile(self.latency, 50),
+            "latency_p95": self._percentile(self.latency, 95),
+            "batch_size_avg": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+        }
+
+
+class InferenceWorker:
+    """
+    モデルを保持する専用スレッドで応答生成を行うワーカー
+    イベントループ側はリクエストをキューに入れて結果を待つだけにする
+    batch_window秒の間に届いたリクエストは、最大max_batch_size件まで1回の生成にまとめる
+    キューでmax_queue_wait秒より長く待ったリクエストは、古い発言への応答になるため生成せずに破棄する
+    learner_providerはAILearnerを返す関数で、最初のリクエストを処理するときまで呼び出さない
+    """
+    def __init__(self, learner_provider, max_queue_size=32, timeout=60.0, max_batch_size=8, batch_window=0.01,
+                 max_queue_wait=None):
+        self.learner_provider = learner_provider
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.max_queue_wait = max_queue_wait
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_window = batch_window
+        self.stats = InferenceStats()
+        # TensorFlowのモデルは1つのスレッドからだけ触るようにする
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._queue = None
+        self._consumer = None
+
+    def start(self):
+        """
+        実行中のイベントループ上でキューとコンシューマータスクを作成する
+        """
+        if self._consumer is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._consumer = asyncio.get_running_loop().create_task(self._consume())
+
+    async def close(self):
+        """
+        コンシューマータスクを止め、スレッドプールを解放する
+        """
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+        self._executor.shutdown(wait=False)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def snapshot(self):
+        """
+        キューの深さとレイテンシの統計を辞書で返す
+        """
+        return self.stats.snapshot(self.queue_depth)
+
+    async def run(self, func, *args):
+        """
+        モデルを扱う任意の処理を推論スレッド上で実行する（モデルの読み込みなど）
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def submit(self, text, channel_id=None, guild_id=None):
+        """
+        応答生成をリクエストし、結果を待つ
+        キューが満杯の場合は InferenceQueueFull、時間切れの場合は asyncio.TimeoutError を送出する
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait(_Request(text, channel_id, future, guild_id=guild_id))
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise InferenceQueueFull(f"Inference queue is full ({self.max_queue_size} pending requests).")
+        self.stats.submitted += 1
+
+        try:
+            # タイムアウトするとfutureがキャンセルされ、まだ処理されていなければスキップされる
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.stats.timed_out += 1
+            raise
+
+    async def stream(self, text, channel_id=None, cancelled=None, guild_id=None):
+        """
+        応答をストリーミングで生成し、その時点までの応答テキストを順に返す非同期ジェネレーター
+        cancelled（threading.Event）をセットするか、途中で受け取りをやめると生成を中断する
+        キューが満杯の場合は InferenceQueueFull、時間切れの場合は asyncio.TimeoutError を送出する
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        cancelled = cancelled or threading.Event()
+        request = _Request(text, channel_id, loop.create_future(), asyncio.Queue(), cancelled, guild_id)
+        try:
+            self._queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise InferenceQueueFull(f"Inference queue is full ({self.max_queue_size} pending requests).")
+        self.stats.submitted += 1
+
+        deadline = loop.time() + self.timeout
+        try:
+            while True:
+                try:
+                    partial = await asyncio.wait_for(request.partials.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    self.stats.timed_out += 1
+                    raise
+                if partial is _END:
+                    break
+                yield partial
+        finally:
+            # 受け取り側がやめた場合は、推論スレッドでの生成も止める
+            cancelled.set()
+            request.future.cancel()
+        if request.future.done() and not request.future.cancelled() and request.future.exception() is not None:
+            raise request.future.exception()
+
+    def _run_stream(self, request, loop):
+        """
+        推論スレッド上でストリーミング生成を行い、途中結果をイベントループ側のキューに渡す
+        """
+        for partial in self.learner_provider().predict_stream(
+            request.text, channel_id=request.channel_id, cancelled=request.cancelled, guild_id=request.guild_id
+        ):
+            loop.call_soon_threadsafe(request.partials.put_nowait, partial)
+
+    def _expire(self, request):
+        """
+        期限を過ぎたリクエストを破棄する。破棄した場合はTrueを返す
+        """
+        if not self.max_queue_wait or time.monotonic() - request.enqueued_at <= self.max_queue_wait:
+            return False
+        self.stats.expired += 1
+        if not request.future.done():
+            request.future.set_exception(InferenceDeadlineExceeded(
+                f"Request waited more than {self.max_queue_wait:.0f} seconds in the inference queue."
+            ))
+        if request.partials is not None:
+            request.partials.put_nowait(_END)
+        return True
+
+    async def _process_stream(self, request):
+        loop = asyncio.get_running_loop()
+        started_at = time.monotonic()
+        self.stats.record_wait(started_at - request.enqueued_at)
+        self.stats.batch_sizes.append(1)
+        try:
+            await self.run(self._run_stream, request, loop)
+        except Exception as e:
+            self.stats.failed += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if request.cancelled.is_set():
+                self.stats.cancelled += 1
+            else:
+                self.stats.completed += 1
+                self.stats.record_latency(time.monotonic() - request.enqueued_at)
+            if not request.future.done():
+                request.future.set_result(None)
+        request.partials.put_nowait(_END)
+
+    async def _next_batch(self):
+        """
+        最初のリクエストが届いてからbatch_window秒待つか、max_batch_size件集まるまでリクエストを集める
+        """
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _consume(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                # 待っている間にタイムアウト・キャンセルされたリクエストは除外する
+                pending = [request for request in batch if not request.future.done()]
+                # ストリーミングのリクエストはまとめずに1件ずつ生成する
+                for request in [request for request in pending if request.partials is not None]:
+                    if request.cancelled.is_set():
+                        self.stats.cancelled += 1
+                        request.partials.put_nowait(_END)
+                        continue
+                    if not self._expire(request):
+                        await self._process_stream(request)
+                pending = [request for request in pending if request.partials is None and not self._expire(request)]
+                if not pending:
+                    continue
+
+                started_at = time.monotonic()
+                for request in pending:
+                    self.stats.record_wait(started_at - request.enqueued_at)
+                self.stats.batch_sizes.append(len(pending))
+
+                texts = [request.text for request in pending]
+                channel_ids = [request.channel_id for request in pending]
+                guild_ids = [request.guild_id for request in pending]
+                try:
+                    results = await self.run(
+                        lambda: self.learner_provider().predict_batch(texts, channel_ids=channel_ids, guild_ids=guild_ids)
+                    )
+                except Exception as e:
+                    self.stats.failed += len(pending)
+                    for request in pending:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+
+                finished_at = time.monotonic()
+                for request, result in zip(pending, results):
+                    self.stats.completed += 1
+                    self.stats.record_latency(finished_at - request.enqueued_at)
+                    if not request.future.done():
+                        request.future.set_result(result)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
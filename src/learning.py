@@ -1,7 +1,29 @@
 import os
-import glob
+import collections
+import json
+import time
+import numpy as np
 from transformers import TFGPT2LMHeadModel, AutoTokenizer
 import tensorflow as tf
+from adapters import AdapterSet, AdapterStore, LoRA, guild_of
+from caches import ChannelContext, ChannelContextCache, ResponseCache
+from backends import create_backend, greedy_next_token
+from config import env_bool, env_float, env_int, env_str
+from corpus import corpus_files
+from dataset import build_packed_dataset
+from lm_trainer import fit_language_model, mixed_precision
+from metrics import METRICS
+from token_cache import TokenCache
+from model_registry import ModelRegistry
+
+# 応答生成に使うモデル・トークナイザー・バージョン・推論バックエンド・ギルドごとのアダプター（使わない場合はNone）の組
+# 差し替えはこの組ごと1回の代入で行う
+ServingModel = collections.namedtuple("ServingModel", ["model", "tokenizer", "version", "backend", "adapters"])
+# アダプターを付けたまま生成できる推論バックエンド（他のバックエンドは変換時の重みで固定される）
+ADAPTER_BACKENDS = ("eager", "xla")
+# 追加学習の再開に使う、モデルと一緒に保存するオプティマイザーの状態と学習済みのメッセージ数
+OPTIMIZER_CHECKPOINT = os.path.join("optimizer", "ckpt")
+TRAINING_STATE_FILE = "training_state.json"
 
 class AILearner:
     """
@@ -9,7 +31,7 @@ class AILearner:
     """
     def __init__(self, model_dir="models"):
         self.model_dir = model_dir
-        self.model_path = os.path.join(self.model_dir, "fine_tuned")
+        self.registry = ModelRegistry(self.model_dir)
 
         wikipedia_base_model_path = "models/wikipedia_base"
         rinna_model_name = "rinna/japanese-gpt2-small"
@@ -23,109 +45,600 @@ class AILearner:
             print("It is recommended to run the Wikipedia pre-training script first for better performance.")
             self.model_name = rinna_model_name
 
-        self.model = None
-        print(f"Initializing tokenizer from {self.model_name}...")
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-        # Add a padding token if it doesn't exist
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+        self.serving = None
+        # 学習用のトークナイザーは最初に使うときに読み込む
+        self._tokenizer = None
+
+        # 同じ質問への応答と、チャンネルごとの会話の途中計算を再利用するためのキャッシュ
+        # どちらも推論スレッドからだけ使う
+        self.response_cache = ResponseCache(
+            max_entries=env_int("AI_KUN_RESPONSE_CACHE_SIZE", 512),
+            ttl=env_float("AI_KUN_RESPONSE_CACHE_TTL", 600.0),
+        )
+        self.use_channel_context = env_bool("AI_KUN_CONTEXT_REUSE", False)
+        self.context_cache = ChannelContextCache(
+            idle_seconds=env_float("AI_KUN_CONTEXT_IDLE_SECONDS", 900.0),
+            memory_budget_bytes=env_int("AI_KUN_CONTEXT_MEMORY_MB", 256) * 1024 * 1024,
+        )
+
+        # 応答生成に使う推論バックエンド（eager / xla / tflite / onnx）
+        self.backend_name = env_str("AI_KUN_BACKEND", "eager")
+        self.backend_options = {}
+        if self.backend_name == "tflite":
+            self.backend_options["quantization"] = env_str("AI_KUN_TFLITE_QUANTIZATION", "int8")
+
+        # ギルドごとの低ランクアダプター（LoRA）。ベースモデルは1つだけ読み込み、メッセージごとに切り替える
+        self.use_adapters = env_bool("AI_KUN_ADAPTERS", False)
+        self.lora_rank = env_int("AI_KUN_LORA_RANK", 8)
+        self.adapter_store = AdapterStore(os.path.join(self.model_dir, "adapters"))
 
         if not os.path.exists(self.model_dir):
             os.makedirs(self.model_dir)
 
-    def fine_tune(self, data_path, epochs=3, batch_size=2):
+        METRICS.collector("learner", self.metrics)
+
+    @property
+    def tokenizer(self):
+        """
+        学習に使うトークナイザー（初回アクセス時に読み込む）
+        """
+        if self._tokenizer is None:
+            print(f"Initializing tokenizer from {self.model_name}...")
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            # Add a padding token if it doesn't exist
+            if tokenizer.pad_token is None:
+                tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+            self._tokenizer = tokenizer
+        return self._tokenizer
+
+    @property
+    def model(self):
+        """
+        応答生成に使っているモデル（未読み込みの場合はNone）
+        """
+        return self.serving.model if self.serving is not None else None
+
+    def fine_tune(self, data_path, epochs=3, batch_size=2, shuffle_buffer_size=10000, callbacks=None,
+                  accumulation_steps=None, use_mixed_precision=None, incremental=False, replay_ratio=None,
+                  adapters=None):
         """
-        指定されたデータでモデルをファインチューニングする
+        指定されたデータでモデルをファインチューニングし、保存したモデルのバージョン名を返す
+        incrementalが真の場合は、現在のモデルとオプティマイザーの状態から学習を再開し、
+        前回の学習以降に追加されたメッセージと、古いメッセージから無作為に選んだ一部（新しいデータのreplay_ratio倍）だけを学習する
+        adaptersが真の場合は、モデル全体ではなくギルドごとのアダプターを学習する（fine_tune_adaptersを参照）
+        accumulation_steps・use_mixed_precision・replay_ratio・adaptersを省略した場合は、環境変数の設定を使う
         """
+        if accumulation_steps is None:
+            accumulation_steps = env_int("AI_KUN_GRAD_ACCUMULATION", 1)
+        if use_mixed_precision is None:
+            use_mixed_precision = env_bool("AI_KUN_MIXED_PRECISION", False)
+        if adapters is None:
+            adapters = self.use_adapters
+        if adapters:
+            return self.fine_tune_adapters(data_path, epochs, batch_size, shuffle_buffer_size, callbacks,
+                                           accumulation_steps, use_mixed_precision)
+        started_at = time.perf_counter()
+        if replay_ratio is None:
+            replay_ratio = env_float("AI_KUN_REPLAY_RATIO", 0.5)
+
         print("Loading and preparing dataset...")
-        text_files = glob.glob(os.path.join(data_path, "*.txt"))
+        text_files = corpus_files(data_path)
         if not text_files:
             print("No data found to train on. Please run 'research' first.")
             return
 
-        full_text = ""
-        for file in text_files:
-            with open(file, "r", encoding="utf-8") as f:
-                full_text += f.read()
+        # 変更のあったファイルだけを複数プロセスでトークン化し、結果はキャッシュから memmap で読み出す
+        block_size = 128  # Max sequence length for the model
+        cache = TokenCache(os.path.join(data_path, ".token_cache"), self.tokenizer)
+        cache.update(text_files)
 
-        tokenized_text = self.tokenizer.encode(full_text)
+        base_path = self.model_name
+        resume_path = None
+        if incremental:
+            resume_path, trained = self._resume_point(data_path, text_files, cache)
+            if resume_path is not None:
+                base_path = resume_path
+            # 会話の途中でブロックを切らないよう、メッセージの境界に沿ってシーケンスに詰める
+            new_ranges = cache.packed_ranges(text_files, block_size, since=trained)
+            old_ranges = cache.packed_ranges(text_files, block_size, until=trained)
+            if not new_ranges:
+                print("No new data since the last checkpoint. Skipping training.")
+                return
+            num_replay = min(len(old_ranges), int(round(len(new_ranges) * replay_ratio)))
+            num_examples = len(new_ranges) + num_replay
+            print(f"Prepared {len(new_ranges)} new training examples and {num_replay} replayed examples.")
 
-        # Create input/output pairs for training
-        examples = []
-        block_size = 128  # Max sequence length for the model
-        for i in range(0, len(tokenized_text) - block_size + 1, block_size):
-            examples.append(tokenized_text[i:i + block_size])
+            def sequences():
+                # 忘却を防ぐための古いデータは、エポックごとに選び直して新しいデータと混ぜる
+                rng = np.random.default_rng()
+                replay = [old_ranges[i] for i in rng.choice(len(old_ranges), num_replay, replace=False)]
+                ranges = new_ranges + replay
+                return cache.iter_ranges([ranges[i] for i in rng.permutation(len(ranges))])
+            use_cache = False
+        else:
+            # 会話の途中でブロックを切らないよう、メッセージの境界に沿ってシーケンスに詰める
+            num_examples = cache.num_sequences(text_files, block_size)
+            if num_examples == 0:
+                print("Not enough text data to create training examples. Need more conversation history.")
+                return
+            num_tokens = cache.num_tokens(text_files)
+            print(f"Prepared {num_examples} training examples ({num_tokens} tokens).")
+
+            def sequences():
+                return cache.iter_packed(text_files, block_size)
+            # 小さなデータセットは1エポック目にメモリへ読み込み、2エポック目以降はそれを使う
+            use_cache = num_tokens * 4 <= env_int("AI_KUN_DATASET_CACHE_MB", 512) * 1024 * 1024
+
+        dataset = build_packed_dataset(
+            sequences,
+            block_size,
+            batch_size,
+            self.tokenizer.pad_token_id,
+            shuffle_buffer_size=min(num_examples, shuffle_buffer_size),
+            cache=use_cache,
+        )
+
+        print(f"Loading model from {base_path}...")
+        with mixed_precision(use_mixed_precision):
+            model = TFGPT2LMHeadModel.from_pretrained(base_path)
+            model.resize_token_embeddings(len(self.tokenizer))
+            optimizer = tf.keras.optimizers.Adam(learning_rate=5e-5)
+            if resume_path is not None:
+                optimizer = self._restore_optimizer(optimizer, model, resume_path)
+
+            print(f"Starting fine-tuning for {epochs} epochs (batch size {batch_size} x {accumulation_steps} accumulation steps)...")
+            fit_language_model(model, dataset, epochs, accumulation_steps=accumulation_steps, callbacks=callbacks,
+                               optimizer=optimizer)
+
+        print("Fine-tuning finished. Saving model...")
+        # 次の追加学習が続きから始められるよう、学習に使ったメッセージ数も保存する
+        training_state = {
+            "data_path": os.path.abspath(data_path),
+            "messages": {os.path.basename(file): cache.num_messages(file) for file in text_files},
+        }
+        version = self.save_model(model, optimizer=optimizer, training_state=training_state)
+        METRICS.observe("fine_tune_seconds", time.perf_counter() - started_at, mode="incremental" if incremental else "full")
+        return version
 
-        if not examples:
-            print("Not enough text data to create training examples. Need more conversation history.")
+    def fine_tune_adapters(self, data_path, epochs=3, batch_size=2, shuffle_buffer_size=10000, callbacks=None,
+                           accumulation_steps=1, use_mixed_precision=False):
+        """
+        ベースモデルの重みを固定し、ギルドごとに低ランクのアダプター（LoRA）だけを学習して保存する
+        ベースモデルは現在のバージョン（なければ元のモデルを最初のバージョンとして保存したもの）で、そのバージョン名を返す
+        前回の学習からデータが増えていないギルドは学習し直さない
+        """
+        started_at = time.perf_counter()
+        print("Loading and preparing dataset...")
+        text_files = corpus_files(data_path)
+        files_by_guild = collections.defaultdict(list)
+        for file in text_files:
+            guild_id = guild_of(file)
+            if guild_id is None:
+                print(f"Skipping {file}: no guild ID in the file name.")
+                continue
+            files_by_guild[guild_id].append(file)
+        if not files_by_guild:
+            print("No data found to train on. Please run 'research' first.")
             return
 
-        inputs, labels = [], []
-        for ex in examples:
-            inputs.append(ex[:-1])
-            labels.append(ex[1:])
+        block_size = 128  # Max sequence length for the model
+        cache = TokenCache(os.path.join(data_path, ".token_cache"), self.tokenizer)
+        cache.update(text_files)
 
-        dataset = tf.data.Dataset.from_tensor_slices((inputs, labels))
-        dataset = dataset.shuffle(len(examples)).batch(batch_size, drop_remainder=True)
+        base_version = self.registry.current()
+        with mixed_precision(use_mixed_precision):
+            if base_version is None:
+                # アダプターはどれも同じベースモデルに対して学習するので、元のモデルを最初のバージョンとして保存しておく
+                print(f"No fine-tuned model found. Saving {self.model_name} as the base model for adapters...")
+                model = TFGPT2LMHeadModel.from_pretrained(self.model_name)
+                model.resize_token_embeddings(len(self.tokenizer))
+                base_version = self.save_model(model)
+            else:
+                model = TFGPT2LMHeadModel.from_pretrained(self.registry.path(base_version))
+            lora = LoRA(model, rank=self.lora_rank)
 
-        print("Loading pre-trained model...")
-        model = TFGPT2LMHeadModel.from_pretrained(self.model_name)
-        model.resize_token_embeddings(len(self.tokenizer))
+            for guild_id, files in sorted(files_by_guild.items()):
+                messages = {os.path.basename(file): cache.num_messages(file) for file in files}
+                meta = self.adapter_store.meta(guild_id)
+                if meta is not None and meta.get("base_version") == base_version and meta.get("rank") == lora.rank \
+                        and meta.get("messages") == messages:
+                    print(f"Adapter for guild {guild_id} is up to date.")
+                    continue
+                num_examples = cache.num_sequences(files, block_size)
+                if num_examples == 0:
+                    print(f"Not enough data to train an adapter for guild {guild_id}.")
+                    continue
 
-        optimizer = tf.keras.optimizers.Adam(learning_rate=5e-5)
-        loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
-        model.compile(optimizer=optimizer, loss=loss)
+                dataset = build_packed_dataset(
+                    lambda files=files: cache.iter_packed(files, block_size),
+                    block_size,
+                    batch_size,
+                    self.tokenizer.pad_token_id,
+                    shuffle_buffer_size=min(num_examples, shuffle_buffer_size),
+                )
+                print(f"Training adapter for guild {guild_id} on {num_examples} examples for {epochs} epochs...")
+                lora.reset()
+                fit_language_model(model, dataset, epochs, learning_rate=2e-4, accumulation_steps=accumulation_steps,
+                                   callbacks=callbacks, variables=lora.variables)
+                self.adapter_store.save(guild_id, lora.get_weights(), {
+                    "base_version": base_version,
+                    "rank": lora.rank,
+                    "alpha": lora.alpha,
+                    "messages": messages,
+                })
+                print(f"Adapter for guild {guild_id} saved to {self.adapter_store.path(guild_id)}")
+        METRICS.observe("fine_tune_seconds", time.perf_counter() - started_at, mode="adapters")
+        return base_version
 
-        print(f"Starting fine-tuning for {epochs} epochs...")
-        model.fit(dataset, epochs=epochs)
+    def _resume_point(self, data_path, files, cache):
+        """
+        追加学習を始めるモデルのパスと、ファイルごとの学習済みのメッセージ数を返す
+        学習済みのモデルがない場合はパスにNoneを返し、すべてのメッセージを新しいデータとして扱う
+        """
+        version = self.registry.current()
+        if version is None:
+            print("No fine-tuned model found. Training from the base model on all data.")
+            return None, {}
+        path = self.registry.path(version)
+        try:
+            with open(os.path.join(path, TRAINING_STATE_FILE), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        trained = {}
+        if state.get("data_path") == os.path.abspath(data_path):
+            for file in files:
+                count = state["messages"].get(os.path.basename(file), 0)
+                # 件数が減ったファイルは作り直されたとみなし、すべて新しいデータとして扱う
+                trained[file] = count if count <= cache.num_messages(file) else 0
+        else:
+            print(f"Model version {version} has no training record for {data_path}; all messages are treated as new.")
+        print(f"Resuming from model version {version}.")
+        return path, trained
 
-        print("Fine-tuning finished. Saving model...")
-        self.save_model(model)
+    @staticmethod
+    def _restore_optimizer(optimizer, model, path):
+        """
+        保存されたオプティマイザーの状態（モーメントと更新回数）を読み込む。読み込めない場合は新しい状態で始める
+        """
+        checkpoint_path = os.path.join(path, OPTIMIZER_CHECKPOINT)
+        if not tf.io.gfile.exists(checkpoint_path + ".index"):
+            print("No saved optimizer state found. Starting with a fresh optimizer.")
+            return optimizer
+        try:
+            optimizer.build(model.trainable_variables)
+            tf.train.Checkpoint(optimizer=optimizer).read(checkpoint_path).assert_existing_objects_matched()
+        except (AssertionError, ValueError, tf.errors.OpError) as e:
+            print(f"[WARNING] Could not restore optimizer state: {e}. Starting with a fresh optimizer.")
+            return tf.keras.optimizers.Adam(learning_rate=5e-5)
+        print(f"Restored optimizer state ({int(optimizer.iterations)} steps).")
+        return optimizer
 
-    def predict(self, text, max_length=50):
+    def predict(self, text, max_length=50, channel_id=None, guild_id=None):
         """
         入力テキストに対して応答を生成する
         """
-        if self.model is None:
+        return self.predict_batch([text], max_length=max_length, channel_ids=[channel_id], guild_ids=[guild_id])[0]
+
+    def predict_batch(self, texts, max_length=50, channel_ids=None, guild_ids=None):
+        """
+        複数の入力テキストを左パディングして1回の生成でまとめて応答を生成する
+        各入力の結果は、単独でpredictした場合と同じ長さで切り詰めて返す
+        会話コンテキストの再利用が有効な場合、チャンネルIDが指定された入力はそのチャンネルの会話の続きとして生成する
+        アダプターを使う場合は、同じギルドの入力ごとにまとめて、そのギルドのアダプターで生成する
+        """
+        started_at = time.perf_counter()
+        if self.serving is None:
             self.load_model()
 
-        if self.model is None:
-            return "モデルが読み込まれていません。先に 'learning' コマンドを実行してください。"
+        # 生成中にモデルが差し替えられても、この呼び出しの間は同じ組を使い続ける
+        serving = self.serving
+        if serving is None:
+            return ["モデルが読み込まれていません。先に 'learning' コマンドを実行してください。"] * len(texts)
+
+        channel_ids = channel_ids or [None] * len(texts)
+        guild_ids = guild_ids or [None] * len(texts)
+        results = [None] * len(texts)
+        uncached = collections.defaultdict(list)
+        for i, (text, channel_id, guild_id) in enumerate(zip(texts, channel_ids, guild_ids)):
+            if self.use_channel_context and channel_id is not None:
+                results[i] = self._generate_in_context(serving, channel_id, text, max_length, guild_id)
+                continue
+            results[i] = self.response_cache.get(text, self._cache_version(serving, guild_id))
+            if results[i] is None:
+                uncached[guild_id].append(i)
+
+        for guild_id, indices in uncached.items():
+            version = self._activate_adapter(serving, guild_id)
+            generated = self._generate_batch(serving, [texts[i] for i in indices], max_length)
+            for i, response in zip(indices, generated):
+                results[i] = response
+                self.response_cache.put(texts[i], version, response)
+        METRICS.observe("predict_seconds", time.perf_counter() - started_at)
+        METRICS.inc("predict_requests_total", len(texts))
+        return results
 
-        input_ids = self.tokenizer.encode(text, return_tensors='tf')
+    @staticmethod
+    def _cache_version(serving, guild_id):
+        """
+        キャッシュのキーに使うバージョン（アダプターを使う場合は、ギルドのアダプターも区別する）
+        """
+        key = serving.adapters.key(guild_id) if serving.adapters is not None else None
+        return serving.version if key is None else f"{serving.version}+{key}"
+
+    @staticmethod
+    def _activate_adapter(serving, guild_id):
+        """
+        guild_idのアダプターを有効にし、キャッシュのキーに使うバージョンを返す（推論スレッドから呼ぶ）
+        """
+        key = serving.adapters.activate(guild_id) if serving.adapters is not None else None
+        return serving.version if key is None else f"{serving.version}+{key}"
+
+    def cache_stats(self):
+        """
+        応答キャッシュと会話コンテキストのヒット率などを返す
+        """
+        return {"response_cache": self.response_cache.stats(), "context_cache": self.context_cache.stats()}
+
+    def metrics(self):
+        """
+        メトリクスとして出力するキャッシュの状態（METRICSのcollector）
+        """
+        stats = self.cache_stats()
+        return {
+            "cache_hits": {(("cache", name),): cache["hits"] for name, cache in stats.items()},
+            "cache_misses": {(("cache", name),): cache["misses"] for name, cache in stats.items()},
+            "cache_hit_rate": {(("cache", name),): cache["hit_rate"] for name, cache in stats.items()},
+            "response_cache_entries": stats["response_cache"]["entries"],
+            "context_cache_bytes": stats["context_cache"]["bytes"],
+            "context_cache_channels": stats["context_cache"]["channels"],
+        }
+
+    def predict_stream(self, text, max_length=50, channel_id=None, cancelled=None, guild_id=None):
+        """
+        応答を1トークンずつ生成し、その時点までの応答テキストを順に返すジェネレーター
+        最後に返すテキストはpredictの結果と同じになる
+        cancelled（threading.Event）がセットされると、その時点で生成をやめる
+        """
+        if self.serving is None:
+            self.load_model()
+
+        serving = self.serving
+        if serving is None:
+            yield "モデルが読み込まれていません。先に 'learning' コマンドを実行してください。"
+            return
+
+        use_context = self.use_channel_context and channel_id is not None
+        if use_context:
+            steps = self._iter_in_context(serving, channel_id, text, max_length, cancelled, guild_id)
+        else:
+            cached = self.response_cache.get(text, self._cache_version(serving, guild_id))
+            if cached is not None:
+                yield cached
+                return
+            version = self._activate_adapter(serving, guild_id)
+            steps = self._iter_fresh(serving, text, max_length, cancelled)
+
+        started_at = time.perf_counter()
+        first = True
+        generated, response = [], None
+        for generated, response in steps:
+            # プロンプトだけの途中結果は返さず、最初のトークンが生成されてから返す
+            if generated:
+                if first:
+                    METRICS.observe("stream_first_token_seconds", time.perf_counter() - started_at)
+                    first = False
+                yield response
+        if cancelled is not None and cancelled.is_set():
+            return
+        if not generated:
+            yield response
+        if not use_context:
+            self.response_cache.put(text, version, response)
+
+    def _iter_fresh(self, serving, text, max_length, cancelled=None):
+        """
+        会話コンテキストを使わずに、1トークンずつ応答を生成する
+        """
+        tokenizer = serving.tokenizer
+        started_at = time.perf_counter()
+        new_ids = tokenizer.encode(text)
+        METRICS.observe("generate_stage_seconds", time.perf_counter() - started_at, stage="encode")
+        budget = max(max_length - len(new_ids), 0)
+        steps = self._decode_steps(serving.model, tokenizer.eos_token_id, new_ids, None, budget, cancelled)
+        for generated, _, response in self._timed_decode(tokenizer, new_ids, steps):
+            yield generated, response
+
+    def _generate_in_context(self, serving, channel_id, text, max_length, guild_id=None):
+        """
+        チャンネルの会話の続きとして応答を生成する
+        """
+        response = None
+        for _, response in self._iter_in_context(serving, channel_id, text, max_length, guild_id=guild_id):
+            pass
+        return response
+
+    def _iter_in_context(self, serving, channel_id, text, max_length, cancelled=None, guild_id=None):
+        """
+        チャンネルの会話の続きとして、1トークンずつ応答を生成する
+        前回までの会話はpast_key_valuesとして保持しているので、新しい発言のトークンだけをモデルに通す
+        past_key_valuesを扱うため、推論バックエンドの設定にかかわらずTensorFlowのモデルを直接使う
+        """
+        model, tokenizer = serving.model, serving.tokenizer
+        started_at = time.perf_counter()
+        new_ids = tokenizer.encode(text)
+        METRICS.observe("generate_stage_seconds", time.perf_counter() - started_at, stage="encode")
+        budget = max(max_length - len(new_ids), 0)
+
+        version = self._activate_adapter(serving, guild_id)
+        context = self.context_cache.get(channel_id, version)
+        # モデルが扱える長さを超える場合は、会話を最初からやり直す
+        if context is not None and len(context.tokens) + len(new_ids) + budget > model.config.n_positions:
+            context = None
+        tokens = list(context.tokens) if context is not None else []
+        past = context.past if context is not None else None
+
+        generated = []
+        steps = self._decode_steps(model, tokenizer.eos_token_id, new_ids, past, budget, cancelled)
+        for generated, past, response in self._timed_decode(tokenizer, new_ids, steps):
+            yield generated, response
+
+        # 中断した生成は会話に含めず、以前のコンテキストをそのまま残す
+        if cancelled is not None and cancelled.is_set():
+            return
+        tokens += new_ids + generated
+        nbytes = sum(t.shape.num_elements() * t.dtype.size for t in tf.nest.flatten(past))
+        self.context_cache.put(channel_id, ChannelContext(tokens, past, nbytes, version))
+
+    @staticmethod
+    def _timed_decode(tokenizer, new_ids, steps):
+        """
+        _decode_stepsの各ステップを (生成したトークン列, past_key_values, 応答テキスト) にして返す
+        モデルによる生成とデコードにかかった時間は、それぞれ合計して生成の終わりに記録する（途中で打ち切った場合も含む）
+        """
+        generate_seconds = decode_seconds = 0.0
+        try:
+            while True:
+                started_at = time.perf_counter()
+                try:
+                    generated, past = next(steps)
+                except StopIteration:
+                    return
+                generated_at = time.perf_counter()
+                response = tokenizer.decode(new_ids + generated, skip_special_tokens=True)
+                generate_seconds += generated_at - started_at
+                decode_seconds += time.perf_counter() - generated_at
+                yield generated, past, response
+        finally:
+            METRICS.observe("generate_stage_seconds", generate_seconds, stage="generate")
+            METRICS.observe("generate_stage_seconds", decode_seconds, stage="decode")
+
+    def _decode_steps(self, model, eos_token_id, new_ids, past, budget, cancelled=None):
+        """
+        new_idsをモデルに通した後、1トークンずつ貪欲に生成する
+        生成したトークン列と、それまでを反映したpast_key_valuesの組を、プロンプトの直後と1トークンごとに返す
+        """
+        logits, past = self._forward(model, new_ids, past)
+        generated = []
+        yield generated, past
+        for _ in range(budget):
+            if cancelled is not None and cancelled.is_set():
+                return
+            next_id = greedy_next_token(logits, new_ids + generated, no_repeat_ngram_size=2)
+            if next_id == eos_token_id:
+                return
+            generated = generated + [next_id]
+            logits, past = self._forward(model, [next_id], past)
+            yield generated, past
+
+    @staticmethod
+    def _forward(model, ids, past):
+        outputs = model(tf.constant([ids], dtype=tf.int32), past_key_values=past, use_cache=True)
+        return outputs.logits[0, -1].numpy(), outputs.past_key_values
+
+    def _generate_batch(self, serving, texts, max_length):
+        tokenizer = serving.tokenizer
+        started_at = time.perf_counter()
+        encoded = [tokenizer.encode(text) for text in texts]
+        lengths = [len(ids) for ids in encoded]
+        padded_length = max(lengths)
+
+        # 生成はプロンプトの右側に続くため、パディングは左側に入れる
+        pad_id = tokenizer.pad_token_id
+        input_ids = [[pad_id] * (padded_length - len(ids)) + ids for ids in encoded]
+        attention_mask = [[0] * (padded_length - len(ids)) + [1] * len(ids) for ids in encoded]
+
+        # 各入力の生成トークン数は max_length から自身の長さを引いたもの
+        budgets = [max(max_length - length, 0) for length in lengths]
+
+        encoded_at = time.perf_counter()
+        METRICS.observe("generate_stage_seconds", encoded_at - started_at, stage="encode")
 
         # モデルによる応答生成
-        output_sequences = self.model.generate(
-            input_ids=input_ids,
-            max_length=max_length,
-            num_return_sequences=1,
-            no_repeat_ngram_size=2,
-            early_stopping=True,
-            pad_token_id=self.tokenizer.pad_token_id,
-            eos_token_id=self.tokenizer.eos_token_id,
+        output_sequences = serving.backend.generate(
+            np.array(input_ids, dtype=np.int32),
+            np.array(attention_mask, dtype=np.int32),
+            max_new_tokens=max(max(budgets), 1),
         )
+        generated_at = time.perf_counter()
+        METRICS.observe("generate_stage_seconds", generated_at - encoded_at, stage="generate")
+        METRICS.observe("generate_batch_size", len(texts), buckets=(1, 2, 4, 8, 16, 32))
 
         # 生成されたテキストのデコード
-        generated_text = self.tokenizer.decode(output_sequences[0], skip_special_tokens=True)
+        responses = [
+            tokenizer.decode(sequence[:padded_length + budget], skip_special_tokens=True)
+            for sequence, budget in zip(output_sequences, budgets)
+        ]
+        METRICS.observe("generate_stage_seconds", time.perf_counter() - generated_at, stage="decode")
+        return responses
 
-        return generated_text
-
-    def load_model(self):
+    def load_model(self, version=None):
         """
-        学習済みモデルを読み込む
+        学習済みモデルを読み込み、ウォームアップしてから応答生成用のモデルと差し替える
+        読み込み中も、差し替えるまでは以前のモデルで応答を続けられる
         """
-        print(f"Loading model from {self.model_path}")
-        if os.path.exists(self.model_path):
-            self.model = TFGPT2LMHeadModel.from_pretrained(self.model_path)
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-            print("Model loaded successfully.")
-        else:
+        version = version or self.registry.current()
+        if version is None:
             print("No fine-tuned model found. Please run 'learning' first.")
+            return False
+        if self.serving is not None and self.serving.version == version:
+            print(f"Model version {version} is already loaded.")
+            if self.serving.adapters is not None:
+                # アダプターだけを学習し直した場合は、ベースモデルはそのままでアダプターを読み直す
+                print(f"Reloaded {self.serving.adapters.refresh()} guild adapter(s).")
+            return True
+
+        path = self.registry.path(version)
+        print(f"Loading model version {version} from {path}")
+        started_at = time.perf_counter()
+        model = TFGPT2LMHeadModel.from_pretrained(path)
+        tokenizer = AutoTokenizer.from_pretrained(path)
+        adapters = None
+        if self.use_adapters:
+            if self.backend_name in ADAPTER_BACKENDS:
+                adapters = AdapterSet(LoRA(model, rank=self.lora_rank), self.adapter_store, version)
+                print(f"Loaded {adapters.refresh()} guild adapter(s) for model version {version}.")
+            else:
+                print(f"[WARNING] Guild adapters are not supported by the {self.backend_name} backend; using the base model only.")
+        backend = create_backend(self.backend_name, model, tokenizer, path, **self.backend_options)
+        serving = ServingModel(model, tokenizer, version, backend, adapters)
+
+        # 最初の応答でグラフ構築の時間がかからないよう、ダミーの入力で一度生成しておく
+        self._generate_batch(serving, ["こんにちは"], max_length=8)
+
+        self.serving = serving
+        METRICS.observe("model_load_seconds", time.perf_counter() - started_at)
+        METRICS.set("model_weights_bytes", sum(w.shape.num_elements() * w.dtype.size for w in model.weights))
+        print(f"Model version {version} loaded successfully ({backend.name} backend).")
+        return True
+
+    def rollback_model(self):
+        """
+        1つ前のバージョンのモデルに戻す。戻せた場合はそのバージョン名を返す
+        """
+        version = self.registry.rollback()
+        if version is None:
+            print("No previous model version to roll back to.")
+            return None
+        self.load_model(version)
+        return version
 
-    def save_model(self, model):
+    def save_model(self, model, optimizer=None, training_state=None):
         """
-        モデルを保存する
+        モデルを新しいバージョンとして保存し、現在のバージョンにする
+        optimizerとtraining_stateを渡した場合は、追加学習の再開に使えるよう一緒に保存する
         """
-        model.save_pretrained(self.model_path)
-        self.tokenizer.save_pretrained(self.model_path)
-        print(f"Model saved to {self.model_path}")
\ No newline at end of file
+        version, path = self.registry.new_version()
+        # 書きかけのディレクトリを読み込まないよう、一時ディレクトリに保存してから名前を変える
+        tmp_path = path + ".tmp"
+        model.save_pretrained(tmp_path)
+        self.tokenizer.save_pretrained(tmp_path)
+        if optimizer is not None:
+            tf.train.Checkpoint(optimizer=optimizer).write(os.path.join(tmp_path, OPTIMIZER_CHECKPOINT))
+        if training_state is not None:
+            with open(os.path.join(tmp_path, TRAINING_STATE_FILE), "w", encoding="utf-8") as f:
+                json.dump(training_state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+        self.registry.publish(version)
+        print(f"Model saved to {path} (version {version})")
+        return version
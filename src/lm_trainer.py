@@ -0,0 +1,221 @@
+import contextlib
+import os
+import shutil
+import time
+
+import tensorflow as tf
+
+
+@contextlib.contextmanager
+def mixed_precision(enabled):
+    """
+    有効な場合、このブロックの中で作成したモデルをbfloat16で計算させる（重みはfloat32のまま保持する）
+    bfloat16はCPUでも使え、float16と違って損失のスケーリングが要らない
+    """
+    if not enabled:
+        yield
+        return
+    previous = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+    try:
+        yield
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous)
+
+
+def is_chief(task_type, task_id, cluster=None):
+    """
+    マルチワーカー学習で、このタスクがチーフ（ログの出力・モデルの保存・共有ファイルの書き出しを受け持つ）かを返す
+    クラスタに "chief" のタスクがない場合は、worker 0 をチーフとして扱う
+    cluster には、ジョブ名をキーとするクラスタの定義（TF_CONFIGの "cluster" など）を渡す
+    """
+    if task_type is None or task_type == "chief":
+        return True
+    return task_type == "worker" and task_id == 0 and "chief" not in (cluster or {})
+
+
+def fit_language_model(model, dataset, epochs, learning_rate=5e-5, accumulation_steps=1, callbacks=None,
+                       optimizer=None, variables=None, log_every=100):
+    """
+    (inputs, labels, sample_weight) のバッチを返すdatasetで言語モデルを学習する
+    accumulation_stepsバッチ分の勾配を平均してから1回更新し、バッチサイズを増やさずに実効バッチサイズを大きくする
+    エポックごとの損失・処理したトークン数・トークン/秒・所要時間を表示し、callbacksのon_epoch_endにも渡す
+    variablesを指定した場合はそれだけを更新し、モデルの他の重みは固定する
+    """
+    optimizer = optimizer or tf.keras.optimizers.Adam(learning_rate=learning_rate)
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+    variables = variables if variables is not None else model.trainable_variables
+    accumulation_steps = max(1, accumulation_steps)
+    accumulated = None
+    if accumulation_steps > 1:
+        accumulated = [tf.Variable(tf.zeros_like(v), trainable=False) for v in variables]
+
+    batch_spec = (
+        tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+        tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+        tf.TensorSpec(shape=(None, None), dtype=tf.float32),
+    )
+
+    def compute_gradients(inputs, labels, weights):
+        with tf.GradientTape() as tape:
+            logits = model(inputs, training=True).logits
+            losses = loss_fn(labels, tf.cast(logits, tf.float32))
+            tokens = tf.reduce_sum(weights)
+            loss = tf.reduce_sum(losses * weights) / tf.maximum(tokens, 1.0)
+        gradients = tape.gradient(loss, variables)
+        gradients = [tf.zeros_like(v) if g is None else tf.convert_to_tensor(g) for g, v in zip(gradients, variables)]
+        return loss, tokens, gradients
+
+    @tf.function(input_signature=batch_spec)
+    def train_step(inputs, labels, weights):
+        loss, tokens, gradients = compute_gradients(inputs, labels, weights)
+        optimizer.apply_gradients(zip(gradients, variables))
+        return loss, tokens
+
+    @tf.function(input_signature=batch_spec)
+    def accumulate_step(inputs, labels, weights):
+        loss, tokens, gradients = compute_gradients(inputs, labels, weights)
+        for total, gradient in zip(accumulated, gradients):
+            total.assign_add(gradient / accumulation_steps)
+        return loss, tokens
+
+    @tf.function
+    def apply_accumulated():
+        optimizer.apply_gradients(zip([total.read_value() for total in accumulated], variables))
+        for total in accumulated:
+            total.assign(tf.zeros_like(total))
+
+    callbacks = tf.keras.callbacks.CallbackList(callbacks, model=model)
+    callbacks.on_train_begin()
+    history = []
+    for epoch in range(epochs):
+        callbacks.on_epoch_begin(epoch)
+        started_at = time.perf_counter()
+        total_loss = total_tokens = 0.0
+        steps = 0
+        for inputs, labels, weights in dataset:
+            if accumulated is None:
+                loss, tokens = train_step(inputs, labels, weights)
+            else:
+                loss, tokens = accumulate_step(inputs, labels, weights)
+                if (steps + 1) % accumulation_steps == 0:
+                    apply_accumulated()
+            tokens = float(tokens)
+            total_loss += float(loss) * tokens
+            total_tokens += tokens
+            steps += 1
+            if log_every and steps % log_every == 0:
+                elapsed = time.perf_counter() - started_at
+                print(f"  step {steps}: loss={total_loss / max(total_tokens, 1):.4f} tokens/sec={total_tokens / elapsed:.0f}")
+        # エポックの終わりに残った勾配も反映する
+        if accumulated is not None and steps % accumulation_steps:
+            apply_accumulated()
+
+        elapsed = time.perf_counter() - started_at
+        logs = {
+            "loss": total_loss / max(total_tokens, 1),
+            "steps": steps,
+            "tokens": int(total_tokens),
+            "tokens_per_sec": total_tokens / elapsed if elapsed > 0 else 0.0,
+            "epoch_time": elapsed,
+        }
+        print(
+            f"Epoch {epoch + 1}/{epochs}: loss={logs['loss']:.4f} tokens={logs['tokens']} "
+            f"tokens/sec={logs['tokens_per_sec']:.0f} time={elapsed:.1f}s"
+        )
+        history.append(logs)
+        callbacks.on_epoch_end(epoch, logs)
+    callbacks.on_train_end()
+    return history
+
+
+def fit_language_model_distributed(strategy, model, dataset_fn, epochs, steps_per_epoch, checkpoint_dir,
+                                   learning_rate=5e-5, checkpoint_every=1000, callbacks=None, log_every=100):
+    """
+    tf.distribute の strategy で言語モデルを学習する（model は strategy.scope() の中で作成しておく）
+    dataset_fn は InputContext を受け取り、そのワーカーの (inputs, labels, sample_weight) のバッチを終わりなく返すdatasetを作る関数
+    各ワーカーの処理するステップ数をそろえるため、エポックは steps_per_epoch ステップで区切る
+    checkpoint_every ステップとエポックの終わりにモデルとオプティマイザーの状態を checkpoint_dir に保存し、
+    保存済みのチェックポイントがあれば、そのステップの続きから再開する
+    """
+    with strategy.scope():
+        optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+        variables = model.trainable_variables
+        optimizer.build(variables)
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction=tf.keras.losses.Reduction.NONE)
+
+    # チェックポイントはすべてのワーカーで保存する必要があるが、残すのはチーフの分だけにする
+    resolver = getattr(strategy, "cluster_resolver", None)
+    task_type = resolver.task_type if resolver is not None else None
+    task_id = resolver.task_id if resolver is not None else None
+    chief = is_chief(task_type, task_id, resolver.cluster_spec().as_dict() if resolver is not None else None)
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
+    save_dir = checkpoint_dir if chief else os.path.join(checkpoint_dir, f"{task_type}_{task_id}")
+    manager = tf.train.CheckpointManager(checkpoint, save_dir, max_to_keep=2)
+    latest = tf.train.latest_checkpoint(checkpoint_dir)
+    if latest is not None:
+        checkpoint.restore(latest)
+        if chief:
+            print(f"Resuming from {latest} (step {int(optimizer.iterations.numpy())}).")
+
+    def step_fn(inputs, labels, weights):
+        # トークン数で重み付けした平均になるよう、全レプリカのトークン数で割る（勾配はレプリカ間で合計される）
+        tokens = tf.reduce_sum(weights)
+        global_tokens = tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, tokens)
+        with tf.GradientTape() as tape:
+            logits = model(inputs, training=True).logits
+            loss_sum = tf.reduce_sum(loss_fn(labels, tf.cast(logits, tf.float32)) * weights)
+            loss = loss_sum / tf.maximum(global_tokens, 1.0)
+        gradients = tape.gradient(loss, variables)
+        gradients = [tf.zeros_like(v) if g is None else tf.convert_to_tensor(g) for g, v in zip(gradients, variables)]
+        optimizer.apply_gradients(zip(gradients, variables))
+        return loss_sum, tokens
+
+    @tf.function
+    def train_step(iterator):
+        loss_sum, tokens = strategy.run(step_fn, args=next(iterator))
+        return (strategy.reduce(tf.distribute.ReduceOp.SUM, loss_sum, axis=None),
+                strategy.reduce(tf.distribute.ReduceOp.SUM, tokens, axis=None))
+
+    iterator = iter(strategy.distribute_datasets_from_function(dataset_fn))
+    callbacks = tf.keras.callbacks.CallbackList(callbacks, model=model)
+    callbacks.on_train_begin()
+    history = []
+    completed = int(optimizer.iterations.numpy())
+    for epoch in range(completed // steps_per_epoch, epochs):
+        callbacks.on_epoch_begin(epoch)
+        started_at = time.perf_counter()
+        total_loss = total_tokens = 0.0
+        steps = 0
+        for step in range(completed - epoch * steps_per_epoch, steps_per_epoch):
+            loss_sum, tokens = train_step(iterator)
+            total_loss += float(loss_sum)
+            total_tokens += float(tokens)
+            steps += 1
+            completed = epoch * steps_per_epoch + step + 1
+            if chief and log_every and steps % log_every == 0:
+                elapsed = time.perf_counter() - started_at
+                print(f"  step {completed}: loss={total_loss / max(total_tokens, 1):.4f} tokens/sec={total_tokens / elapsed:.0f}")
+            if checkpoint_every and completed % checkpoint_every == 0 and step + 1 < steps_per_epoch:
+                manager.save(checkpoint_number=completed)
+        manager.save(checkpoint_number=completed)
+
+        elapsed = time.perf_counter() - started_at
+        logs = {
+            "loss": total_loss / max(total_tokens, 1),
+            "steps": steps,
+            "tokens": int(total_tokens),
+            "tokens_per_sec": total_tokens / elapsed if elapsed > 0 else 0.0,
+            "epoch_time": elapsed,
+        }
+        if chief:
+            print(
+                f"Epoch {epoch + 1}/{epochs}: loss={logs['loss']:.4f} tokens={logs['tokens']} "
+                f"tokens/sec={logs['tokens_per_sec']:.0f} time={elapsed:.1f}s ({strategy.num_replicas_in_sync} replica(s))"
+            )
+        history.append(logs)
+        callbacks.on_epoch_end(epoch, logs)
+    callbacks.on_train_end()
+    if not chief:
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return history
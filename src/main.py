@@ -1,15 +1,47 @@
 import os
 import sys
 import asyncio
-from dotenv import load_dotenv
 
 # --- Dependency Checker ---
+import hashlib
+import json
+import re
 import subprocess
-try:
-    import pkg_resources
-except ImportError:
-    print("[ERROR] Package 'setuptools' is not installed. Please install it using: pip install setuptools")
-    sys.exit(1)
+from importlib import metadata
+
+# 依存関係のチェック結果を保存するファイル。requirements.txtが変わるまで再チェックしない
+DEPENDENCY_CHECK_CACHE = '.dependency_check.json'
+
+
+def _requirements_fingerprint(requirements_text):
+    return hashlib.sha256((sys.executable + "\n" + requirements_text).encode('utf-8')).hexdigest()
+
+
+def _find_unsatisfied(requirements):
+    """
+    インストールされていない、またはバージョンが合わないパッケージの一覧を返す
+    """
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        Requirement = None
+
+    problems = []
+    for line in requirements:
+        if Requirement is not None:
+            requirement = Requirement(line)
+            name, specifier = requirement.name, requirement.specifier
+        else:
+            name, specifier = re.split(r"[<>=!~;\[\s]", line, maxsplit=1)[0], None
+        try:
+            installed = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            problems.append(f"{name} is not installed")
+            continue
+        if specifier and not specifier.contains(installed, prereleases=True):
+            problems.append(f"{name} {installed} does not satisfy {specifier}")
+    return problems
+
 
 def check_and_install_dependencies():
     """
@@ -18,42 +50,64 @@ def check_and_install_dependencies():
     """
     try:
         with open('requirements.txt', 'r', encoding='utf-8') as f:
-            requirements = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            requirements_text = f.read()
     except FileNotFoundError:
         print("[ERROR] requirements.txt not found. Please ensure it's in the project's root directory.")
         sys.exit(1)
+    requirements = [line.strip() for line in requirements_text.splitlines() if line.strip() and not line.startswith('#')]
 
-    print("Checking for required packages...")
+    fingerprint = _requirements_fingerprint(requirements_text)
     try:
-        pkg_resources.require(requirements)
+        with open(DEPENDENCY_CHECK_CACHE, 'r', encoding='utf-8') as f:
+            if json.load(f).get("fingerprint") == fingerprint:
+                return
+    except (FileNotFoundError, ValueError):
+        pass
+
+    print("Checking for required packages...")
+    problems = _find_unsatisfied(requirements)
+    if not problems:
         print("All required packages are already installed.")
-    except (pkg_resources.DistributionNotFound, pkg_resources.VersionConflict) as e:
-        print(f"[WARNING] A package is missing or has a version conflict: {e}")
-        print("Attempting to install/update packages from requirements.txt...")
-        try:
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
-            print("\nPackages installed successfully.")
-            print("Please restart the application for the changes to take effect.")
-            sys.exit(0)
-        except subprocess.CalledProcessError as install_error:
-            print(f"\n[ERROR] Failed to install packages: {install_error}")
-            print("Please try running the following command manually in your terminal:")
-            print("    pip install -r requirements.txt")
-            sys.exit(1)
+        with open(DEPENDENCY_CHECK_CACHE, 'w', encoding='utf-8') as f:
+            json.dump({"fingerprint": fingerprint}, f)
+        return
+
+    print(f"[WARNING] A package is missing or has a version conflict: {'; '.join(problems)}")
+    print("Attempting to install/update packages from requirements.txt...")
+    try:
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
+        print("\nPackages installed successfully.")
+        print("Please restart the application for the changes to take effect.")
+        sys.exit(0)
+    except subprocess.CalledProcessError as install_error:
+        print(f"\n[ERROR] Failed to install packages: {install_error}")
+        print("Please try running the following command manually in your terminal:")
+        print("    pip install -r requirements.txt")
+        sys.exit(1)
 
 # --- End of Dependency Checker ---
 
 
-from bot import AIKunBot
-from learning import AILearner
+def make_intents():
+    """
+    ボットに必要なインテントを作成する
+    """
+    import discord
+
+    intents = discord.Intents.default()
+    intents.messages = True
+    intents.guilds = True
+    intents.message_content = True # メッセージ内容へのアクセスを有効にする
+    return intents
 
-import discord
 
 async def do_research(token, intents):
     """
     データ収集のためにボットを起動し、完了後に終了する
     """
-    bot = AIKunBot(intents=intents)
+    from bot import AIKunBot
+
+    bot = AIKunBot(intents=intents, serve=False)
 
     @bot.event
     async def on_ready():
@@ -74,29 +128,28 @@ def main():
         return
 
     check_and_install_dependencies()
+    from dotenv import load_dotenv
     load_dotenv()
     token = os.getenv("DISCORD_BOT_TOKEN")
 
     command = sys.argv[1]
 
-    intents = discord.Intents.default()
-    intents.messages = True
-    intents.guilds = True
-    intents.message_content = True # メッセージ内容へのアクセスを有効にする
-
+    # 各コマンドに必要なモジュールだけを、そのコマンドを実行するときに読み込む
     if command == "run":
         if not token:
             print("Error: DISCORD_BOT_TOKEN not found in .env file.")
             return
-        bot = AIKunBot(intents=intents)
+        from bot import AIKunBot
+        bot = AIKunBot(intents=make_intents())
         bot.run(token)
     elif command == "research":
         if not token:
             print("Error: DISCORD_BOT_TOKEN not found in .env file.")
             return
-        asyncio.run(do_research(token, intents))
+        asyncio.run(do_research(token, make_intents()))
     elif command == "learning":
         print("Starting learning...")
+        from learning import AILearner
         learner = AILearner()
         learner.fine_tune(data_path="data")
         print("Learning finished. You can now run the bot using the 'run' command.")
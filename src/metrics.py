@@ -0,0 +1,275 @@
+import asyncio
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# 秒単位のヒストグラムの既定のバケット（応答生成の数ミリ秒から、学習・収集の数十分まで）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+
+class Histogram:
+    """
+    バケットごとの件数・合計・件数を保持するヒストグラム（Prometheusのhistogramと同じ形式）
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        バケットの中を線形補間して分位数を推定する。最後のバケットを超えた場合は最大値を返す
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):
+                    return self.max
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class MetricsRegistry:
+    """
+    カウンター・ゲージ・ヒストグラムを名前とラベルごとに保持する
+    推論スレッドやイベントループなど複数のスレッドから記録されるため、更新はロックで守る
+    """
+    def __init__(self, prefix="ai_kun_"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        # 出力するときに値を計算するゲージ（モデルのメモリ使用量やキャッシュのヒット率など）
+        self._collectors = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        このブロックの所要時間（秒）をヒストグラムに記録する
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collector(self, name, func):
+        """
+        出力のたびにfuncを呼び、返された {メトリクス名: 値} または {メトリクス名: {ラベルの組: 値}} をゲージとして出力する
+        """
+        self._collectors[name] = func
+
+    def histogram(self, name, **labels):
+        with self._lock:
+            return self._histograms.get(self._key(name, labels))
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def _collected(self):
+        gauges = {}
+        for name, func in list(self._collectors.items()):
+            try:
+                values = func()
+            except Exception as e:
+                print(f"[WARNING] Metrics collector {name} failed: {e}")
+                continue
+            for metric, value in values.items():
+                if isinstance(value, dict):
+                    for labels, labelled in value.items():
+                        gauges[(metric, tuple(sorted(labels)))] = labelled
+                else:
+                    gauges[(metric, ())] = value
+        return gauges
+
+    def _all(self):
+        gauges = self._collected()
+        with self._lock:
+            counters = dict(self._counters)
+            gauges.update(self._gauges)
+            histograms = {key: histogram.snapshot() for key, histogram in self._histograms.items()}
+        gauges = {key: value for key, value in gauges.items() if value is not None}
+        return counters, gauges, histograms
+
+    def snapshot(self):
+        """
+        すべてのメトリクスをJSONにできる辞書で返す
+        """
+        counters, gauges, histograms = self._all()
+
+        def flatten(values):
+            result = {}
+            for (name, labels), value in sorted(values.items()):
+                label = ",".join(f"{k}={v}" for k, v in labels)
+                result[f"{name}{{{label}}}" if label else name] = value
+            return result
+
+        return {
+            "timestamp": time.time(),
+            "counters": flatten(counters),
+            "gauges": flatten(gauges),
+            "histograms": flatten(histograms),
+        }
+
+    def render_prometheus(self):
+        """
+        Prometheusのテキスト形式で出力する
+        """
+        counters, gauges, histograms = self._all()
+        lines = []
+
+        def label_text(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        def header(name, kind, seen):
+            if name in seen:
+                return
+            seen.add(name)
+            lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter", seen)
+            lines.append(f"{self.prefix}{name}{label_text(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, "gauge", seen)
+            lines.append(f"{self.prefix}{name}{label_text(labels)} {float(value)}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name, "histogram", seen)
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(f"{self.prefix}{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.prefix}{name}_sum{label_text(labels)} {histogram['sum']}")
+            lines.append(f"{self.prefix}{name}_count{label_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path):
+        """
+        スナップショットをJSONファイルに書き込む（読み込み側が書きかけを見ないよう、置き換えは1回のリネームで行う）
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+
+# プロセス全体で共有するレジストリ
+METRICS = MetricsRegistry()
+
+
+def process_memory_bytes():
+    """
+    プロセスの常駐メモリ（RSS）をバイト数で返す。取得できない環境ではNoneを返す
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # /procのない環境（macOS）では最大RSSで代用する（単位はバイト）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+
+async def monitor_event_loop(registry=METRICS, interval=0.5):
+    """
+    interval秒ごとに眠り、予定より遅れて起きた時間をイベントループの遅延として記録する
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        registry.observe("event_loop_lag_seconds", lag)
+        registry.set("event_loop_lag_last_seconds", lag)
+
+
+class MetricsServer:
+    """
+    /metrics（Prometheusのテキスト形式）と /metrics.json を返すローカルのHTTPサーバー
+    """
+    def __init__(self, registry=METRICS, host="127.0.0.1", port=9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+
+        async def prometheus(request):
+            text = await asyncio.to_thread(self.registry.render_prometheus)
+            return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+        async def snapshot(request):
+            return web.json_response(await asyncio.to_thread(self.registry.snapshot))
+
+        app = web.Application()
+        app.router.add_get("/metrics", prometheus)
+        app.router.add_get("/metrics.json", snapshot)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Metrics endpoint listening on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,108 @@
+import datetime
+import json
+import os
+import shutil
+
+
+class ModelRegistry:
+    """
+    学習済みモデルをバージョンごとのディレクトリで管理する
+    models/versions/<タイムスタンプ>/ にモデルを保存し、models/current.json で現在のバージョンを指す
+    """
+    # 以前の形式（models/fine_tuned を上書きする方式）で保存されたモデルのバージョン名
+    LEGACY_VERSION = "fine_tuned"
+
+    def __init__(self, model_dir="models", keep=5):
+        self.model_dir = model_dir
+        self.versions_dir = os.path.join(model_dir, "versions")
+        self.pointer_path = os.path.join(model_dir, "current.json")
+        self.keep = keep
+
+    def path(self, version):
+        if version == self.LEGACY_VERSION:
+            return os.path.join(self.model_dir, self.LEGACY_VERSION)
+        return os.path.join(self.versions_dir, version)
+
+    def new_version(self):
+        """
+        新しいバージョン名と保存先のパスを返す（ディレクトリはまだ作らない）
+        """
+        base = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        version, suffix = base, 1
+        while os.path.exists(self.path(version)) or os.path.exists(self.path(version) + ".tmp"):
+            suffix += 1
+            version = f"{base}-{suffix}"
+        return version, self.path(version)
+
+    def versions(self):
+        """
+        保存が完了しているバージョンを古い順に返す
+        """
+        if not os.path.isdir(self.versions_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.versions_dir)
+            if not name.endswith(".tmp") and os.path.isdir(os.path.join(self.versions_dir, name))
+        )
+
+    def _read_pointer(self):
+        try:
+            with open(self.pointer_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"current": None, "history": []}
+
+    def _write_pointer(self, pointer):
+        tmp_path = self.pointer_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(pointer, f, indent=1)
+        # 読み込み側が書きかけのファイルを見ないよう、置き換えは1回のリネームで行う
+        os.replace(tmp_path, self.pointer_path)
+
+    def current(self):
+        """
+        現在のバージョン名を返す。レジストリが空で旧形式のモデルがあればそれを返す
+        """
+        current = self._read_pointer()["current"]
+        if current is not None and os.path.isdir(self.path(current)):
+            return current
+        if os.path.isdir(self.path(self.LEGACY_VERSION)):
+            return self.LEGACY_VERSION
+        return None
+
+    def publish(self, version):
+        """
+        保存済みのバージョンを現在のバージョンにする。直前のバージョンはロールバック用に履歴に残す
+        """
+        pointer = self._read_pointer()
+        previous = self.current()
+        if previous is not None and previous != version:
+            pointer["history"].append(previous)
+        pointer["current"] = version
+        self._write_pointer(pointer)
+        self.prune()
+
+    def rollback(self):
+        """
+        1つ前のバージョンに戻し、そのバージョン名を返す。戻せるバージョンがなければNoneを返す
+        """
+        pointer = self._read_pointer()
+        while pointer["history"]:
+            previous = pointer["history"].pop()
+            if os.path.isdir(self.path(previous)):
+                pointer["current"] = previous
+                self._write_pointer(pointer)
+                return previous
+        return None
+
+    def prune(self):
+        """
+        現在のバージョンと直近の履歴を残し、古いバージョンを削除する
+        """
+        pointer = self._read_pointer()
+        pointer["history"] = pointer["history"][-self.keep:]
+        self._write_pointer(pointer)
+        keep = set(pointer["history"]) | {pointer["current"]}
+        for version in self.versions():
+            if version not in keep:
+                shutil.rmtree(self.path(version), ignore_errors=True)
@@ -0,0 +1,131 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from dataset import batch_by_length, to_example
+
+SHARD_FORMAT_VERSION = 1
+
+
+def _load_index(shard_dir):
+    try:
+        with open(os.path.join(shard_dir, "index.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_index(shard_dir, index):
+    path = os.path.join(shard_dir, "index.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def write_shards(cache, files, block_size, shard_dir, sequences_per_shard=16384):
+    """
+    トークンキャッシュのシーケンスを、固定長レコードのシャードファイルに書き出し、インデックスを返す
+    各レコードは [トークン数, トークンID..., 0埋め] の block_size + 1 個の値で、TokenCacheと同じ型（uint16/uint32）で保存する
+    入力とトークナイザーが同じなら書き出し済みのシャードを使い、中断した場合は完了済みのシャードの続きから書き出す
+    """
+    sources = {os.path.abspath(file): cache.index[os.path.abspath(file)]["key"] for file in files}
+    index = _load_index(shard_dir)
+    expected = {
+        "format": SHARD_FORMAT_VERSION,
+        "block_size": block_size,
+        "dtype": np.dtype(cache.dtype).name,
+        "sources": sources,
+        "sequences_per_shard": sequences_per_shard,
+    }
+    if index is None or any(index.get(key) != value for key, value in expected.items()):
+        index = dict(expected, shards=[], complete=False)
+        os.makedirs(shard_dir, exist_ok=True)
+        for name in os.listdir(shard_dir):
+            if name.startswith("shard_"):
+                os.remove(os.path.join(shard_dir, name))
+    if index["complete"]:
+        print(f"Using {len(index['shards'])} existing shard(s) in {shard_dir}.")
+        return index
+    done = sum(shard["sequences"] for shard in index["shards"])
+    if done:
+        print(f"Resuming: {len(index['shards'])} shard(s) ({done} sequences) already written.")
+
+    buffer = np.zeros((sequences_per_shard, block_size + 1), dtype=cache.dtype)
+    count = 0
+
+    def flush():
+        name = f"shard_{len(index['shards']):05d}.bin"
+        path = os.path.join(shard_dir, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(buffer[:count].tobytes())
+        os.replace(path + ".tmp", path)
+        index["shards"].append({"file": name, "sequences": count})
+        _save_index(shard_dir, index)
+
+    for i, sequence in enumerate(cache.iter_packed(files, block_size)):
+        if i < done:
+            continue
+        buffer[count, 0] = len(sequence)
+        buffer[count, 1:len(sequence) + 1] = sequence
+        buffer[count, len(sequence) + 1:] = 0
+        count += 1
+        if count == sequences_per_shard:
+            flush()
+            count = 0
+    if count:
+        flush()
+    index["complete"] = True
+    _save_index(shard_dir, index)
+    print(f"Wrote {len(index['shards'])} shard(s) ({sum(shard['sequences'] for shard in index['shards'])} sequences) to {shard_dir}.")
+    return index
+
+
+def shards_complete(shard_dir):
+    index = _load_index(shard_dir)
+    return index is not None and index["complete"]
+
+
+def num_shard_sequences(shard_dir):
+    index = _load_index(shard_dir)
+    return 0 if index is None else sum(shard["sequences"] for shard in index["shards"])
+
+
+def shard_dataset(shard_dir, batch_size, pad_token_id, input_context=None, shuffle_buffer_size=10000,
+                  cycle_length=None, seed=None):
+    """
+    シャードから (inputs, labels, sample_weight) のバッチを終わりなく返す tf.data.Dataset を作る
+    シャードは複数同時に並列で読み（interleave）、読み出しと復号はすべてグラフ内で行うのでPythonのロックを取らない
+    input_context（tf.distribute.InputContext）を渡した場合は、シャードをワーカーごとに分ける
+    （シャードがワーカーより少ない場合は、各ワーカーがすべてのシャードをそれぞれ別の順序で読む）
+    """
+    index = _load_index(shard_dir)
+    if index is None or not index["complete"]:
+        raise FileNotFoundError(f"No complete shard index in {shard_dir}")
+    block_size = index["block_size"]
+    dtype = tf.as_dtype(index["dtype"])
+    if dtype == tf.uint32:
+        # decode_raw は uint32 に対応していない。トークンIDは2^31未満なので、同じビット列を int32 として読めばよい
+        dtype = tf.int32
+    record_bytes = (block_size + 1) * dtype.size
+    paths = [os.path.join(shard_dir, shard["file"]) for shard in index["shards"]]
+
+    files = tf.data.Dataset.from_tensor_slices(paths)
+    if input_context is not None and len(paths) >= input_context.num_input_pipelines:
+        files = files.shard(input_context.num_input_pipelines, input_context.input_pipeline_id)
+    files = files.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True).repeat()
+    records = files.interleave(
+        lambda path: tf.data.FixedLengthRecordDataset(path, record_bytes, buffer_size=1 << 20),
+        cycle_length=cycle_length or tf.data.AUTOTUNE,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False,
+    )
+
+    def decode(record):
+        values = tf.cast(tf.io.decode_raw(record, dtype, little_endian=True), tf.int32)
+        return to_example(values[1:values[0] + 1])
+
+    records = records.shuffle(shuffle_buffer_size, seed=seed)
+    records = records.map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+    return batch_by_length(records, block_size, batch_size, pad_token_id).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+class StateStore:
+    """
+    ボットの状態（稼働中かどうか、有効なチャンネル、チャンネルごとの設定、収集済みのメッセージID）を保存するSQLiteのストア
+    起動時にすべて読み込んでメモリ上で参照し、変更はまとめてflush()で書き込む
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS channels (
+            channel_id INTEGER PRIMARY KEY,
+            enabled INTEGER NOT NULL DEFAULT 0,
+            settings TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            scope TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (scope, channel_id)
+        );
+    """
+
+    def __init__(self, path="data/state.sqlite3"):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # flush()は別スレッドから呼ばれることがあるため、接続はロックで守る
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._settings = {}
+        self._channels = {}
+        self._checkpoints = {}
+        self._dirty_settings = set()
+        self._dirty_channels = set()
+        self._dirty_checkpoints = set()
+        self._load()
+
+    def _load(self):
+        with self._lock:
+            for key, value in self._conn.execute("SELECT key, value FROM settings"):
+                self._settings[key] = json.loads(value)
+            for channel_id, enabled, settings in self._conn.execute("SELECT channel_id, enabled, settings FROM channels"):
+                self._channels[channel_id] = {"enabled": bool(enabled), "settings": json.loads(settings)}
+            for scope, channel_id, message_id in self._conn.execute("SELECT scope, channel_id, message_id FROM checkpoints"):
+                self._checkpoints.setdefault(scope, {})[channel_id] = message_id
+
+    def get(self, key, default=None):
+        return self._settings.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._settings[key] = value
+            self._dirty_settings.add(key)
+
+    def _channel(self, channel_id):
+        return self._channels.setdefault(channel_id, {"enabled": False, "settings": {}})
+
+    def enabled_channels(self):
+        return {channel_id for channel_id, channel in self._channels.items() if channel["enabled"]}
+
+    def set_channel_enabled(self, channel_id, enabled):
+        with self._lock:
+            self._channel(channel_id)["enabled"] = enabled
+            self._dirty_channels.add(channel_id)
+
+    def channel_settings(self, channel_id=None):
+        """
+        チャンネルの設定を返す。channel_idを省略した場合は、設定のあるすべてのチャンネルの設定を返す
+        """
+        if channel_id is None:
+            return {cid: dict(channel["settings"]) for cid, channel in self._channels.items() if channel["settings"]}
+        channel = self._channels.get(channel_id)
+        return dict(channel["settings"]) if channel is not None else {}
+
+    def update_channel_settings(self, channel_id, **settings):
+        with self._lock:
+            self._channel(channel_id)["settings"].update(settings)
+            self._dirty_channels.add(channel_id)
+
+    def checkpoints(self, scope):
+        """
+        収集先（scope）ごとの、チャンネルIDと最後に収集したメッセージIDの辞書を返す
+        """
+        return dict(self._checkpoints.get(scope, {}))
+
+    def set_checkpoint(self, scope, channel_id, message_id):
+        with self._lock:
+            self._checkpoints.setdefault(scope, {})[channel_id] = message_id
+            self._dirty_checkpoints.add((scope, channel_id))
+
+    def flush(self):
+        """
+        まだ書き込んでいない変更を1つのトランザクションで書き込む
+        """
+        with self._lock:
+            if not (self._dirty_settings or self._dirty_channels or self._dirty_checkpoints):
+                return
+            settings = [(key, json.dumps(self._settings[key])) for key in self._dirty_settings]
+            channels = [
+                (channel_id, int(self._channels[channel_id]["enabled"]), json.dumps(self._channels[channel_id]["settings"]))
+                for channel_id in self._dirty_channels
+            ]
+            checkpoints = [
+                (scope, channel_id, self._checkpoints[scope][channel_id])
+                for scope, channel_id in self._dirty_checkpoints
+            ]
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", settings)
+                self._conn.executemany("INSERT OR REPLACE INTO channels (channel_id, enabled, settings) VALUES (?, ?, ?)", channels)
+                self._conn.executemany("INSERT OR REPLACE INTO checkpoints (scope, channel_id, message_id) VALUES (?, ?, ?)", checkpoints)
+            # 書き込みに失敗した場合（ロック中・ディスクの空き不足など）は、次のflushで書き込み直す
+            self._dirty_settings.clear()
+            self._dirty_channels.clear()
+            self._dirty_checkpoints.clear()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from corpus import CORPUS_SUFFIX
+from dataset import iter_token_chunks, pack_ranges
+
+
+class TokenCache:
+    """
+    ファイルごとのトークンID列をディスクに保存し、変更のないファイルの再トークン化を省くキャッシュ
+    各エントリはファイルパス・サイズ・更新時刻・トークナイザーのバージョンで識別し、
+    トークンIDはuint16/uint32の生バイナリとして保存して np.memmap で読み出す
+    メッセージ（行）ごとのトークン数も .len ファイルに保存し、メッセージの境界に沿った詰め込みに使う
+    トークン化した内容のsha1と行数も記録し、追記されただけのファイルは追記された行だけをトークン化する
+    """
+    FORMAT_VERSION = 2
+
+    def __init__(self, cache_dir, tokenizer):
+        self.cache_dir = cache_dir
+        self.tokenizer_name = tokenizer.name_or_path
+        self.dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
+        fingerprint = f"{self.FORMAT_VERSION}|{type(tokenizer).__name__}|{self.tokenizer_name}|{len(tokenizer)}"
+        self.tokenizer_version = hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def _key(self, path):
+        stat = os.stat(path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}:{self.tokenizer_version}"
+
+    def _bin_path(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, name + ".bin")
+
+    @staticmethod
+    def _lengths_path(bin_path):
+        return bin_path[:-len(".bin")] + ".len"
+
+    def is_fresh(self, path):
+        entry = self.index.get(os.path.abspath(path))
+        if entry is None or entry["key"] != self._key(path):
+            return False
+        bin_path = os.path.join(self.cache_dir, entry["file"])
+        return os.path.exists(bin_path) and os.path.exists(self._lengths_path(bin_path))
+
+    @staticmethod
+    def _digest(path, size, prefix_size=None, chunk_size=1 << 20):
+        """
+        ファイルの先頭sizeバイトのsha1と、先頭prefix_sizeバイトのsha1・その最後のバイトを、1回の読み出しで求める
+        """
+        digest = hashlib.sha1()
+        prefix_digest = last_byte = chunk = None
+        position = 0
+        with open(path, "rb") as f:
+            for boundary in ([prefix_size] if prefix_size is not None else []) + [size]:
+                while position < boundary:
+                    chunk = f.read(min(chunk_size, boundary - position))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    position += len(chunk)
+                if boundary == prefix_size and position == prefix_size:
+                    prefix_digest, last_byte = digest.hexdigest(), chunk[-1:]
+        return digest.hexdigest(), prefix_digest, last_byte
+
+    def _appended_entry(self, path, entry, size):
+        """
+        ファイルが前回トークン化した内容の後ろに追記されただけなら、そのエントリを返す（続きだけをトークン化できる）
+        戻り値の2つ目は、ファイル全体のsha1
+        """
+        resumable = (
+            entry is not None and entry.get("digest") is not None
+            and entry["key"].rsplit(":", 1)[-1] == self.tokenizer_version
+            and 0 < entry["bytes"] <= size
+            and all(os.path.exists(p) for p in self._entry_paths(entry))
+        )
+        digest, prefix_digest, last_byte = self._digest(path, size, entry["bytes"] if resumable else None)
+        if not resumable or prefix_digest != entry["digest"]:
+            return None, digest
+        # テキストファイルの最後の行が途中までだった場合は、その行が書き足されている
+        if not path.endswith(CORPUS_SUFFIX) and last_byte != b"\n":
+            return None, digest
+        return entry, digest
+
+    def _entry_paths(self, entry):
+        bin_path = os.path.join(self.cache_dir, entry["file"])
+        return bin_path, self._lengths_path(bin_path)
+
+    def update(self, files, processes=None):
+        """
+        新規・変更されたファイルだけをトークン化してキャッシュに書き込み、トークン化したファイル数を返す
+        前回から追記されただけのファイルは、追記された行だけをトークン化して既存のキャッシュの後ろに足す
+        """
+        stale = [file for file in files if not self.is_fresh(file)]
+        if stale:
+            appended, digests, sizes = {}, {}, {}
+            for file in stale:
+                sizes[file] = os.stat(file).st_size
+                entry, digests[file] = self._appended_entry(file, self.index.get(os.path.abspath(file)), sizes[file])
+                if entry is not None:
+                    appended[file] = entry
+            print(f"Tokenizing {len(stale)} new or changed file(s) ({len(appended)} appended, "
+                  f"{len(files) - len(stale)} cached)...")
+            counts = {file: entry["tokens"] for file, entry in appended.items()}
+            messages = {file: entry["messages"] for file, entry in appended.items()}
+            lines = {file: entry["lines"] for file, entry in appended.items()}
+            out = out_lengths = out_file = None
+            try:
+                # トークン化の結果はファイル順に届くので、ファイルが変わったら前の出力を閉じる
+                for file, ids, lengths, chunk_lines in iter_token_chunks(stale, self.tokenizer_name, processes, skip=dict(lines)):
+                    if file != out_file:
+                        if out is not None:
+                            out.close()
+                            out_lengths.close()
+                        if file in appended:
+                            # 前回の書き込みが途中で止まっていても、インデックスに記録した長さまでに切り詰めてから足す
+                            bin_path, lengths_path = self._entry_paths(appended[file])
+                            out = open(bin_path, "r+b")
+                            out.truncate(counts[file] * np.dtype(self.dtype).itemsize)
+                            out.seek(0, os.SEEK_END)
+                            out_lengths = open(lengths_path, "r+b")
+                            out_lengths.truncate(messages[file] * np.dtype(np.uint32).itemsize)
+                            out_lengths.seek(0, os.SEEK_END)
+                        else:
+                            bin_path = self._bin_path(file)
+                            out = open(bin_path + ".tmp", "wb")
+                            out_lengths = open(self._lengths_path(bin_path) + ".tmp", "wb")
+                            counts[file] = messages[file] = lines[file] = 0
+                        out_file = file
+                    out.write(ids.astype(self.dtype).tobytes())
+                    out_lengths.write(lengths.astype(np.uint32).tobytes())
+                    counts[file] += len(ids)
+                    messages[file] += len(lengths)
+                    lines[file] += chunk_lines
+            finally:
+                if out is not None:
+                    out.close()
+                    out_lengths.close()
+
+            for file in stale:
+                bin_path = self._bin_path(file)
+                lengths_path = self._lengths_path(bin_path)
+                if file in appended:
+                    bin_path = self._entry_paths(appended[file])[0]
+                elif file in counts:
+                    os.replace(bin_path + ".tmp", bin_path)
+                    os.replace(lengths_path + ".tmp", lengths_path)
+                else:
+                    # 空のファイル
+                    open(bin_path, "wb").close()
+                    open(lengths_path, "wb").close()
+                self.index[os.path.abspath(file)] = {
+                    "key": self._key(file),
+                    "file": os.path.basename(bin_path),
+                    "tokens": counts.get(file, 0),
+                    "messages": messages.get(file, 0),
+                    "lines": lines.get(file, 0),
+                    "bytes": sizes[file],
+                    "digest": digests[file],
+                }
+        else:
+            print(f"All {len(files)} file(s) are already tokenized.")
+
+        # 元ファイルが消えたエントリを削除する
+        for path in [path for path in self.index if not os.path.exists(path)]:
+            bin_path = os.path.join(self.cache_dir, self.index.pop(path)["file"])
+            for stale_path in (bin_path, self._lengths_path(bin_path)):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+        self._save_index()
+        return len(stale)
+
+    def load(self, path):
+        """
+        キャッシュ済みのトークンID列を np.memmap で返す（ファイル全体は読み込まない）
+        """
+        entry = self.index[os.path.abspath(path)]
+        if entry["tokens"] == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(os.path.join(self.cache_dir, entry["file"]), dtype=self.dtype, mode="r", shape=(entry["tokens"],))
+
+    def num_tokens(self, files):
+        return sum(self.index[os.path.abspath(file)]["tokens"] for file in files)
+
+    def num_messages(self, path):
+        return self.index[os.path.abspath(path)]["messages"]
+
+    def load_lengths(self, path):
+        """
+        キャッシュ済みのメッセージごとのトークン数を返す
+        """
+        entry = self.index[os.path.abspath(path)]
+        if entry["messages"] == 0:
+            return np.empty(0, dtype=np.uint32)
+        lengths_path = self._lengths_path(os.path.join(self.cache_dir, entry["file"]))
+        return np.memmap(lengths_path, dtype=np.uint32, mode="r", shape=(entry["messages"],))
+
+    def num_sequences(self, files, block_size):
+        """
+        iter_packedが返すシーケンスの数
+        """
+        return sum(sum(1 for _ in pack_ranges(self.load_lengths(file), block_size)) for file in files)
+
+    def iter_packed(self, files, block_size):
+        """
+        メッセージの境界に沿って、block_sizeトークン以下に詰めたシーケンスを順に返す
+        ファイル（チャンネル）をまたいでは詰めず、各シーケンスはmemmapのスライスをそのまま返す
+        """
+        for file in files:
+            tokens = self.load(file)
+            for start, end in pack_ranges(self.load_lengths(file), block_size):
+                yield tokens[start:end]
+
+    def packed_ranges(self, files, block_size, since=None, until=None):
+        """
+        メッセージの境界に沿って詰めたシーケンスを (ファイル, 開始位置, 終了位置) のリストで返す
+        since/untilはファイルごとのメッセージ数の辞書で、指定した場合はその番号以降/より前のメッセージだけを詰める
+        """
+        ranges = []
+        for file in files:
+            lengths = self.load_lengths(file)
+            first = since.get(file, 0) if since is not None else 0
+            last = until.get(file, 0) if until is not None else len(lengths)
+            offset = int(lengths[:first].sum())
+            for start, end in pack_ranges(lengths[first:last], block_size):
+                ranges.append((file, offset + start, offset + end))
+        return ranges
+
+    def iter_ranges(self, ranges):
+        """
+        packed_rangesが返した範囲のトークンID列を順に返す
+        """
+        tokens = {}
+        for file, start, end in ranges:
+            if file not in tokens:
+                tokens[file] = self.load(file)
+            yield tokens[file][start:end]
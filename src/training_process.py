@@ -0,0 +1,138 @@
+import asyncio
+import inspect
+import multiprocessing
+import os
+import queue
+import time
+
+
+def _apply_limits(threads, memory_limit_mb):
+    """
+    学習プロセスのスレッド数とメモリ使用量の上限を設定する（TensorFlowの読み込み前に呼ぶ）
+    """
+    if memory_limit_mb:
+        try:
+            import resource
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            # Windowsなど、resourceモジュールが使えない環境では上限を設定しない
+            print(f"[WARNING] Could not apply memory limit to the training process: {e}")
+
+    if threads:
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(max(1, threads // 2))
+
+
+def _training_main(data_path, epochs, incremental, threads, memory_limit_mb, events):
+    """
+    学習プロセスのエントリーポイント。進捗と結果はeventsキューで親プロセスに送る
+    """
+    _apply_limits(threads, memory_limit_mb)
+
+    import tensorflow as tf
+    from learning import AILearner
+
+    class ProgressCallback(tf.keras.callbacks.Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            logs = logs or {}
+            events.put({
+                "type": "epoch",
+                "epoch": epoch + 1,
+                "epochs": epochs,
+                "loss": float(logs.get("loss", 0.0)),
+                "tokens_per_sec": float(logs.get("tokens_per_sec", 0.0)),
+                "epoch_time": float(logs.get("epoch_time", 0.0)),
+            })
+
+    try:
+        events.put({"type": "started", "pid": os.getpid()})
+        learner = AILearner()
+        started_at = time.perf_counter()
+        version = learner.fine_tune(data_path=data_path, epochs=epochs, callbacks=[ProgressCallback()], incremental=incremental)
+        # このプロセスのメトリクスは親プロセスから見えないので、学習にかかった時間はイベントで送る
+        mode = "adapters" if learner.use_adapters else "incremental" if incremental else "full"
+        events.put({"type": "done", "version": version, "seconds": time.perf_counter() - started_at, "mode": mode})
+    except Exception as e:
+        events.put({"type": "error", "error": repr(e)})
+        raise
+
+
+class TrainingProcess:
+    """
+    ファインチューニングを別プロセスで実行し、進捗と結果をイベントループへ非同期に知らせる
+    学習中もボットのイベントループと推論は止まらない
+    """
+    def __init__(self, threads=None, memory_limit_mb=None, poll_interval=1.0):
+        self.threads = threads
+        self.memory_limit_mb = memory_limit_mb
+        self.poll_interval = poll_interval
+        self.process = None
+
+    @property
+    def is_running(self):
+        return self.process is not None and self.process.is_alive()
+
+    async def run(self, data_path, epochs=1, on_progress=None, incremental=False):
+        """
+        学習を実行し、成功した場合は保存されたモデルのバージョン名を、失敗した場合はNoneを返す
+        on_progressには進捗イベント（辞書）が渡される
+        incrementalが真の場合は、現在のモデルから前回以降に追加されたデータで追加学習する
+        """
+        if self.is_running:
+            print("A training process is already running.")
+            return None
+
+        # 親プロセスのTensorFlowの状態を引き継がないよう、spawnで新しいプロセスを起動する
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        self.process = context.Process(
+            target=_training_main,
+            args=(data_path, epochs, incremental, self.threads, self.memory_limit_mb, events),
+            name="ai-kun-training",
+        )
+        self.process.start()
+
+        version = None
+        finished = False
+        while not finished:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                if not self.process.is_alive():
+                    # 終了直前に送られたイベントを取りこぼさない
+                    try:
+                        event = await asyncio.to_thread(events.get, True, self.poll_interval)
+                    except queue.Empty:
+                        break
+                else:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+            if event["type"] == "done":
+                version = event["version"]
+                finished = True
+            elif event["type"] == "error":
+                print(f"Training process failed: {event['error']}")
+                finished = True
+            if on_progress is not None:
+                result = on_progress(event)
+                if inspect.isawaitable(result):
+                    await result
+
+        await asyncio.to_thread(self.process.join)
+        exitcode = self.process.exitcode
+        self.process = None
+        if exitcode != 0:
+            print(f"Training process exited with code {exitcode}.")
+            return None
+        return version
+
+    def terminate(self):
+        """
+        実行中の学習プロセスを強制終了する
+        """
+        if self.is_running:
+            self.process.terminate()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# src/ と AI/ 以下のモジュールを、ボットの実行時と同じく直接インポートする
+for directory in ("src", "AI"):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", directory))
@@ -0,0 +1,65 @@
+import asyncio
+
+from admission import AdmissionController, TokenBucket
+
+
+def test_token_bucket_allows_burst_then_limits():
+    bucket = TokenBucket(rate=0.001, burst=2)
+    assert bucket.try_take()
+    assert bucket.try_take()
+    assert not bucket.try_take()
+
+
+def test_token_bucket_without_rate_is_unlimited():
+    bucket = TokenBucket(rate=0, burst=1)
+    assert all(bucket.try_take() for _ in range(100))
+
+
+def _controller(window=0.2):
+    return AdmissionController(channel_rate=0, global_rate=0, coalesce_window=window)
+
+
+def test_isolated_message_is_admitted_without_waiting():
+    admission = _controller(window=5.0)
+
+    async def run():
+        return await asyncio.wait_for(admission.admit(1, "こんにちは"), timeout=1.0)
+
+    assert asyncio.run(run()) == "こんにちは"
+
+
+def test_burst_is_coalesced_into_one_prompt():
+    admission = _controller()
+
+    async def run():
+        first = await admission.admit(1, "a")
+        admission.finished(1)
+        # 直前のメッセージから間がないので、続くメッセージはまとめる
+        return first, await asyncio.gather(admission.admit(1, "b"), admission.admit(1, "c"), admission.admit(2, "d"))
+
+    first, rest = asyncio.run(run())
+    assert first == "a"
+    assert rest == ["b\nc", None, "d"]
+    assert admission.coalesced == 1
+
+
+def test_messages_during_generation_wait_to_be_merged():
+    admission = _controller()
+
+    async def run():
+        await admission.admit(1, "a")
+        # 前の応答の生成中に届いたメッセージは、間が空いていてもまとめ待ちにする
+        admission._last_arrival[1] -= 10
+        return await asyncio.gather(admission.admit(1, "b"), admission.admit(1, "c"))
+
+    assert asyncio.run(run()) == ["b\nc", None]
+
+
+def test_rate_limited_messages_are_dropped():
+    admission = AdmissionController(channel_rate=0.001, channel_burst=1, global_rate=0, coalesce_window=0)
+
+    async def run():
+        return [await admission.admit(1, "a"), await admission.admit(1, "b")]
+
+    assert asyncio.run(run()) == ["a", None]
+    assert admission.rate_limited == 1
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from backends import TFNoRepeatBigramLogitsProcessor, TFTokenBudgetLogitsProcessor, _WindowedGreedyBackend, greedy_next_token
+
+
+def test_greedy_next_token_skips_repeated_bigram():
+    logits = np.array([0.0, 5.0, 1.0, 0.0])
+    # 直前のトークン2の後にはすでに1が出ているので、次に1は選ばない
+    assert greedy_next_token(logits, [2, 1, 3, 2]) == 2
+    assert greedy_next_token(logits, [3, 2]) == 1
+
+
+def test_tf_no_repeat_bigram_matches_python_version():
+    sequence = [2, 1, 3, 2]
+    logits = np.array([[0.0, 5.0, 1.0, 0.0]], dtype=np.float32)
+    scores = TFNoRepeatBigramLogitsProcessor()(tf.constant([sequence + [0, 0]]), tf.constant(logits), tf.constant(len(sequence)))
+    assert int(tf.argmax(scores[0])) == greedy_next_token(logits[0], sequence)
+
+
+def test_token_budget_forces_eos_at_limit():
+    processor = TFTokenBudgetLogitsProcessor(eos_token_id=3)
+    processor.limit.assign(5)
+    scores = tf.constant([[1.0, 2.0, 0.5, 0.0]])
+    ids = tf.zeros((1, 8), dtype=tf.int32)
+    assert int(tf.argmax(processor(ids, scores, tf.constant(4))[0])) == 1
+    assert int(tf.argmax(processor(ids, scores, tf.constant(5))[0])) == 3
+
+
+def test_windowed_backend_requires_last_logits():
+    with pytest.raises(TypeError):
+        _WindowedGreedyBackend(None, None, None)
@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+
+import discord
+
+from bot import AIKunBot
+from metrics import METRICS
+
+
+class _Author:
+    id = 1
+    bot = False
+
+
+class _Channel:
+    id = 20
+
+
+class _Message:
+    def __init__(self, content):
+        self.content = content
+        self.author = _Author()
+        self.channel = _Channel()
+        self.guild = None
+
+
+def test_research_bot_ignores_messages_and_commands(tmp_path, monkeypatch):
+    monkeypatch.setenv("AI_KUN_STATE_PATH", str(tmp_path / "state.sqlite3"))
+    bot = AIKunBot(intents=discord.Intents.default(), serve=False)
+    bot.is_ai_running = True
+    bot.ai_enabled_channels = {_Channel.id}
+    handled = []
+
+    async def handle_command(message):
+        handled.append(message)
+
+    async def admit(channel_id, content):
+        handled.append(content)
+
+    bot.handle_command = handle_command
+    bot.admission.admit = admit
+
+    async def run():
+        await bot.on_message(_Message("!AI-KUN Run"))
+        await bot.on_message(_Message("こんにちは"))
+
+    asyncio.run(run())
+    assert handled == []
+
+
+def test_training_done_event_records_fine_tune_time(tmp_path, monkeypatch):
+    monkeypatch.setenv("AI_KUN_STATE_PATH", str(tmp_path / "state.sqlite3"))
+    bot = AIKunBot(intents=discord.Intents.default(), serve=False)
+    before = METRICS.histogram("fine_tune_seconds", mode="incremental")
+    before = before.count if before is not None else 0
+    bot.report_training_progress({"type": "done", "version": "v1", "seconds": 12.5, "mode": "incremental"})
+    assert METRICS.histogram("fine_tune_seconds", mode="incremental").count == before + 1
+
+
+class _HistoryChannel:
+    id = 30
+    name = "general"
+
+    def __init__(self):
+        self.requested_after = []
+
+    def history(self, limit=None, after=None, oldest_first=True):
+        self.requested_after.append(after)
+
+        async def messages():
+            return
+            yield
+
+        return messages()
+
+
+class _Guild:
+    id = 40
+
+
+def test_collection_resumes_from_checkpoint_older_than_after(tmp_path, monkeypatch):
+    monkeypatch.setenv("AI_KUN_STATE_PATH", str(tmp_path / "state.sqlite3"))
+    bot = AIKunBot(intents=discord.Intents.default(), serve=False)
+    scope = str(tmp_path)
+    week_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(weeks=1)
+    # ボットが1週間より長く止まっていた場合のチェックポイント
+    checkpoint = discord.utils.time_snowflake(week_ago - datetime.timedelta(days=3))
+    bot.state.set_checkpoint(scope, _HistoryChannel.id, checkpoint)
+    channel = _HistoryChannel()
+
+    asyncio.run(bot._collect_channel(_Guild(), channel, str(tmp_path), week_ago, scope, asyncio.Semaphore(1)))
+    assert channel.requested_after[0].id == checkpoint
+
+    # チェックポイントがない場合は after から取得する
+    channel.id = _HistoryChannel.id + 1
+    asyncio.run(bot._collect_channel(_Guild(), channel, str(tmp_path), week_ago, scope, asyncio.Semaphore(1)))
+    assert channel.requested_after[1] == week_ago
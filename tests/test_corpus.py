@@ -0,0 +1,63 @@
+import os
+import random
+
+from corpus import CorpusWriter, NearDuplicateFilter, corpus_files, iter_records, last_record_id
+
+
+def _random_text(rng):
+    return "".join(rng.choice("あいうえおかきくけこさしすせそ") for _ in range(20))
+
+
+def test_near_duplicate_filter_ignores_notation_and_numbers():
+    dedup = NearDuplicateFilter()
+    assert not dedup.is_duplicate("ＯＫ、3時に集合 https://example.com/1")
+    assert dedup.is_duplicate("ok 5時に集合!! https://example.com/2")
+    assert not dedup.is_duplicate("こんばんは")
+
+
+def test_near_duplicate_filter_forgets_outside_window():
+    dedup = NearDuplicateFilter(window=2)
+    for text in ("あ", "い", "う"):
+        assert not dedup.is_duplicate(text)
+    assert not dedup.is_duplicate("あ")
+    assert dedup.is_duplicate("う")
+
+
+def test_writer_skips_duplicates_of_existing_records(tmp_path):
+    path = str(tmp_path / "1_2.jsonl.gz")
+    writer = CorpusWriter(path)
+    writer.write({"id": 1, "content": "こんにちは"})
+    writer.close()
+
+    writer = CorpusWriter(path)
+    assert not writer.write({"id": 2, "content": "こんにちは"})
+    assert writer.write({"id": 3, "content": "さようなら"})
+    writer.close()
+    assert [record["id"] for record in iter_records(path)] == [1, 3]
+    assert last_record_id(path) == 3
+
+
+def test_append_after_truncated_member_keeps_file_readable(tmp_path):
+    path = str(tmp_path / "1_2.jsonl.gz")
+    rng = random.Random(0)
+    writer = CorpusWriter(path)
+    for i in range(2000):
+        writer.write({"id": i + 1, "content": _random_text(rng)})
+    writer.close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) * 2 // 3)
+
+    writer = CorpusWriter(path)
+    for i in range(5):
+        writer.write({"id": 5000 + i, "content": _random_text(rng)})
+    writer.close()
+
+    records = list(iter_records(path))
+    assert 0 < len(records) < 2000 + 5
+    assert [record["id"] for record in records[-5:]] == [5000, 5001, 5002, 5003, 5004]
+
+
+def test_corpus_files_skips_legacy_text_with_corpus(tmp_path):
+    for name in ("1_2.txt", "1_2.jsonl.gz", "1_3.txt"):
+        (tmp_path / name).write_bytes(b"")
+    assert [os.path.basename(path) for path in corpus_files(str(tmp_path))] == ["1_2.jsonl.gz", "1_3.txt"]
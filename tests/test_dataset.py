@@ -0,0 +1,16 @@
+from dataset import pack_ranges
+
+
+def test_pack_ranges_keeps_message_boundaries():
+    assert list(pack_ranges([3, 4, 2, 5], block_size=8)) == [(0, 7), (7, 14)]
+
+
+def test_pack_ranges_splits_long_messages():
+    assert list(pack_ranges([2, 11], block_size=4)) == [(0, 2), (2, 6), (6, 10), (10, 13)]
+
+
+def test_pack_ranges_drops_single_tokens():
+    # 1トークンだけのシーケンスは学習に使えない
+    assert list(pack_ranges([1], block_size=4)) == []
+    assert list(pack_ranges([4, 1], block_size=4)) == [(0, 4)]
+    assert list(pack_ranges([], block_size=4)) == []
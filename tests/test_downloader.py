@@ -0,0 +1,175 @@
+import bz2
+import hashlib
+import json
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import downloader
+from downloader import ChecksumMismatch, DownloadError, RangeDownloader, fetch_checksum
+from prepare_and_train import WIKI_CHECKSUM_NAME, WIKI_DUMP_NAME, WikipediaTrainer
+
+DATA = random.Random(0).randbytes(3_000_007)
+MD5 = hashlib.md5(DATA).hexdigest()
+
+
+class _Server:
+    """
+    Rangeリクエストに対応したダウンロード元の代わり。途中で接続を切る回数や、ETagを変えられる
+    """
+    def __init__(self):
+        self.ranges = True
+        self.etag = '"v1"'
+        self.last_modified = "Tue, 01 Sep 2026 00:00:00 GMT"
+        self.failures = 0
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                if self.path.endswith(".txt"):
+                    body = f"0123  other.bz2\n{MD5}  {WIKI_DUMP_NAME}\n".encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                requested = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+                if server.ranges and requested and if_range in (None, server.etag, server.last_modified):
+                    start, end = requested[len("bytes="):].split("-")
+                    start, end = int(start), int(end) if end else len(DATA) - 1
+                    body = DATA[start:end + 1]
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+                else:
+                    body = DATA
+                    self.send_response(200)
+                self.send_header("ETag", server.etag)
+                self.send_header("Last-Modified", server.last_modified)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if server.failures > 0 and len(body) > 1:
+                    server.failures -= 1
+                    self.wfile.write(body[:len(body) // 2])
+                    self.wfile.flush()
+                    self.connection.close()
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+    server = _Server()
+    yield server
+    server.close()
+
+
+def _downloader(**kwargs):
+    return RangeDownloader(**dict(dict(connections=3, segment_size=1 << 20, chunk_size=1 << 16, retries=0, timeout=5), **kwargs))
+
+
+def test_fetch_checksum(server):
+    assert fetch_checksum(f"{server.url}/{WIKI_CHECKSUM_NAME}", WIKI_DUMP_NAME) == MD5
+    with pytest.raises(DownloadError):
+        fetch_checksum(f"{server.url}/{WIKI_CHECKSUM_NAME}", "missing.bz2")
+
+
+def test_download_in_ranges(server, tmp_path):
+    path = str(tmp_path / "dump.bz2")
+    _downloader().download(f"{server.url}/dump.bz2", path, checksum=MD5)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert os.listdir(tmp_path) == ["dump.bz2"]
+    assert sum(1 for headers in server.requests if headers.get("Range", "").startswith("bytes=")) == 1 + 3
+
+
+def test_resume_downloads_only_missing_segments(server, tmp_path):
+    path = str(tmp_path / "dump.bz2")
+    server.failures = 1
+    with pytest.raises(DownloadError):
+        _downloader(connections=1).download(f"{server.url}/dump.bz2", path, checksum=MD5)
+    with open(path + ".part.json", "r", encoding="utf-8") as f:
+        assert len(json.load(f)["done"]) == 2
+
+    server.requests.clear()
+    _downloader().download(f"{server.url}/dump.bz2", path, checksum=MD5)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    # 範囲を調べる1回と、失敗した1区間だけを要求する
+    assert len(server.requests) == 2
+
+
+def test_retries_failed_segments(server, tmp_path):
+    path = str(tmp_path / "dump.bz2")
+    server.failures = 2
+    _downloader(retries=2).download(f"{server.url}/dump.bz2", path, checksum=MD5)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_checksum_mismatch_discards_partial_file(server, tmp_path):
+    path = str(tmp_path / "dump.bz2")
+    with pytest.raises(ChecksumMismatch):
+        _downloader().download(f"{server.url}/dump.bz2", path, checksum="0" * 32)
+    assert os.listdir(tmp_path) == []
+
+
+def test_single_connection_without_range_support(server, tmp_path):
+    path = str(tmp_path / "dump.bz2")
+    server.ranges = False
+    _downloader().download(f"{server.url}/dump.bz2", path, checksum=MD5)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_weak_etag_falls_back_to_last_modified(server, tmp_path):
+    server.etag = 'W/"v1"'
+    _downloader().download(f"{server.url}/dump.bz2", str(tmp_path / "dump.bz2"), checksum=MD5)
+    assert {headers.get("If-Range") for headers in server.requests if "If-Range" in headers} == {server.last_modified}
+
+
+def _trainer(tmp_path):
+    trainer = WikipediaTrainer.__new__(WikipediaTrainer)
+    trainer.wiki_dump_path = str(tmp_path / WIKI_DUMP_NAME)
+    return trainer
+
+
+def test_existing_older_dump_is_kept(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("AI_KUN_WIKI_DUMP_URL", server.url)
+    trainer = _trainer(tmp_path)
+    old_dump = bz2.compress(b"<mediawiki>older month</mediawiki>")
+    with open(trainer.wiki_dump_path, "wb") as f:
+        f.write(old_dump)
+    trainer.download_wikipedia_dump()
+    with open(trainer.wiki_dump_path, "rb") as f:
+        assert f.read() == old_dump
+    assert os.path.exists(trainer.wiki_dump_path + ".md5")
+    assert not any("Range" in headers for headers in server.requests)
+
+
+def test_truncated_dump_is_downloaded_again(server, tmp_path, monkeypatch):
+    monkeypatch.setenv("AI_KUN_WIKI_DUMP_URL", server.url)
+    monkeypatch.setenv("AI_KUN_DOWNLOAD_SEGMENT_MB", "1")
+    trainer = _trainer(tmp_path)
+    with open(trainer.wiki_dump_path, "wb") as f:
+        f.write(bz2.compress(random.Random(1).randbytes(100_000))[:5_000])
+    trainer.download_wikipedia_dump()
+    with open(trainer.wiki_dump_path, "rb") as f:
+        assert f.read() == DATA
@@ -0,0 +1,50 @@
+import os
+
+from model_registry import ModelRegistry
+
+
+def _save(registry):
+    version, path = registry.new_version()
+    os.makedirs(path)
+    return version
+
+
+def test_publish_and_rollback(tmp_path):
+    registry = ModelRegistry(str(tmp_path))
+    assert registry.current() is None
+    first = _save(registry)
+    registry.publish(first)
+    second = _save(registry)
+    assert second != first
+    registry.publish(second)
+    assert registry.current() == second
+    assert registry.rollback() == first
+    assert registry.current() == first
+    assert registry.rollback() is None
+
+
+def test_prune_keeps_current_and_recent_history(tmp_path):
+    registry = ModelRegistry(str(tmp_path), keep=1)
+    versions = []
+    for _ in range(3):
+        versions.append(_save(registry))
+        registry.publish(versions[-1])
+    assert registry.versions() == versions[1:]
+
+
+def test_unfinished_versions_are_ignored(tmp_path):
+    registry = ModelRegistry(str(tmp_path))
+    version, path = registry.new_version()
+    os.makedirs(path + ".tmp")
+    assert registry.versions() == []
+    assert registry.new_version()[0] != version
+
+
+def test_legacy_model_is_current_without_registry(tmp_path):
+    os.makedirs(tmp_path / ModelRegistry.LEGACY_VERSION)
+    registry = ModelRegistry(str(tmp_path))
+    assert registry.current() == ModelRegistry.LEGACY_VERSION
+    version = _save(registry)
+    registry.publish(version)
+    assert registry.current() == version
+    assert registry.rollback() == ModelRegistry.LEGACY_VERSION
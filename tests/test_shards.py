@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import pytest
+
+from lm_trainer import is_chief
+from shards import shard_dataset, shards_complete, write_shards
+
+
+class _FakeCache:
+    """
+    write_shards が使う TokenCache の部分だけを持つ、メモリ上のキャッシュ
+    """
+    def __init__(self, sequences, dtype):
+        self.sequences = [np.array(sequence, dtype=dtype) for sequence in sequences]
+        self.dtype = dtype
+        self.index = {}
+
+    def add(self, file):
+        self.index[os.path.abspath(file)] = {"key": "test"}
+
+    def iter_packed(self, files, block_size):
+        yield from self.sequences
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.uint32])
+def test_shard_dataset_reads_written_sequences(tmp_path, dtype):
+    sequences = [[70000 % np.iinfo(dtype).max, 5, 6, 7], [8, 9, 10], [11, 12, 13, 14, 15]]
+    cache = _FakeCache(sequences, dtype)
+    source = tmp_path / "corpus.txt"
+    cache.add(source)
+    shard_dir = str(tmp_path / "shards")
+    write_shards(cache, [str(source)], block_size=8, shard_dir=shard_dir, sequences_per_shard=2)
+    assert shards_complete(shard_dir)
+
+    batches = shard_dataset(shard_dir, batch_size=1, pad_token_id=0, shuffle_buffer_size=1, seed=0)
+    seen = set()
+    for inputs, labels, weights in batches.take(len(sequences) * 4):
+        length = int(weights.numpy().sum())
+        seen.add(tuple(inputs.numpy()[0, :length]) + (int(labels.numpy()[0, length - 1]),))
+    assert seen == {tuple(sequence) for sequence in sequences}
+
+
+def test_is_chief_prefers_chief_task():
+    assert is_chief(None, None)
+    assert is_chief("worker", 0, {"worker": ["a", "b"]})
+    assert not is_chief("worker", 1, {"worker": ["a", "b"]})
+    assert is_chief("chief", 0, {"chief": ["a"], "worker": ["b"]})
+    assert not is_chief("worker", 0, {"chief": ["a"], "worker": ["b"]})
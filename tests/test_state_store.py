@@ -0,0 +1,53 @@
+import sqlite3
+
+import pytest
+
+from state_store import StateStore
+
+
+def test_changes_persist_after_flush(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    store = StateStore(path)
+    store.set("is_ai_running", True)
+    store.set_channel_enabled(10, True)
+    store.update_channel_settings(10, max_length=80)
+    store.set_checkpoint("data", 10, 12345)
+    store.close()
+
+    store = StateStore(path)
+    assert store.get("is_ai_running") is True
+    assert store.enabled_channels() == {10}
+    assert store.channel_settings(10) == {"max_length": 80}
+    assert store.checkpoints("data") == {10: 12345}
+    store.close()
+
+
+class _FailingConnection:
+    """
+    トランザクションの書き込みで失敗する接続（ロック中・ディスクの空き不足の代わり）
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def executemany(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_failed_flush_keeps_changes_for_the_next_flush(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    store = StateStore(path)
+    conn = store._conn
+    store._conn = _FailingConnection(conn)
+    store.set_checkpoint("data", 10, 999)
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+
+    store._conn = conn
+    store.close()
+    assert StateStore(path).checkpoints("data") == {10: 999}
@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from corpus import CorpusWriter
+from token_cache import TokenCache
+
+CHARS = "あいうえおかきくけこさしすせそ"
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    vocab = {"[PAD]": 0, "</s>": 1, "<unk>": 2}
+    for char in CHARS:
+        vocab[char] = len(vocab)
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", eos_token="</s>", unk_token="<unk>")
+    path = str(tmp_path_factory.mktemp("tokenizer"))
+    tokenizer.save_pretrained(path)
+    # ワーカープロセスは名前（パス）からトークナイザーを読み込む
+    return PreTrainedTokenizerFast.from_pretrained(path)
+
+
+def _lines(seed, count):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(CHARS) for _ in range(rng.randint(1, 12))) for _ in range(count)]
+
+
+def _tokenize(tmp_path, tokenizer, files, name):
+    cache = TokenCache(str(tmp_path / name), tokenizer)
+    updated = cache.update(files, processes=1)
+    return cache, updated
+
+
+def _assert_same_as_fresh(cache, tmp_path, tokenizer, file):
+    fresh, _ = _tokenize(tmp_path, tokenizer, [file], "fresh")
+    np.testing.assert_array_equal(cache.load(file), fresh.load(file))
+    np.testing.assert_array_equal(cache.load_lengths(file), fresh.load_lengths(file))
+
+
+def test_appended_text_is_tokenized_incrementally(tmp_path, tokenizer, capsys):
+    path = str(tmp_path / "corpus.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(_lines(0, 50)) + "\n")
+    cache, _ = _tokenize(tmp_path, tokenizer, [path], "cache")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("\n".join(_lines(1, 20)) + "\n")
+    capsys.readouterr()
+
+    cache, updated = _tokenize(tmp_path, tokenizer, [path], "cache")
+    assert updated == 1
+    assert "(1 appended" in capsys.readouterr().out
+    assert cache.num_messages(path) == 70
+    _assert_same_as_fresh(cache, tmp_path, tokenizer, path)
+
+
+def test_appended_corpus_is_tokenized_incrementally(tmp_path, tokenizer, capsys):
+    path = str(tmp_path / "1_2.jsonl.gz")
+    for seed, start in ((0, 0), (1, 100)):
+        writer = CorpusWriter(path)
+        for i, line in enumerate(_lines(seed, 30)):
+            writer.write({"id": start + i, "content": line})
+        writer.close()
+        cache, _ = _tokenize(tmp_path, tokenizer, [path], "cache")
+    assert "(1 appended" in capsys.readouterr().out
+    _assert_same_as_fresh(cache, tmp_path, tokenizer, path)
+
+
+def test_rewritten_file_is_tokenized_again(tmp_path, tokenizer, capsys):
+    path = str(tmp_path / "corpus.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        # 最後の行に改行がないので、追記するとその行が書き足される
+        f.write("\n".join(_lines(0, 10)))
+    _tokenize(tmp_path, tokenizer, [path], "cache")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("あいう\n")
+    capsys.readouterr()
+    cache, _ = _tokenize(tmp_path, tokenizer, [path], "cache")
+    assert "(0 appended" in capsys.readouterr().out
+    _assert_same_as_fresh(cache, tmp_path, tokenizer, path)
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(_lines(2, 40)) + "\n")
+    capsys.readouterr()
+    cache, _ = _tokenize(tmp_path, tokenizer, [path], "cache")
+    assert "(0 appended" in capsys.readouterr().out
+    _assert_same_as_fresh(cache, tmp_path, tokenizer, path)
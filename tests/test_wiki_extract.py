@@ -0,0 +1,62 @@
+import bz2
+import os
+import random
+from xml.etree import ElementTree
+
+import pytest
+
+from prepare_and_train import WikipediaTrainer, _SkipPagesThrough
+
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet"]
+
+
+def _write_dump(path, pages=7):
+    rng = random.Random(0)
+    parts = ['<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/"><siteinfo><sitename>test</sitename></siteinfo>']
+    for pageid in range(1, pages + 1):
+        text = " ".join(rng.choice(WORDS) for _ in range(80))
+        parts.append(f"<page><title>Page {pageid}</title><ns>0</ns><id>{pageid}</id>"
+                     f"<revision><id>{100 + pageid}</id><text>{text}</text></revision></page>")
+    parts.append("</mediawiki>")
+    with open(path, "wb") as f:
+        f.write(bz2.compress("\n".join(parts).encode("utf-8")))
+
+
+def _trainer(tmp_path, name):
+    trainer = WikipediaTrainer.__new__(WikipediaTrainer)
+    trainer.wiki_dump_path = str(tmp_path / "dump.xml.bz2")
+    trainer.wiki_text_path = str(tmp_path / f"{name}.txt")
+    trainer.wiki_shard_dir = str(tmp_path / f"{name}_shards")
+    return trainer
+
+
+def test_resumed_extraction_matches_single_pass(tmp_path, monkeypatch):
+    _write_dump(str(tmp_path / "dump.xml.bz2"))
+    reference = _trainer(tmp_path, "reference")
+    reference.extract_and_clean_text(articles_per_shard=2, processes=1)
+
+    resumed = _trainer(tmp_path, "resumed")
+    complete = WikipediaTrainer._complete_extract_shard
+
+    def interrupt_after_two_shards(self, progress, shard_path, articles, last_pageid):
+        complete(self, progress, shard_path, articles, last_pageid)
+        if len(progress["shards"]) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(WikipediaTrainer, "_complete_extract_shard", interrupt_after_two_shards)
+    with pytest.raises(KeyboardInterrupt):
+        resumed.extract_and_clean_text(articles_per_shard=2, processes=1)
+    monkeypatch.setattr(WikipediaTrainer, "_complete_extract_shard", complete)
+    assert not os.path.exists(resumed.wiki_text_path)
+
+    resumed.extract_and_clean_text(articles_per_shard=2, processes=1)
+    with open(reference.wiki_text_path, encoding="utf-8") as expected, open(resumed.wiki_text_path, encoding="utf-8") as f:
+        text = f.read()
+        assert text == expected.read()
+    assert len(text.splitlines()) == 7
+
+
+def test_skip_pages_through_last_written_page():
+    skipper = _SkipPagesThrough("3")
+    pages = [ElementTree.fromstring(f"<page><id>{pageid}</id></page>") for pageid in range(1, 6)]
+    assert [bool(skipper(page, pageid_path="./id")) for page in pages] == [False, False, False, True, True]